@@ -1,5 +1,7 @@
 import datetime
+import itertools
 import logging
+import time
 import traceback
 
 import flask_socketio as client_socket
@@ -73,6 +75,7 @@ def socketio_outer_event(*args, **kwargs):
             g.language = request.args.get("language")
             conn = psycopg2.connect(app.config["SQLALCHEMY_DATABASE_URI"])
             g.pyslate = create_pyslate(g.language, backend=postgres_backend.PostgresBackend(conn, "translations"))
+            socketio_users.refresh_sid(request.sid)
             result = f(*a, **k)  # argument list (the first and only positional arg) is expanded
             return (True,) + (result if result else ())
 
@@ -100,6 +103,7 @@ def socketio_player_event(*args, **kwargs):
 
             conn = psycopg2.connect(app.config["SQLALCHEMY_DATABASE_URI"])
             g.pyslate = create_pyslate(g.language, backend=postgres_backend.PostgresBackend(conn, "translations"))
+            socketio_users.refresh_sid(request.sid)
             result = f(*a, **k)  # argument list (the first and only positional arg) is expanded
             return (True,) + (result if result else ())
 
@@ -128,6 +132,7 @@ def socketio_character_event(*args, **kwargs):
             if not g.character.is_alive:
                 raise main.CharacterDeadException(character=g.character)
 
+            socketio_users.refresh_sid(request.sid)
             result = f(*a, **k)  # argument list (the first and only positional arg) is expanded
             return (True,) + (result if result else ())
 
@@ -138,6 +143,8 @@ def socketio_character_event(*args, **kwargs):
 
 app.encode = main.encode
 app.decode = main.decode
+app.encode_many = main.encode_many
+app.decode_many = main.decode_many
 
 from exeris.outer import outer_bp
 from exeris.player import player_bp
@@ -732,39 +739,186 @@ def character_preprocessor(endpoint, values):
 
 
 class SocketioUsers:
+    """
+    Keeps track of socketio sids of the players and characters. Every sid has a reverse index "sids:<sid>"
+    containing names of all the sets it belongs to, so the sid can be removed without scanning the whole database.
+    The reverse index of a sid expires after SID_TTL seconds since its last activity. Sids whose reverse index
+    has expired (e.g. sids of a crashed server) are skipped and removed from the sets when the sets are read.
+    All the keys expire after SID_TTL seconds since the last activity of any of their sids.
+    """
+    SID_TTL = 24 * 60 * 60  # in seconds
+    REFRESH_INTERVAL = 5 * 60  # in seconds, the expiration is extended at most once per interval for every sid
+
+    PLAYER_KEY_PREFIX = "sid_by_player_id:"
+    CHARACTER_KEY_PREFIX = "sid_by_character_id:"
+    OPEN_ENTITY_KEY_PREFIX = "sid_by_open_entity_id:"
+    SID_KEY_PREFIX = "sids:"
+
     def __init__(self):
         # redis_db.flushdb()
-        pass
+        self._last_refresh_by_sid = {}
 
     def get_all_by_player_id(self, player_id):
-        result_from_redis = redis_db.smembers("sid_by_player_id:" + str(player_id))
-        return [result.decode('utf-8') for result in result_from_redis]
+        return self.get_all_by_player_ids([player_id])[player_id]
 
     def get_all_by_character_id(self, character_id):
-        result_from_redis = redis_db.smembers("sid_by_character_id:" + str(character_id))
-
-        return [result.decode('utf-8') for result in result_from_redis]
+        return self.get_all_by_character_ids([character_id])[character_id]
+
+    def get_all_by_player_ids(self, player_ids):
+        """
+        :return: dict of player id -> list of sids, retrieved in a single pipeline
+        """
+        return self._get_all_by_ids(self.PLAYER_KEY_PREFIX, player_ids)
+
+    def get_all_by_character_ids(self, character_ids):
+        """
+        :return: dict of character id -> list of sids, retrieved in a single pipeline
+        """
+        return self._get_all_by_ids(self.CHARACTER_KEY_PREFIX, character_ids)
+
+    def get_all_by_open_entity_ids(self, entity_ids):
+        """
+        :return: dict of entity id -> list of sids having contents of this entity expanded in the entities panel
+        """
+        return self._get_all_by_ids(self.OPEN_ENTITY_KEY_PREFIX, entity_ids)
+
+    def get_character_ids_by_sids(self, sids):
+        """
+        :return: dict of sid -> id of the character (or None) connected through this sid
+        """
+        sids = list(sids)
+        pipe = redis_db.pipeline()
+        for sid in sids:
+            pipe.smembers(self.SID_KEY_PREFIX + sid)
+        results_from_redis = pipe.execute()
+
+        character_ids = {}
+        for sid, set_names in zip(sids, results_from_redis):
+            character_ids[sid] = None
+            for set_name in set_names:
+                set_name = set_name.decode('utf-8')
+                if set_name.startswith(self.CHARACTER_KEY_PREFIX):
+                    character_ids[sid] = int(set_name[len(self.CHARACTER_KEY_PREFIX):])
+        return character_ids
 
     def add_for_player_id(self, sid, player_id):
-        redis_db.sadd("sid_by_player_id:" + str(player_id), sid)
+        self._add_to_set(sid, self.PLAYER_KEY_PREFIX + str(player_id))
 
     def add_for_character_id(self, sid, character_id):
-        redis_db.sadd("sid_by_character_id:" + str(character_id), sid)
+        self._add_to_set(sid, self.CHARACTER_KEY_PREFIX + str(character_id))
 
-    def remove_sid(self, sid):
-        player_id_sets = redis_db.keys("sid_by_player_id:*")
-        for player_id_set_name in player_id_sets:
-            redis_db.srem(player_id_set_name, sid)
+    def add_for_open_entity_id(self, sid, entity_id):
+        self._add_to_set(sid, self.OPEN_ENTITY_KEY_PREFIX + str(entity_id))
 
-        character_id_sets = redis_db.keys("sid_by_character_id:*")
-        for character_id_set_name in character_id_sets:
-            redis_db.srem(character_id_set_name, sid)
+    def remove_sid_for_open_entity_id(self, sid, entity_id):
+        set_name = self.OPEN_ENTITY_KEY_PREFIX + str(entity_id)
+
+        pipe = redis_db.pipeline()
+        pipe.srem(set_name, sid)
+        pipe.srem(self.SID_KEY_PREFIX + sid, set_name)
+        pipe.execute()
+
+    def remove_sid(self, sid):
+        sid_key = self.SID_KEY_PREFIX + sid
+        set_names = redis_db.smembers(sid_key)
+
+        pipe = redis_db.pipeline()
+        for set_name in set_names:
+            pipe.srem(set_name, sid)
+        pipe.delete(sid_key)
+        pipe.execute()
+        self._last_refresh_by_sid.pop(sid, None)
+
+    def remove_all_open_entity_ids_of_sid(self, sid):
+        sid_key = self.SID_KEY_PREFIX + sid
+        set_names = [set_name for set_name in redis_db.smembers(sid_key)
+                     if set_name.decode('utf-8').startswith(self.OPEN_ENTITY_KEY_PREFIX)]
+        if not set_names:
+            return
+
+        pipe = redis_db.pipeline()
+        for set_name in set_names:
+            pipe.srem(set_name, sid)
+        pipe.srem(sid_key, *set_names)
+        pipe.execute()
+
+    def refresh_sid(self, sid):
+        """
+        Extends the expiration time of the sid and all the sets it belongs to.
+        It's called on every event received from the sid, so connections open for a long time don't expire,
+        but it's done at most once per REFRESH_INTERVAL.
+        """
+        now = time.time()
+        if now - self._last_refresh_by_sid.get(sid, 0) < self.REFRESH_INTERVAL:
+            return
+        self._last_refresh_by_sid[sid] = now
+
+        sid_key = self.SID_KEY_PREFIX + sid
+        set_names = redis_db.smembers(sid_key)
+
+        pipe = redis_db.pipeline()
+        for set_name in set_names:
+            pipe.expire(set_name, self.SID_TTL)
+        pipe.expire(sid_key, self.SID_TTL)
+        pipe.execute()
 
     def remove_for_player_id(self, player_id):
-        redis_db.delete("sid_by_player_id:" + str(player_id))
+        self._remove_set(self.PLAYER_KEY_PREFIX + str(player_id))
 
     def remove_for_character_id(self, character_id):
-        redis_db.delete("sid_by_character_id:" + str(character_id))
+        self._remove_set(self.CHARACTER_KEY_PREFIX + str(character_id))
+
+    def _get_all_by_ids(self, key_prefix, ids):
+        ids = list(ids)
+        if not ids:
+            return {}
+
+        pipe = redis_db.pipeline()
+        for entity_id in ids:
+            pipe.smembers(key_prefix + str(entity_id))
+        results_from_redis = pipe.execute()
+
+        sids_by_id = {entity_id: [result.decode('utf-8') for result in results]
+                      for entity_id, results in zip(ids, results_from_redis)}
+        live_sids = self._get_live_sids(itertools.chain(*sids_by_id.values()))
+
+        pipe = redis_db.pipeline()
+        for entity_id, sids in sids_by_id.items():
+            dead_sids = [sid for sid in sids if sid not in live_sids]
+            if dead_sids:
+                pipe.srem(key_prefix + str(entity_id), *dead_sids)
+        pipe.execute()
+
+        return {entity_id: [sid for sid in sids if sid in live_sids] for entity_id, sids in sids_by_id.items()}
+
+    def _get_live_sids(self, sids):
+        """
+        :return: set of the sids whose reverse index hasn't expired yet
+        """
+        sids = list(set(sids))
+        pipe = redis_db.pipeline()
+        for sid in sids:
+            pipe.exists(self.SID_KEY_PREFIX + sid)
+        return {sid for sid, exists in zip(sids, pipe.execute()) if exists}
+
+    def _add_to_set(self, sid, set_name):
+        sid_key = self.SID_KEY_PREFIX + sid
+
+        pipe = redis_db.pipeline()
+        pipe.sadd(set_name, sid)
+        pipe.expire(set_name, self.SID_TTL)
+        pipe.sadd(sid_key, set_name)
+        pipe.expire(sid_key, self.SID_TTL)
+        pipe.execute()
+
+    def _remove_set(self, set_name):
+        sids = redis_db.smembers(set_name)
+
+        pipe = redis_db.pipeline()
+        for sid in sids:
+            pipe.srem(self.SID_KEY_PREFIX + sid.decode('utf-8'), set_name)
+        pipe.delete(set_name)
+        pipe.execute()
 
 
 socketio_users = SocketioUsers()
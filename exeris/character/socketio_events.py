@@ -1,15 +1,17 @@
+import hashlib
 import logging
 import string
 import time
 
 import flask_socketio as client_socket
-from flask import g, render_template
+from flask import g, render_template, request
 
-from exeris.app import socketio_character_event
+from exeris.app import socketio_character_event, socketio_users
 from exeris.core import models, actions, accessible_actions, recipes, deferred, general, main, combat
 from exeris.core import properties
 from exeris.core.main import db, app
 from exeris.core.properties_base import P
+from exeris.extra import entities_panel
 
 logger = logging.getLogger(__name__)
 
@@ -417,12 +419,7 @@ def _get_entities_in(parent_entity, observer, excluded=None):
                                                                open_entity=parent_entity).first():
             db.session.add(models.EntityContentsPreference(g.character, parent_entity))
 
-    entity_entries = []
-    for entity in entities:
-        entity_info = _get_entity_info(entity, observer)
-
-        entity_entries.append(entity_info)
-    return entity_entries
+    return _get_entities_info(entities, observer)
 
 
 @socketio_character_event("collapse_entity")
@@ -431,13 +428,24 @@ def collapse_entity(parent_entity_id):
     pref = models.EntityContentsPreference.query.filter_by(character=g.character, open_entity=parent_entity).first()
     if pref:
         db.session.delete(pref)
+    socketio_users.remove_sid_for_open_entity_id(request.sid, parent_entity.id)
 
     db.session.commit()
     return parent_entity_id,
 
 
 @socketio_character_event("entities_refresh_list")
-def entities_refresh_list(view):
+def entities_refresh_list(view, known_versions=None):
+    """
+    Returns info about all the locations displayed at the top level of the entities panel.
+    Locations whose info is already known by the client in the current version are not rendered again.
+    All the sublists are collapsed, so the sid stops being notified about changes of their contents.
+    :param known_versions: dict of encoded location id -> version of the location info shown by the client
+    :return: list of dicts containing "id", "version" and "html", which is None if the client has the current version
+    """
+    known_versions = known_versions if known_versions else {}
+    socketio_users.remove_all_open_entity_ids_of_sid(request.sid)
+
     if view == "inventory":
         displayed_locations = [g.character]
     else:
@@ -449,7 +457,17 @@ def entities_refresh_list(view):
             displayed_locations.remove(location.get_root())
         displayed_locations = [location] + displayed_locations
 
-    locations = [_get_entity_info(loc_to_show, g.character) for loc_to_show in displayed_locations]
+    versions = entities_panel.get_info_versions(displayed_locations)
+    encoded_ids = app.encode_many(models.ids(displayed_locations))
+    outdated_locations = [location for location, encoded_id, version
+                          in zip(displayed_locations, encoded_ids, versions)
+                          if known_versions.get(encoded_id) != version]
+    rendered_by_id = {location_info["id"]: location_info
+                      for location_info in _get_entities_info(outdated_locations, g.character)}
+
+    locations = [{"id": encoded_id, "version": version,
+                  "html": rendered_by_id[encoded_id]["html"] if encoded_id in rendered_by_id else None}
+                 for encoded_id, version in zip(encoded_ids, versions)]
     return locations,
 
 
@@ -467,14 +485,48 @@ def refresh_entity_info(entity_id):
 
 @socketio_character_event("entities_get_sublist")
 def entities_get_sublist(entity_id, parent_parent_id):
+    parent_entity = _get_parent_entity_of_sublist(entity_id)
+    version = entities_panel.get_contents_version(parent_entity.id)
+    rendered = _get_entities_in(parent_entity, g.character, _get_excluded_from_sublist(parent_parent_id))
+    socketio_users.add_for_open_entity_id(request.sid, parent_entity.id)
+
+    return entity_id, rendered, version
+
+
+@socketio_character_event("entities_get_sublist_changes")
+def entities_get_sublist_changes(entity_id, parent_parent_id, known_version, known_hashes):
+    """
+    Returns only the rows of the sublist which were added, removed or changed since the known version.
+    :param known_version: contents version of the sublist which is shown by the client
+    :param known_hashes: dict of encoded entity id -> hash of each row shown by the client
+    :return: tuple (entity_id, version, changes), where changes is None if nothing has changed
+    """
+    parent_entity = _get_parent_entity_of_sublist(entity_id)
+    version = entities_panel.get_contents_version(parent_entity.id)
+    if version == known_version:
+        return entity_id, version, None
+
+    rendered = _get_entities_in(parent_entity, g.character, _get_excluded_from_sublist(parent_parent_id))
+
+    rendered_ids = {row["id"] for row in rendered}
+    changes = {
+        "added": [row for row in rendered if row["id"] not in known_hashes],
+        "changed": [row for row in rendered if row["id"] in known_hashes and known_hashes[row["id"]] != row["hash"]],
+        "removed": [row_id for row_id in known_hashes if row_id not in rendered_ids],
+    }
+    return entity_id, version, changes
+
+
+def _get_parent_entity_of_sublist(entity_id):
     parent_entity = models.Entity.by_id(app.decode(entity_id))
     rng = general.VisibilityBasedRange(distance=30)
     if not rng.is_near(g.character, parent_entity):
         raise main.EntityTooFarAwayException(entity=parent_entity)
-    exclude = [models.Entity.by_id(app.decode(parent_parent_id))] if parent_parent_id else []
-    rendered = _get_entities_in(parent_entity, g.character, exclude)
+    return parent_entity
 
-    return entity_id, rendered,
+
+def _get_excluded_from_sublist(parent_parent_id):
+    return [models.Entity.by_id(app.decode(parent_parent_id))] if parent_parent_id else []
 
 
 @socketio_character_event("move_to_location")
@@ -592,22 +644,72 @@ def get_identifier_for_union(union_id):
 
 
 def _get_entity_info(entity, observer):
-    if isinstance(entity, models.Passage):
-        entity = _get_directed_passage_in_correct_direction(g.character.being_in, entity)
+    return _get_entities_info([entity], observer)[0]
+
+
+def _get_entities_info(entities, observer):
+    """
+    Renders info about all the specified entities. Properties, activities and contents of all the entities
+    are loaded at once, so the number of queries doesn't grow with the number of entities.
+    :param entities: list of Entities or Passages to be shown
+    :param observer: character who looks at the entities
+    :return: list of dicts containing "html" and "id" of each entity
+    """
+    rows = []  # (entity, other_side, full_name)
+    for entity in entities:
+        if isinstance(entity, models.Passage):
+            entity = _get_directed_passage_in_correct_direction(g.character.being_in, entity)
 
-    other_side = None
-    if isinstance(entity, models.PassageToNeighbour):
-        full_name = g.pyslate.t("entity_info",
-                                other_side=entity.other_side.pyslatize(detailed=True),
-                                **entity.passage.pyslatize(detailed=True))
-        passage_to_neighbour = entity
-        entity = passage_to_neighbour.passage
-        other_side = passage_to_neighbour.other_side
+        if isinstance(entity, models.PassageToNeighbour):
+            rows.append((entity.passage, entity.other_side))
+        elif isinstance(entity, models.Entity):
+            rows.append((entity, None))
+        else:
+            raise ValueError("Entity to show is of type {}".format(type(entity)))
 
-    elif isinstance(entity, models.Entity):
-        full_name = g.pyslate.t("entity_info", **entity.pyslatize(html=True, detailed=True))
+    if not rows:
+        return []
+
+    all_entities = [entity for entity, other_side in rows] + [other_side for entity, other_side in rows if other_side]
+
+    with models.prefetched_properties(all_entities):
+        activities_by_parent_id = {}
+        for activity in models.Activity.query.filter(models.Activity.is_in(all_entities)).all():
+            activities_by_parent_id.setdefault(activity.parent_entity_id, activity)
+
+        contents_of_entities = db.session.query(models.Entity.parent_entity_id, models.Entity.role,
+                                                models.Entity.discriminator_type) \
+            .filter(models.Entity.parent_entity_id.in_(models.ids(all_entities))) \
+            .filter(models.Entity.discriminator_type != models.ENTITY_ACTIVITY).distinct().all()
+        ids_of_entities_having_children = {parent_id for parent_id, role, discriminator in contents_of_entities}
+        ids_of_entities_having_entities_in = {parent_id for parent_id, role, discriminator in contents_of_entities
+                                              if role == models.Entity.ROLE_BEING_IN and discriminator not in
+                                              [models.ENTITY_LOCATION, models.ENTITY_ROOT_LOCATION]}
+
+        entity_info_template = app.jinja_env.get_template("entities/entity_info.html")
+
+        def render_entity_info(**context):
+            app.update_template_context(context)
+            return entity_info_template.render(context)
+
+        encoded_ids = app.encode_many([entity.id for entity, other_side in rows])
+
+        entity_entries = []
+        for (entity, other_side), encoded_id in zip(rows, encoded_ids):
+            entity_entries.append(_get_single_entity_info(entity, encoded_id, other_side, observer,
+                                                          activities_by_parent_id, ids_of_entities_having_children,
+                                                          ids_of_entities_having_entities_in, render_entity_info))
+        return entity_entries
+
+
+def _get_single_entity_info(entity, encoded_id, other_side, observer, activities_by_parent_id,
+                            ids_of_entities_having_children, ids_of_entities_having_entities_in, render_entity_info):
+    if other_side:
+        full_name = g.pyslate.t("entity_info",
+                                other_side=other_side.pyslatize(detailed=True),
+                                **entity.pyslatize(detailed=True))
     else:
-        raise ValueError("Entity to show is of type {}".format(type(entity)))
+        full_name = g.pyslate.t("entity_info", **entity.pyslatize(html=True, detailed=True))
 
     def has_needed_prop(entity, action):
         if action.required_property == P.ANY:
@@ -616,9 +718,8 @@ def _get_entity_info(entity, observer):
 
     activities = []
     # TODO translation
-    activity = models.Activity.query.filter(models.Activity.is_in(entity)).first()
-    if activity:
-        activities.append(activity)
+    if entity.id in activities_by_parent_id:
+        activities.append(activities_by_parent_id[entity.id])
 
     possible_actions = [accessible_actions.EntityActionRecord(entity, action)
                         for action in accessible_actions.ACTIONS_ON_GROUND
@@ -630,17 +731,15 @@ def _get_entity_info(entity, observer):
                              if has_needed_prop(other_side, action) and action.other_req(other_side)]
 
         other_side_is_enterable_or_storage = other_side.has_property(P.STORAGE) or other_side.has_property(P.ENTERABLE)
-        are_entities_on_other_side = models.Entity.query.filter(models.Entity.is_in(other_side)) \
-                                         .filter(models.Entity.discriminator_type != models.ENTITY_ACTIVITY).count() > 0
+        are_entities_on_other_side = other_side.id in ids_of_entities_having_entities_in
         if not are_entities_on_other_side:
             are_entities_on_other_side = models.Passage.query.filter(models.Passage.incident(other_side)).count() > 1
 
         can_see_the_other_side = general.VisibilityBasedRange(distance=30).is_near(g.character, other_side)
         expandable = other_side_is_enterable_or_storage and are_entities_on_other_side and can_see_the_other_side
 
-        activity = models.Activity.query.filter(models.Activity.is_in(other_side)).first()
-        if activity:
-            activities.append(activity)
+        if other_side.id in activities_by_parent_id:
+            activities.append(activities_by_parent_id[other_side.id])
 
         other_side_member_of_union = properties.OptionalMemberOfUnionProperty(other_side)
         union_membership = get_identifier_for_union(other_side_member_of_union.get_union_id())
@@ -648,16 +747,16 @@ def _get_entity_info(entity, observer):
         expandable = entity == observer or \
                      (entity.has_property(P.STORAGE) or entity.has_property(P.ENTERABLE)) \
                      and not entity.has_property(P.CLOSEABLE, closed=True) and \
-                     models.Entity.query.filter(models.Entity.parent_entity == entity) \
-                         .filter(models.Entity.discriminator_type != models.ENTITY_ACTIVITY).first() is not None
+                     entity.id in ids_of_entities_having_children
 
         entity_member_of_union = properties.OptionalMemberOfUnionProperty(entity)
         union_membership = get_identifier_for_union(entity_member_of_union.get_union_id())
 
-    entity_html = render_template("entities/entity_info.html", full_name=full_name, entity_id=entity.id,
-                                  actions=possible_actions, activities=activities, expandable=expandable,
-                                  other_side=other_side, union_membership=union_membership)
-    return {"html": entity_html, "id": app.encode(entity.id)}
+    entity_html = render_entity_info(full_name=full_name, entity_id=entity.id,
+                                     actions=possible_actions, activities=activities, expandable=expandable,
+                                     other_side=other_side, union_membership=union_membership)
+    return {"html": entity_html, "id": encoded_id,
+            "hash": hashlib.sha1(entity_html.encode()).hexdigest()}
 
 
 def _get_directed_passage_in_correct_direction(char_location, entity):
@@ -1,11 +1,51 @@
 FRAGMENTS.entities = (function($, socket) {
 
+    var sublist_versions = {}; // entity id -> contents version of the expanded sublist
+
+    var get_entity_node = function(entity_id) {
+        var entity_node = $("div[data-entity='" + entity_id + "']");
+        if (entity_node.length == 0) {
+            entity_node = $("div[data-other-side='" + entity_id + "']");
+        }
+        return entity_node;
+    };
+
+    var create_entity_row = function(entity_info) {
+        return $("<li>" + entity_info.html + "</li>").data("hash", entity_info.hash);
+    };
+
+    var location_versions = {}; // location id -> version of the location info shown at the top level
+
     $.subscribe("entities:refresh_list", function() {
-        socket.emit("entities_refresh_list", entities_to_show, function(locations) {
+        var known_versions = {}; // only of the locations which are still shown
+        $("#entities_root > ol > li > .entity_info").each(function() {
+            var location_id = $(this).data("entity");
+            if (location_id in location_versions) {
+                known_versions[location_id] = location_versions[location_id];
+            }
+        });
+        socket.emit("entities_refresh_list", entities_to_show, known_versions, function(locations) {
             var entities_root = $("#entities_root > ol");
+            var old_location_rows = {};
+            entities_root.children("li").each(function() {
+                old_location_rows[$(this).children(".entity_info").data("entity")] = $(this).detach();
+            });
             entities_root.empty();
+            sublist_versions = {};
+            location_versions = {};
             $.each(locations, function(idx, location_info) {
-                entities_root.append($("<li></li>").append(location_info.html));
+                var location_row;
+                if (location_info.html === null) { // the same as the one already shown
+                    location_row = old_location_rows[location_info.id];
+                    // server unsubscribes the sid from all the sublists, so they are collapsed
+                    location_row.find("ol").remove();
+                    location_row.find(".collapse_subtree").text("\\/")
+                        .addClass("expand_subtree").removeClass("collapse_subtree");
+                } else {
+                    location_row = $("<li></li>").append(location_info.html);
+                }
+                location_versions[location_info.id] = location_info.version;
+                entities_root.append(location_row);
             });
 
             $("#entities_root .entity_info").first().find("button.expand_subtree").click();
@@ -38,15 +78,14 @@ FRAGMENTS.entities = (function($, socket) {
         }
 
         var entity_parent = entity_node.parent().closest(".entity_info");
-        socket.emit("entities_get_sublist", entity_id, entity_parent.data("entity"), function(parent_id, entities) {
+        socket.emit("entities_get_sublist", entity_id, entity_parent.data("entity"),
+            function(parent_id, entities, version) {
             var list = $("<ol></ol>");
             $.each(entities, function(idx, entity_info) {
-                list.append($("<li>" + entity_info.html + "</li>"));
+                list.append(create_entity_row(entity_info));
             });
-            var parent = $("div[data-entity='" + parent_id + "']");
-            if (parent.length == 0) { // todo handling other-side
-                parent = $("div[data-other-side='" + parent_id + "']");
-            }
+            var parent = get_entity_node(parent_id);
+            sublist_versions[parent_id] = version;
             parent.append(list);
             parent.children(".expand_subtree").text("/\\").addClass("collapse_subtree").removeClass("expand_subtree");
         });
@@ -56,12 +95,55 @@ FRAGMENTS.entities = (function($, socket) {
         var entity_id = $(event.target).closest(".entity_info").data("entity");
 
         socket.emit("collapse_entity", entity_id, function(entity_id) {
+            delete sublist_versions[entity_id];
             var parent = $("div[data-entity='" + entity_id + "']");
             parent.find("ol").remove();
             parent.children(".collapse_subtree").text("\\/").addClass("expand_subtree").removeClass("collapse_subtree");
         });
     });
 
+    socket.on("entities.contents_changed", function(parent_id, version) {
+        if (!(parent_id in sublist_versions) || sublist_versions[parent_id] == version) {
+            return;
+        }
+        var parent = get_entity_node(parent_id);
+        var list = parent.children("ol");
+        var known_hashes = {};
+        list.children("li").each(function() {
+            known_hashes[$(this).children(".entity_info").data("entity")] = $(this).data("hash");
+        });
+
+        var entity_parent = parent.parent().closest(".entity_info");
+        socket.emit("entities_get_sublist_changes", parent_id, entity_parent.data("entity"),
+            sublist_versions[parent_id], known_hashes, function(parent_id, version, changes) {
+            sublist_versions[parent_id] = version;
+            if (!changes) {
+                return;
+            }
+            var row_of = function(entity_id) {
+                return list.children("li").filter(function() {
+                    return $(this).children(".entity_info").data("entity") == entity_id;
+                });
+            };
+            $.each(changes.removed, function(idx, entity_id) {
+                row_of(entity_id).remove();
+            });
+            $.each(changes.changed, function(idx, entity_info) {
+                var old_row = row_of(entity_info.id);
+                var new_row = create_entity_row(entity_info);
+                var old_sublist = old_row.children(".entity_info").children("ol");
+                if (old_sublist.length) { // keep the expanded contents
+                    new_row.children(".entity_info").append(old_sublist).children(".expand_subtree")
+                        .text("/\\").addClass("collapse_subtree").removeClass("expand_subtree");
+                }
+                old_row.replaceWith(new_row);
+            });
+            $.each(changes.added, function(idx, entity_info) {
+                list.append(create_entity_row(entity_info));
+            });
+        });
+    });
+
     $(document).on("click", "#confirm_edit_readable", function(event) {
         var new_text = $("#edit_readable_text").val();
         var entity_id = $(event.target).data("entity");
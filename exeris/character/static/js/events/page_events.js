@@ -14,8 +14,10 @@ FRAGMENTS.events = (function($, socket) {
         });
     });
 
-    socket.on("character.new_event", function(event_id, event_text) {
-        $(".events_list_contents > ol").prepend(convertEventToText(event_text, event_id));
+    socket.on("character.new_events", function(new_events) {
+        for (var i = 0; i < new_events.length; i++) {
+            $(".events_list_contents > ol").prepend(convertEventToText(new_events[i][1], new_events[i][0]));
+        }
     });
 
 })(jQuery, socket);
@@ -1,5 +1,7 @@
+import collections
+import itertools
 import math
-import sys
+import weakref
 from statistics import mean
 
 import random
@@ -11,7 +13,8 @@ from exeris.core.deferred import convert
 from exeris.core.main import db, Events, PartialEvents
 from exeris.core.properties import P
 from flask import logging
-from sqlalchemy import func
+from flask_sqlalchemy import SignallingSession
+from geoalchemy2.shape import from_shape
 
 logger = logging.getLogger(__name__)
 
@@ -269,10 +272,7 @@ class CreateItemAction(ActivityAction):
         predicted_item_weight = self.amount * self.item_type.unit_weight
         if not self.item_type.portable:
             return False
-        inventory_weight = db.session.query(func.sum(models.Entity.weight)) \
-            .filter(models.Entity.is_in(self.initiator)).scalar()
-        inventory_weight = inventory_weight if inventory_weight else 0
-        return inventory_weight + predicted_item_weight <= get_max_allowed_weight(self.initiator)
+        return self.initiator.contents_weight() + predicted_item_weight <= get_max_allowed_weight(self.initiator)
 
     def create_or_update_stackable_item(self, result_loc, item_weight):
         existing_pile = models.Item.query \
@@ -504,19 +504,43 @@ class ProcessAction(AbstractAction):
 class WorkProcess(ProcessAction):
     SCHEDULER_RUNNING_INTERVAL = 10 * general.GameDate.SEC_IN_MIN
 
+    # number of intents or activities performed in a single savepoint, 1 means a savepoint for each of them
+    CHUNK_SIZE = 50
+
+    # shared by all the runs of the process, so actions of unchanged intents are not deserialized every tick
+    deserialized_actions_cache = deferred.DeserializedActionsCache()
+
+    # failure notifications reported in the current tick by (character id, content hash)
+    failure_notifications_of_tick = {}
+
     def __init__(self, task):
         super().__init__(task)
 
     def perform_action(self):
-        work_intents = models.Intent.query.filter_by(type=main.Intents.WORK).order_by(
-            models.Intent.priority.desc()).all()
+        WorkProcess.failure_notifications_of_tick.clear()
+
+        # activities in a steady state don't need to be progressed until their scheduled completion
+        activities_in_steady_state = models.Activity.query.filter(
+            models.Activity.steady_state_dependencies.isnot(None)).all()
+        self.check_crews_of_activities_in_steady_state(activities_in_steady_state)
+
+        work_intents = models.Intent.query.filter_by(type=main.Intents.WORK)
+        if activities_in_steady_state:
+            steady_activity_ids = [activity.id for activity in activities_in_steady_state]
+            work_intents = work_intents.filter(sql.or_(models.Intent.target_id.is_(None),
+                                                       ~models.Intent.target_id.in_(steady_activity_ids)))
+        work_intents = work_intents.order_by(models.Intent.priority.desc()).all()
+        self.deserialized_actions_cache.retain_only(work_intents)
+        # keeps the objects in the identity map until all the actions are deserialized
+        preloaded_objects = self.deserialized_actions_cache.preload(work_intents)
 
         activities_to_progress = {}
+        intents_to_perform = []
         for work_intent in work_intents:
             # in fact it shouldn't move anything, it should store intermediate data about direction and speed for each
             # RootLocation, because there can be multi-location vehicles.
             # But there can also be 2 separate veh in one RootLocation
-            action_to_perform = deferred.call(work_intent.serialized_action)
+            action_to_perform = self.deserialized_actions_cache.get_action(work_intent)
 
             if isinstance(action_to_perform, WorkOnActivityAction):
                 # activities are handled differently, because all participants must be converted at once
@@ -524,74 +548,147 @@ class WorkProcess(ProcessAction):
                     activities_to_progress[action_to_perform.activity] = []
                 activities_to_progress[action_to_perform.activity] += [work_intent.executor]
                 continue
+            intents_to_perform.append(work_intent)
 
-            try:
-                db.session.begin_nested()
-                result = action_to_perform.perform()
-
-                if result:  # action finished successfully and should be removed
-                    logger.info("Intent %s of %s finished successfully. Removing it",
-                                str(action_to_perform), str(work_intent.executor))
-                    db.session.delete(work_intent)
-                work_intent.serialized_action = deferred.serialize(action_to_perform)
-                db.session.commit()
-            except main.TurningIntoIntentExceptionMixin:
-                db.session.rollback()  # for actions that need to be tried every tick
-            except main.GameException as exception:
-                db.session.rollback()
-                self.report_failure_notification(exception.error_tag, exception.error_kwargs, work_intent.executor)
-            except:  # action failed for unknown (probably not temporary) reason
-                logger.error("Unknown exception prevented execution of %s", str(action_to_perform), exc_info=True)
-                raise
+        self.perform_in_chunks(intents_to_perform, self.perform_intent, self.handle_intent_failure)
 
         self.process_activities_progress(activities_to_progress)
         self.process_travel_movement()
 
+    def perform_in_chunks(self, jobs, perform_job, handle_failure):
+        """
+        Performs jobs in chunks of CHUNK_SIZE, every chunk in a single savepoint.
+        If any job of the chunk fails, then the whole chunk is rolled back and bisected
+        until the failing job is isolated, so all the other jobs can be performed successfully.
+        :param jobs: list of jobs to perform
+        :param perform_job: function performing a single job
+        :param handle_failure: function called with the job and the exception after the failed job is rolled back
+        """
+        for chunk_start in range(0, len(jobs), self.CHUNK_SIZE):
+            self._perform_chunk(jobs[chunk_start:chunk_start + self.CHUNK_SIZE], perform_job, handle_failure)
+
+    def _perform_chunk(self, chunk, perform_job, handle_failure):
+        try:
+            db.session.begin_nested()
+            for job in chunk:
+                perform_job(job)
+            db.session.commit()
+        except (main.TurningIntoIntentExceptionMixin, main.GameException) as exception:
+            db.session.rollback()
+            if len(chunk) == 1:
+                handle_failure(chunk[0], exception)
+            else:
+                logger.debug("Chunk of %s jobs failed, bisecting it", len(chunk))
+                middle = len(chunk) // 2
+                self._perform_chunk(chunk[:middle], perform_job, handle_failure)
+                self._perform_chunk(chunk[middle:], perform_job, handle_failure)
+        except:  # job failed for unknown (probably not temporary) reason
+            logger.error("Unknown exception prevented execution of %s", chunk, exc_info=True)
+            raise
+
+    def perform_intent(self, work_intent):
+        try:
+            action_to_perform = self.deserialized_actions_cache.get_action(work_intent)
+            result = action_to_perform.perform()
+        except:
+            # action could have been changed before failure
+            self.deserialized_actions_cache.discard(work_intent)
+            raise
+
+        if result:  # action finished successfully and should be removed
+            logger.info("Intent %s of %s finished successfully. Removing it",
+                        str(action_to_perform), str(work_intent.executor))
+            db.session.delete(work_intent)
+            self.deserialized_actions_cache.discard(work_intent)
+        else:
+            self.deserialized_actions_cache.update(work_intent, action_to_perform)
+
+    def handle_intent_failure(self, work_intent, exception):
+        if not isinstance(exception, main.TurningIntoIntentExceptionMixin):  # these need to be tried every tick
+            self.report_failure_notification(exception.error_tag, exception.error_kwargs, work_intent.executor)
+
+    def get_tick_timestamp(self):
+        if self.task:
+            return self.task.execution_game_timestamp
+        return general.GameDate.now().game_timestamp
+
+    def get_tick_interval(self):
+        if self.task and self.task.execution_interval:
+            return self.task.execution_interval
+        return WorkProcess.SCHEDULER_RUNNING_INTERVAL
+
+    def check_crews_of_activities_in_steady_state(self, activities_in_steady_state):
+        """
+        Workers can stop working on the activity without any change of entities being observed,
+        so the crew of every activity in a steady state is compared with the one at the moment of entering it.
+        """
+        if not activities_in_steady_state:
+            return
+        workers_by_activity_id = collections.defaultdict(set)
+        steady_work_intents = db.session.query(models.Intent.target_id, models.Intent.executor_id) \
+            .filter(models.Intent.type == main.Intents.WORK) \
+            .filter(models.Intent.target_id.in_([activity.id for activity in activities_in_steady_state])).all()
+        for activity_id, worker_id in steady_work_intents:
+            workers_by_activity_id[activity_id].add(worker_id)
+
+        for activity in activities_in_steady_state:
+            if workers_by_activity_id[activity.id] != set(activity.steady_state["workers"]):
+                logger.info("Crew of %s has changed, it's no longer in a steady state", activity)
+                ActivitySteadyState.leave(activity, self.get_tick_timestamp())
+
     def process_activities_progress(self, activities_to_progress):
-        for activity, workers in activities_to_progress.items():
-            activity_progress = ActivityProgressProcess(activity, workers)
-            try:
-                db.session.begin_nested()
-                activity_progress.perform()
-                db.session.commit()
-            except main.GameException as exception:
-                logger.debug("GameException prevented ActivityProgress %s ", sys.exc_info())
-                db.session.rollback()  # add some user notification
-                for worker in workers:
-                    self.report_failure_notification(exception.error_tag, exception.error_kwargs, worker)
-            except:
-                logger.error("Unknown exception prevented ActivityProgress", exc_info=True)
-                raise
+        equipment_finder = PrefetchedEquipmentFinder(activities_to_progress)
+
+        def progress_activity(activity_and_workers):
+            activity, workers = activity_and_workers
+            activity_progress = ActivityProgressProcess(activity, workers, equipment_finder)
+            ticks_left, quality_sum, quality_ticks = activity.ticks_left, activity.quality_sum, activity.quality_ticks
+            activity_progress.perform()
+            if activity_progress.is_steady():
+                ActivitySteadyState.enter(activity, ticks_left - activity.ticks_left,
+                                          activity.quality_sum - quality_sum,
+                                          activity.quality_ticks - quality_ticks,
+                                          workers, activity_progress.get_dependency_ids(),
+                                          self.get_tick_timestamp(), self.get_tick_interval())
+
+        def handle_activity_failure(activity_and_workers, exception):
+            logger.debug("GameException prevented ActivityProgress %s ", exception)
+            activity, workers = activity_and_workers
+            for worker in workers:
+                self.report_failure_notification(exception.error_tag, exception.error_kwargs, worker)
+
+        self.perform_in_chunks(list(activities_to_progress.items()), progress_activity, handle_activity_failure)
 
     @classmethod
     def report_failure_notification(cls, error_tag, error_kwargs, worker):
-        failure_notification = models.Notification.query.filter_by(title_tag=error_tag, title_params=error_kwargs,
-                                                                   text_tag=error_tag, text_params=error_kwargs,
-                                                                   character=worker, player=None).first()
+        content_hash = models.Notification.get_content_hash(error_tag, error_kwargs, error_tag, error_kwargs)
+        failure_notification = cls.failure_notifications_of_tick.get((worker.id, content_hash))
+        # notification could have been created in a savepoint which was rolled back
+        if failure_notification is None or failure_notification not in db.session:
+            failure_notification = models.Notification.query.filter_by(character=worker, player=None,
+                                                                       content_hash=content_hash).first()
 
         if failure_notification:
             failure_notification.count += 1
             failure_notification.update_date()
         else:
             failure_notification = models.Notification(error_tag, error_kwargs, error_tag, error_kwargs,
-                                                       character=worker, player=None)
+                                                       character=worker, player=None, deduplicated=True)
             db.session.add(failure_notification)
             failure_notification.add_close_option()
+        cls.failure_notifications_of_tick[(worker.id, content_hash)] = failure_notification
         main.call_hook(main.Hooks.NEW_CHARACTER_NOTIFICATION, character=worker, notification=failure_notification)
 
     def process_travel_movement(self):
         entities_being_moved = db.session.query(models.Entity, models.EntityProperty) \
             .filter(models.EntityProperty.name == P.BEING_MOVED) \
             .filter(models.EntityProperty.entity_id == models.Entity.id).all()
-        if entities_being_moved:
-            entities, _ = zip(*entities_being_moved)
-        else:
-            entities = []
+        entities = [entity for entity, _ in entities_being_moved]
+        travel_targets_by_id = self.get_travel_targets_by_id(
+            [being_moved_property for _, being_moved_property in entities_being_moved])
 
-        # caching
-        # entity_ids = [entity.id for entity in entities]
-        # cached_union_members = models.EntityProperty.query.filter_by(name=P.MEMBER_OF_UNION) \
-        #     .filter(models.EntityProperty.entity_id.in_(entity_ids)).all()
+        any_terrain_group = models.EntityType.by_name(main.Types.ANY_TERRAIN)
+        any_terrain_types = models.get_concrete_types_for_groups([any_terrain_group])
 
         union_representatives = {}
         travel_credits_by_representative = {}
@@ -599,22 +696,37 @@ class WorkProcess(ProcessAction):
         targets_by_representative = {}
         allowed_terrains_by_representative = {}
 
-        # when in union then one entity becomes union's representative, otherwise it's its own representative
-        self.select_representatives_for_entities(entities, mobile_entities_count_by_representative,
-                                                 travel_credits_by_representative, union_representatives)
-
-        for entity in entities:
-            self.calculate_movement_contribution_from_entities(entity, mobile_entities_count_by_representative,
-                                                               travel_credits_by_representative, union_representatives,
-                                                               targets_by_representative,
-                                                               allowed_terrains_by_representative)
-
+        # properties of all the moving entities are loaded at once instead of being queried for every entity
+        with models.prefetched_properties(entities):
+            # when in union then one entity becomes union's representative, otherwise it's its own representative
+            self.select_representatives_for_entities(entities, mobile_entities_count_by_representative,
+                                                     travel_credits_by_representative, union_representatives)
+
+            for entity, being_moved_property in entities_being_moved:
+                self.calculate_movement_contribution_from_entities(entity, being_moved_property,
+                                                                   mobile_entities_count_by_representative,
+                                                                   travel_credits_by_representative,
+                                                                   union_representatives, targets_by_representative,
+                                                                   allowed_terrains_by_representative,
+                                                                   travel_targets_by_id, any_terrain_types)
+
+        new_positions_by_root_location = {}
         for representative in travel_credits_by_representative.keys():
             self.move_entity_based_on_movement_contributions(representative,
                                                              mobile_entities_count_by_representative[representative],
                                                              travel_credits_by_representative[representative],
                                                              targets_by_representative[representative],
-                                                             allowed_terrains_by_representative[representative])
+                                                             allowed_terrains_by_representative[representative],
+                                                             new_positions_by_root_location)
+        move_root_locations(new_positions_by_root_location)
+
+    @staticmethod
+    def get_travel_targets_by_id(being_moved_properties):
+        target_ids = {being_moved_property.data.get("target") for being_moved_property in being_moved_properties}
+        target_ids.discard(None)
+        if not target_ids:
+            return {}
+        return {target.id: target for target in models.Location.query.filter(models.Location.id.in_(target_ids))}
 
     def select_representatives_for_entities(self, entities, number_of_mobile_entities,
                                             travel_credits_in_union_by_entity, union_representatives):
@@ -622,14 +734,16 @@ class WorkProcess(ProcessAction):
             entity_member_of_union_property = properties.OptionalMemberOfUnionProperty(entity)
             union_id = entity_member_of_union_property.get_union_id()
             if union_id not in union_representatives:
-                travel_credits_in_union_by_entity[entity] = Point(0, 0)
+                travel_credits_in_union_by_entity[entity] = [0, 0]
                 number_of_mobile_entities[entity] = 0
                 if union_id is not None:
                     union_representatives[union_id] = entity
 
-    def calculate_movement_contribution_from_entities(self, entity, mobile_entities_count_by_representative,
+    def calculate_movement_contribution_from_entities(self, entity, being_moved_property,
+                                                      mobile_entities_count_by_representative,
                                                       travel_credits_by_representative, union_representatives,
-                                                      targets_by_representative, allowed_terrains_by_representative):
+                                                      targets_by_representative, allowed_terrains_by_representative,
+                                                      travel_targets_by_id, any_terrain_types):
         has_mobile_prop = entity.has_property(P.MOBILE)
         if has_mobile_prop:
             entity_mobile_property = properties.MobileProperty(entity)
@@ -640,33 +754,36 @@ class WorkProcess(ProcessAction):
             entity_member_of_union_property = properties.OptionalMemberOfUnionProperty(entity)
             union_id = entity_member_of_union_property.get_union_id()
             representative = self.get_representative(entity, union_id, union_representatives)
-            orig_point = travel_credits_by_representative[representative]
-            travel_credits_by_representative[representative] = Point(orig_point.x + vector_x,
-                                                                     orig_point.y + vector_y)
+            travel_credits_by_representative[representative][0] += vector_x
+            travel_credits_by_representative[representative][1] += vector_y
             if representative not in targets_by_representative:
                 targets_by_representative[representative] = []
-            if entity_being_moved_property.get_target():  # random of two targets is selected
-                targets_by_representative[representative] += [entity_being_moved_property.get_target()]
+            target_id = entity_being_moved_property.get_target_id()
+            if target_id in travel_targets_by_id:  # random of two targets is selected
+                targets_by_representative[representative] += [travel_targets_by_id[target_id]]
             if representative not in allowed_terrains_by_representative:
-                any_terrain_group = models.EntityType.by_name(main.Types.ANY_TERRAIN)
-                allowed_terrains_by_representative[representative] = models.get_concrete_types_for_groups(
-                    [any_terrain_group])
+                allowed_terrains_by_representative[representative] = any_terrain_types
             if entity_being_moved_property.get_terrain_types():
                 allowed_terrains_by_representative[representative] = self.get_intersection_of_concrete_types(
                     allowed_terrains_by_representative[representative],
                     models.get_concrete_types_for_groups(entity_being_moved_property.get_terrain_types()))
             mobile_entities_count_by_representative[representative] += 1
 
-            rho, phi = util.cart_to_pol(Point(vector_x, vector_y))
-            entity_being_moved_property.remove()
+            # only the inertia is left for the next tick, the property is modified directly,
+            # because it's already prefetched and can't be recreated by OptionalBeingMovedProperty
+            rho, phi = math.hypot(vector_x, vector_y), math.atan2(vector_y, vector_x)
             if rho >= 0.01:
-                entity_being_moved_property.set_inertia(rho, phi)
+                being_moved_property.data = {"inertia": [rho, phi]}
+            else:
+                being_moved_property.data = {}
+                db.session.delete(being_moved_property)
 
     def move_entity_based_on_movement_contributions(self, representative, mobile_entities_in_union_count,
-                                                    travel_credits_in_union, travel_targets, allowed_terrains):
-        travel_credits, direction = util.cart_to_pol(
-            Point(travel_credits_in_union.x / mobile_entities_in_union_count,
-                  travel_credits_in_union.y / mobile_entities_in_union_count))
+                                                    travel_credits_in_union, travel_targets, allowed_terrains,
+                                                    new_positions_by_root_location):
+        travel_credits_x, travel_credits_y = travel_credits_in_union
+        travel_credits = math.hypot(travel_credits_x, travel_credits_y) / mobile_entities_in_union_count
+        direction = math.atan2(travel_credits_y, travel_credits_x)
         max_potential_distance = travel_credits * general.TraversabilityBasedRange.MAX_RANGE_MULTIPLIER
         rng = general.TraversabilityBasedRange(travel_credits, allowed_terrain_types=allowed_terrains)
         initial_pos = representative.get_position()
@@ -678,7 +795,7 @@ class WorkProcess(ProcessAction):
                 destination_pos, representative, initial_pos, travel_targets[0]):
             return
         else:
-            move_entity_to_position(representative, direction, destination_pos)
+            move_entity_to_position(representative, direction, destination_pos, new_positions_by_root_location)
 
     def move_to_destination_if_close_enough(self, destination_pos, entity, initial_pos, travel_target):
         goal_point = travel_target.get_position()
@@ -693,12 +810,12 @@ class WorkProcess(ProcessAction):
 
     def calculate_movement_contribution_of_entity(self, entity_mobile_property, entity_being_moved_property):
         inertiality = entity_mobile_property.get_inertiality()
-        movement_direction, movement_speed = entity_being_moved_property.get_movement()
-        inertia_direction, inertia_speed = entity_being_moved_property.get_inertia()
-        movement_vector = util.pol_to_cart(movement_direction, movement_speed)
-        inertia_vector = util.pol_to_cart(inertia_direction, inertia_speed)
-        vector_x = movement_vector.x * (1 - inertiality) + inertia_vector.x * inertiality
-        vector_y = movement_vector.y * (1 - inertiality) + inertia_vector.y * inertiality
+        movement_speed, movement_direction = entity_being_moved_property.get_movement()
+        inertia_speed, inertia_direction = entity_being_moved_property.get_inertia()
+        vector_x = movement_speed * math.cos(movement_direction) * (1 - inertiality) \
+            + inertia_speed * math.cos(inertia_direction) * inertiality
+        vector_y = movement_speed * math.sin(movement_direction) * (1 - inertiality) \
+            + inertia_speed * math.sin(inertia_direction) * inertiality
         return vector_x, vector_y
 
     def get_representative(self, entity, union_id, union_representatives):
@@ -719,22 +836,27 @@ def _get_union_members_or_itself(entity):
         return [entity]
 
 
-def move_entity_to_position(entity, direction, target_position):
+def move_entity_to_position(entity, direction, target_position, new_positions_by_root_location=None):
+    """
+    Moves the entity to the target position. If it's alone in its RootLocation, then the RootLocation is moved.
+    :param new_positions_by_root_location: optional dict which collects (position, direction) of RootLocations
+    which should be moved, so they can all be moved at once by `move_root_locations`.
+    Otherwise the RootLocation is moved immediately.
+    """
     if isinstance(entity, models.RootLocation):
         raise ValueError("One shall not move a sole RootLocation {}".format(entity))
     old_root = entity.get_root()
 
     if old_root.position != target_position:
-        root_location = models.RootLocation.query.filter_by(position=target_position.wkt).first()
+        root_location = get_root_location_at_position(target_position, new_positions_by_root_location)
         if not root_location:
             union_members = _get_union_members_or_itself(entity)
             if old_root.is_empty(excluding=union_members):
                 # there's nothing else, so we can move this RootLocation
-                old_root.position = target_position
-                old_root.direction = direction
-
-                # remove to avoid situations like moving a city with observed name
-                models.ObservedName.query.filter_by(target=old_root).delete()
+                if new_positions_by_root_location is not None:
+                    new_positions_by_root_location[old_root] = (target_position, direction)
+                else:
+                    move_root_locations({old_root: (target_position, direction)})
             else:
                 root_location = models.RootLocation(target_position, direction)
                 db.session.add(root_location)
@@ -745,6 +867,62 @@ def move_entity_to_position(entity, direction, target_position):
                      target_position)
 
 
+def get_root_location_at_position(position, new_positions_by_root_location=None):
+    """
+    Returns RootLocation which is at the position after all the pending moves are applied.
+    :param new_positions_by_root_location: dict of RootLocation -> (new position, new direction) of pending moves
+    """
+    if not new_positions_by_root_location:
+        return models.RootLocation.query.filter_by(position=position.wkt).first()
+
+    moved_root_location = next((root_location for root_location, (new_position, _)
+                                in new_positions_by_root_location.items() if new_position == position), None)
+    if moved_root_location:
+        return moved_root_location
+    # RootLocations which are going to be moved away are no longer at their position
+    moved_root_location_ids = [root_location.id for root_location in new_positions_by_root_location.keys()
+                               if root_location.id is not None]
+    return models.RootLocation.query.filter_by(position=position.wkt) \
+        .filter(~models.RootLocation.id.in_(moved_root_location_ids)).first()
+
+
+def move_root_locations(new_positions_by_root_location):
+    """
+    Moves all the specified RootLocations using a single UPDATE statement.
+    Observed names of these RootLocations are removed.
+    :param new_positions_by_root_location: dict of RootLocation -> (new position, new direction)
+    """
+    if not new_positions_by_root_location:
+        return
+    db.session.flush()  # so all the RootLocations are persisted
+    root_locations_table = models.RootLocation.__table__
+    db.session.execute(root_locations_table.update()
+                       .where(root_locations_table.c.id == sql.bindparam("root_location_id"))
+                       .values(_position=sql.bindparam("new_position", type_=root_locations_table.c._position.type),
+                               direction=sql.bindparam("new_direction")),
+                       [{"root_location_id": root_location.id,
+                         "new_position": from_shape(models.RootLocation.wrap_position(position)),
+                         "new_direction": direction % 360}
+                        for root_location, (position, direction) in new_positions_by_root_location.items()])
+
+    root_location_ids = models.ids(new_positions_by_root_location.keys())
+    # remove to avoid situations like moving a city with observed name
+    models.ObservedName.query.filter(models.ObservedName.target_id.in_(root_location_ids)) \
+        .delete(synchronize_session="fetch")
+    models.ObservedNamesCache.clear()
+    for root_location in new_positions_by_root_location.keys():
+        db.session.expire(root_location, ["_position", "direction"])
+
+
+def expire_loaded_entities(entity_class, attributes):
+    """
+    Expires the attributes of all entities of the class which are present in the session,
+    so the values changed by a bulk UPDATE are loaded again when they are accessed.
+    """
+    for entity in [obj for obj in db.session.identity_map.values() if isinstance(obj, entity_class)]:
+        db.session.expire(entity, attributes)
+
+
 class FightInCombatAction(Action):
     @convert(executor=models.Entity, combat_entity=models.Combat)
     def __init__(self, executor, combat_entity, side, stance):
@@ -752,10 +930,12 @@ class FightInCombatAction(Action):
         self.combat_entity = combat_entity
         self.side = side
         self.stance = stance
+        self.combat_round = None  # set by CombatProcess to share ranges between all fighters
 
     def perform_action(self):
-        foe_combat_actions = combat.get_combat_actions_of_visible_foes(self.executor, self.combat_entity)
-        combat_action_of_target = combat.get_hit_target(self, foe_combat_actions)
+        foe_combat_actions = combat.get_combat_actions_of_visible_foes(self.executor, self.combat_entity,
+                                                                       self.combat_round)
+        combat_action_of_target = combat.get_hit_target(self, foe_combat_actions, self.combat_round)
 
         if combat_action_of_target:
             self.execute_hit(combat_action_of_target)
@@ -773,9 +953,11 @@ class FightInCombatAction(Action):
         self.combat_entity.set_recorded_damage(damaged_foe,
                                                self.combat_entity.get_recorded_damage(damaged_foe) + hit_damage)
 
-        general.EventCreator.base(main.Events.HIT_TARGET_IN_COMBAT, rng=general.VisibilityBasedRange(10), params={},
-                                  doer=self.executor,
-                                  target=targets_combat_action.executor)
+        if self.combat_round:
+            self.combat_round.record_hit(self.executor, targets_combat_action.executor)
+        else:
+            general.EventCreator.base(main.Events.HIT_TARGET_IN_COMBAT, rng=general.VisibilityBasedRange(10),
+                                      params={}, doer=self.executor, target=targets_combat_action.executor)
 
     def calculate_hit_damage(self, targets_combat_action):
         hit_damage = 0.1  # trololo hit damage formula
@@ -790,7 +972,11 @@ class FightInCombatAction(Action):
                                                                     executor=self.executor).first()
         if auxiliary_action_to_perform:
             logger.debug("Performing auxiliary combat action: %s", auxiliary_action_to_perform)
-            auxiliary_action_to_perform.perform()
+            deferred.call(auxiliary_action_to_perform.serialized_action).perform()
+            db.session.delete(auxiliary_action_to_perform)
+            if self.combat_round:
+                # auxiliary action could have changed own combat action, e.g. its stance
+                self.combat_round.refresh_combat_action(self.executor)
 
 
 class WorkOnActivityAction(Action):
@@ -876,16 +1062,136 @@ class TravelToEntityAction(ActionOnEntity):
                     direction_to_destination, target_entity_root.position)
 
 
+class EquipmentFinder:
+    """
+    Finds tools and machines needed to work on activities. Every call queries the database.
+    """
+
+    def get_group(self, type_name):
+        return models.EntityType.by_name(type_name)
+
+    def get_type_eff_pairs(self, group):
+        return group.get_descending_types()
+
+    def get_tools(self, worker, allowed_types):
+        return general.ItemQueryHelper.query_all_types_in(allowed_types, worker).all()
+
+    def get_machines_around(self, entity, allowed_types):
+        return ActivityProgress.get_all_machines_around_entity(allowed_types, entity)
+
+    def get_machines_near(self, entity, allowed_types):
+        return general.ItemQueryHelper.query_all_types_near(allowed_types, entity).all()
+
+
+class PrefetchedEquipmentFinder(EquipmentFinder):
+    """
+    Finds tools and machines for all activities progressed in a single tick.
+    Every type group is expanded only once and all tools, mandatory machines and optional machines
+    which can be useful for any of the activities are retrieved with a single query each.
+    """
+
+    def __init__(self, activities_to_progress):
+        self._groups = {}
+        self._type_eff_pairs = {}
+
+        tool_type_names, mandatory_machine_type_names, optional_machine_type_names = set(), set(), set()
+        all_workers, all_entities_worked_on = set(), set()
+        for activity, workers in activities_to_progress.items():
+            req = activity.requirements
+            tool_groups = list(req.get("mandatory_tools", [])) + list(req.get("optional_tools", {}))
+            if tool_groups:
+                tool_type_names.update(self._get_concrete_type_names(tool_groups))
+                all_workers.update(workers)
+            if "mandatory_machines" in req:
+                mandatory_machine_type_names.update(self._get_concrete_type_names(req["mandatory_machines"]))
+                all_entities_worked_on.add(activity.being_in)
+            if "optional_machines" in req:
+                optional_machine_type_names.update(self._get_concrete_type_names(req["optional_machines"]))
+                all_entities_worked_on.add(activity.being_in)
+
+        self._tools_by_parent_id = self._get_items_by_parent_id(tool_type_names, list(all_workers))
+
+        parent_locations = set()
+        for entity in all_entities_worked_on:
+            parent_locations.update(entity.parent_locations())
+        self._machines_by_parent_id = self._get_items_by_parent_id(mandatory_machine_type_names,
+                                                                   list(parent_locations))
+
+        # optional machines can be in the entity worked on or in the entities inside of it
+        self._children_by_parent_id = collections.defaultdict(list)
+        places_for_optional_machines = list(all_entities_worked_on)
+        if optional_machine_type_names and all_entities_worked_on:
+            for child in models.Entity.query.filter(models.Entity.is_in(list(all_entities_worked_on))).all():
+                self._children_by_parent_id[child.parent_entity_id].append(child)
+                places_for_optional_machines.append(child)
+        self._optional_machines_by_parent_id = self._get_items_by_parent_id(optional_machine_type_names,
+                                                                            places_for_optional_machines)
+
+    def _get_concrete_type_names(self, group_names):
+        type_names = set()
+        for group_name in group_names:
+            group = self.get_group(group_name)
+            if group:
+                type_names.update(entity_type.name for entity_type, eff in self.get_type_eff_pairs(group))
+        return type_names
+
+    @staticmethod
+    def _get_items_by_parent_id(type_names, parents):
+        items_by_parent_id = collections.defaultdict(list)
+        if type_names and parents:
+            for item in models.Item.query.filter(models.Item.type_name.in_(type_names),
+                                                 models.Item.is_in(parents)).all():
+                items_by_parent_id[item.parent_entity_id].append(item)
+        return items_by_parent_id
+
+    @staticmethod
+    def _select(items, parent, allowed_types):
+        # previous activities of the same tick could have moved or removed some of the prefetched items
+        return [item for item in items if item.type in allowed_types and item.being_in == parent
+                and not sql.inspect(item).deleted and not sql.inspect(item).was_deleted]
+
+    def get_group(self, type_name):
+        if type_name not in self._groups:
+            self._groups[type_name] = super().get_group(type_name)
+        return self._groups[type_name]
+
+    def get_type_eff_pairs(self, group):
+        if group.name not in self._type_eff_pairs:
+            self._type_eff_pairs[group.name] = super().get_type_eff_pairs(group)
+        return self._type_eff_pairs[group.name]
+
+    def get_tools(self, worker, allowed_types):
+        return self._select(self._tools_by_parent_id[worker.id], worker, allowed_types)
+
+    def get_machines_around(self, entity, allowed_types):
+        # parent entity is considered a primary machine regardless of its relative quality
+        if entity.type in allowed_types:
+            return [entity]
+
+        machines = []
+        for location in entity.parent_locations():
+            machines += self._select(self._machines_by_parent_id[location.id], location, allowed_types)
+        return machines
+
+    def get_machines_near(self, entity, allowed_types):
+        machines = self._select(self._optional_machines_by_parent_id[entity.id], entity, allowed_types)
+        for child in self._children_by_parent_id[entity.id]:
+            machines += self._select(self._optional_machines_by_parent_id[child.id], child, allowed_types)
+        return machines
+
+
 class ActivityProgressProcess(AbstractAction):
     DEFAULT_PROGRESS = 5.0
 
-    def __init__(self, activity, workers):
+    def __init__(self, activity, workers, equipment_finder=None):
         self.activity = activity
         self.workers = workers
+        self.equipment_finder = equipment_finder if equipment_finder else EquipmentFinder()
         self.entity_worked_on = self.activity.being_in
         self.tool_based_quality = []
         self.machine_based_quality = []
         self.progress_ratio = 0.0
+        self.active_workers = []
 
     def perform_action(self):
         logger.info("progress of %s", self.activity)
@@ -897,12 +1203,12 @@ class ActivityProgressProcess(AbstractAction):
         if "mandatory_machines" in req:
             logger.info("checking mandatory_machines")
             ActivityProgress.check_mandatory_machines(req["mandatory_machines"],
-                                                      self.entity_worked_on, activity_params)
+                                                      self.entity_worked_on, activity_params, self.equipment_finder)
 
         if "optional_machines" in req:
             logger.info("checking optional_machines")
             ActivityProgress.check_optional_machines(req["optional_machines"],
-                                                     self.entity_worked_on, activity_params)
+                                                     self.entity_worked_on, activity_params, self.equipment_finder)
 
         if "targets" in req:
             logger.info("checking targets")
@@ -936,17 +1242,18 @@ class ActivityProgressProcess(AbstractAction):
         if "machine_based_quality" in activity_params:
             self.machine_based_quality = activity_params["machine_based_quality"]
 
-        active_workers = []
         for worker in self.workers:
             try:
                 worker_impact = {}
                 ActivityProgress.check_worker_proximity(self.activity, worker)
 
                 if "mandatory_tools" in req:
-                    ActivityProgress.check_mandatory_tools(worker, req["mandatory_tools"], worker_impact)
+                    ActivityProgress.check_mandatory_tools(worker, req["mandatory_tools"], worker_impact,
+                                                           self.equipment_finder)
 
                 if "optional_tools" in req:
-                    ActivityProgress.check_optional_tools(worker, req["optional_tools"], worker_impact)
+                    ActivityProgress.check_optional_tools(worker, req["optional_tools"], worker_impact,
+                                                          self.equipment_finder)
 
                 if "skills" in req:
                     ActivityProgress.check_skills(worker, req["skills"], worker_impact)
@@ -957,16 +1264,16 @@ class ActivityProgressProcess(AbstractAction):
                     self.progress_ratio += worker_impact["progress_ratio"]
 
                 self.progress_ratio += ActivityProgressProcess.DEFAULT_PROGRESS
-                active_workers.append(worker)
+                self.active_workers.append(worker)
             except main.GameException as exception:
                 # report the notification to worker
                 WorkProcess.report_failure_notification(exception.error_tag, exception.error_kwargs, worker)
 
         if "max_workers" in req:
-            ActivityProgress.check_min_workers(active_workers, req["min_workers"])
+            ActivityProgress.check_min_workers(self.active_workers, req["min_workers"])
 
         if "min_workers" in req:
-            ActivityProgress.check_max_workers(active_workers, req["max_workers"])
+            ActivityProgress.check_max_workers(self.active_workers, req["max_workers"])
 
         if len(self.tool_based_quality):
             self.activity.quality_sum += mean(self.tool_based_quality)
@@ -993,6 +1300,263 @@ class ActivityProgressProcess(AbstractAction):
         if self.activity.ticks_left <= 0:
             ActivityProgress.finish_activity(self.activity)
 
+    def is_steady(self):
+        """
+        :return: True if the activity made progress with all the workers and is going to make the same progress
+        until any of its dependencies changes
+        """
+        if self.activity.ticks_left <= 0 or sql.inspect(self.activity).deleted:
+            return False
+        return self.progress_ratio > 0 and len(self.active_workers) == len(self.workers)
+
+    def get_dependency_ids(self):
+        """
+        :return: ids of entities whose change can affect the progress of the activity: the workers (with
+        tools in their inventories), the entity worked on and everything it is in, the locations around,
+        the entities inside of it (when optional machines are used) and the targets of the activity
+        """
+        dependencies = [self.activity] + list(self.workers) + self.entity_worked_on.parent_locations()
+        entity = self.entity_worked_on
+        while entity:
+            dependencies.append(entity)
+            entity = entity.being_in
+
+        req = self.activity.requirements
+        if "optional_machines" in req:
+            dependencies += models.Entity.query.filter(models.Entity.is_in(self.entity_worked_on)).all()
+        return [entity.id for entity in dependencies] + list(req.get("targets", []))
+
+
+class ActivitySteadyState:
+    """
+    Activity is in a steady state when it's worked on by the same crew with the same tools and machines
+    in unchanged surroundings, so every run of WorkProcess would bring exactly the same progress and quality.
+    Such activity is skipped by WorkProcess and a single ActivityCompletionProcess is scheduled for the moment
+    it's going to be finished. Any change of the entities it depends on brings it back to the regular progress.
+    """
+
+    # e.g. states of characters change all the time, but they don't affect work
+    RELEVANT_ENTITY_ATTRIBUTES = ["parent_entity", "role", "type_name", "quality", "amount"]
+
+    @classmethod
+    def enter(cls, activity, progress, quality_sum, quality_ticks, workers, dependency_ids, timestamp, interval):
+        """
+        :param interval: number of game seconds between the subsequent runs of WorkProcess
+        """
+        ticks_to_finish = math.ceil(activity.ticks_left / progress)
+        completion_task = models.ScheduledTask(deferred.serialize(ActivityCompletionProcess(activity, None)),
+                                               timestamp + ticks_to_finish * interval)
+        db.session.add(completion_task)
+
+        activity.steady_state_dependencies = sorted(set(dependency_ids))
+        db.session.flush()
+        # changes made until now can't invalidate the state which is just being entered
+        _get_pending_changes(db.session).register_entering(activity.id)
+        activity.steady_state = {
+            "since": timestamp,
+            "interval": interval,
+            "ticks_to_finish": ticks_to_finish,
+            "progress": progress,
+            "quality_sum": quality_sum,
+            "quality_ticks": quality_ticks,
+            "workers": [worker.id for worker in workers],
+            "completion_task_id": completion_task.id,
+        }
+        logger.info("%s is in a steady state, it'll be finished in %s ticks", activity, ticks_to_finish)
+
+    @classmethod
+    def leave(cls, activity, timestamp=None, remove_completion_task=True):
+        """
+        Applies the progress of all the ticks since entering the steady state and turns back to the regular progress
+        :param activity: activity in a steady state
+        :param timestamp: game timestamp of the moment of leaving the steady state, the current one if not specified
+        :param remove_completion_task: False if the completion task is the one that's currently run
+        """
+        if timestamp is None:
+            timestamp = general.GameDate.now().game_timestamp
+        state = activity.steady_state
+        ticks_elapsed = (timestamp - state["since"]) // state.get("interval", WorkProcess.SCHEDULER_RUNNING_INTERVAL)
+        ticks_elapsed = max(0, min(ticks_elapsed, state["ticks_to_finish"]))
+
+        activity.ticks_left -= ticks_elapsed * state["progress"]
+        activity.quality_sum += ticks_elapsed * state["quality_sum"]
+        activity.quality_ticks += ticks_elapsed * state["quality_ticks"]
+
+        if remove_completion_task:
+            models.ScheduledTask.query.filter_by(id=state["completion_task_id"]).delete()
+        activity.steady_state = None
+        activity.steady_state_dependencies = None
+
+    @staticmethod
+    def is_in_steady_state(activity):
+        return activity.steady_state_dependencies is not None
+
+    @staticmethod
+    def mark_entities_changed(entity_ids):
+        """
+        Registers the change of entities which was made without the session noticing it, e.g. by a bulk update.
+        """
+        _get_pending_changes(db.session).register_changes(entity_ids)
+
+    @staticmethod
+    def leave_for_changed_dependencies():
+        """
+        Brings all the activities whose dependencies have changed in the current transaction back to
+        the regular progress. It's run automatically just before the outermost transaction is committed.
+        """
+        db.session.flush()
+        pending_changes = _get_pending_changes(db.session)
+        if pending_changes.orphaned_completion_task_ids:
+            models.ScheduledTask.query.filter(
+                models.ScheduledTask.id.in_(pending_changes.orphaned_completion_task_ids)) \
+                .delete(synchronize_session=False)
+
+        changed_entity_ids = list(pending_changes.changes_by_entity_id.keys())
+        if changed_entity_ids:
+            dependent_activities = models.Activity.query.filter(
+                models.Activity.steady_state_dependencies.overlap(changed_entity_ids)).all()
+            for activity in dependent_activities:
+                if pending_changes.has_dependency_changed(activity):
+                    logger.info("Dependencies of %s have changed, it's no longer in a steady state", activity)
+                    ActivitySteadyState.leave(activity)
+        pending_changes.clear()
+
+    @staticmethod
+    def get_entities_affected_by_change(obj, created_or_deleted):
+        if isinstance(obj, models.Activity):
+            activity_state = sql.inspect(obj)
+            # progress applied when entering or leaving the steady state is not a change
+            if activity_state.attrs.ticks_left.history.has_changes() \
+                    and not activity_state.attrs.steady_state_dependencies.history.has_changes():
+                return [obj]
+            return []
+        if isinstance(obj, models.Entity):
+            entity_state = sql.inspect(obj)
+            if created_or_deleted or any(entity_state.attrs[attr].history.has_changes()
+                                         for attr in ActivitySteadyState.RELEVANT_ENTITY_ATTRIBUTES
+                                         if attr in entity_state.attrs):
+                old_and_new_parents = itertools.chain(*entity_state.attrs.parent_entity.history)
+                return [obj, obj.parent_entity] + list(old_and_new_parents)
+            return []
+        if isinstance(obj, models.EntityProperty):
+            return [obj.entity]
+        if isinstance(obj, models.Intent):
+            return [obj.executor, obj.target]
+        return []
+
+
+class ActivityCompletionProcess(ProcessAction):
+    """
+    Scheduled for the moment when an activity in a steady state is going to be finished.
+    """
+
+    @convert(activity=models.Activity)
+    def __init__(self, activity, task):
+        super().__init__(task)
+        self.activity = activity
+
+    def perform_action(self):
+        if not self.activity or not ActivitySteadyState.is_in_steady_state(self.activity):
+            return
+
+        timestamp = self.task.execution_game_timestamp if self.task else None
+        ActivitySteadyState.leave(self.activity, timestamp, remove_completion_task=False)
+        if self.activity.ticks_left <= 0:
+            ActivityProgress.finish_activity(self.activity)
+
+
+class PendingSteadyStateChanges:
+    """
+    Changes of entities made in the current transaction which can affect activities in a steady state.
+    Every change gets a sequence number, so an activity entering the steady state in the middle of the transaction
+    is not affected by the changes made before that moment. It's kept in `session.info`, so it's never shared
+    between sessions, and it's restored to the state from the beginning of a savepoint when it's rolled back.
+    """
+
+    def __init__(self):
+        self.sequence_number = 0
+        self.changes_by_entity_id = {}
+        self.entering_by_activity_id = {}
+        self.orphaned_completion_task_ids = set()
+        self.snapshots_by_savepoint = weakref.WeakKeyDictionary()
+
+    def register_changes(self, entity_ids):
+        self.sequence_number += 1
+        for entity_id in entity_ids:
+            self.changes_by_entity_id[entity_id] = self.sequence_number
+
+    def register_entering(self, activity_id):
+        self.sequence_number += 1
+        self.entering_by_activity_id[activity_id] = self.sequence_number
+
+    def has_dependency_changed(self, activity):
+        entered_at = self.entering_by_activity_id.get(activity.id, 0)
+        return any(self.changes_by_entity_id.get(entity_id, 0) > entered_at
+                   for entity_id in activity.steady_state_dependencies)
+
+    def take_snapshot(self, savepoint):
+        self.snapshots_by_savepoint[savepoint] = (dict(self.changes_by_entity_id),
+                                                  dict(self.entering_by_activity_id),
+                                                  set(self.orphaned_completion_task_ids))
+
+    def restore_snapshot(self, savepoint):
+        if savepoint in self.snapshots_by_savepoint:
+            self.changes_by_entity_id, self.entering_by_activity_id, self.orphaned_completion_task_ids = \
+                self.snapshots_by_savepoint.pop(savepoint)
+
+    def clear(self):
+        self.changes_by_entity_id.clear()
+        self.entering_by_activity_id.clear()
+        self.orphaned_completion_task_ids.clear()
+
+
+def _get_pending_changes(session):
+    return session.info.setdefault("pending_steady_state_changes", PendingSteadyStateChanges())
+
+
+@sql.event.listens_for(SignallingSession, "before_flush")
+def collect_changed_entities_before_flush(session, flush_context, instances):
+    pending_changes = _get_pending_changes(session)
+    for obj in session.deleted:
+        if isinstance(obj, models.Activity) and ActivitySteadyState.is_in_steady_state(obj):
+            pending_changes.orphaned_completion_task_ids.add(obj.steady_state["completion_task_id"])
+
+    affected_entities = []
+    for obj in itertools.chain(session.new, session.deleted):
+        affected_entities += ActivitySteadyState.get_entities_affected_by_change(obj, True)
+    for obj in session.dirty:
+        if session.is_modified(obj):
+            affected_entities += ActivitySteadyState.get_entities_affected_by_change(obj, False)
+    # entities which are just being created can't be dependencies of any activity
+    changed_entity_ids = {entity.id for entity in affected_entities if entity is not None and entity.id is not None}
+    if changed_entity_ids:
+        pending_changes.register_changes(changed_entity_ids)
+
+
+@sql.event.listens_for(SignallingSession, "before_commit")
+def update_steady_state_of_activities_before_commit(session):
+    # committing a savepoint doesn't make the changes final, so it's done only for the outermost transaction
+    if session.transaction.parent is None:
+        ActivitySteadyState.leave_for_changed_dependencies()
+
+
+@sql.event.listens_for(SignallingSession, "after_transaction_create")
+def take_snapshot_of_changed_entities_on_savepoint(session, transaction):
+    if transaction.nested:
+        _get_pending_changes(session).take_snapshot(transaction)
+
+
+@sql.event.listens_for(SignallingSession, "after_soft_rollback")
+def restore_changed_entities_after_rollback(session, previous_transaction):
+    if previous_transaction.nested:
+        _get_pending_changes(session).restore_snapshot(previous_transaction)
+
+
+@sql.event.listens_for(SignallingSession, "after_transaction_end")
+def clear_changed_entities_after_transaction_end(session, transaction):
+    if transaction.parent is None:
+        _get_pending_changes(session).clear()
+
 
 class ActivityProgress:
     @classmethod
@@ -1009,14 +1573,15 @@ class ActivityProgress:
                 raise main.NoInputMaterialException(item_type=models.EntityType.by_name(name))
 
     @classmethod
-    def check_mandatory_tools(cls, worker, tools, worker_impact):
+    def check_mandatory_tools(cls, worker, tools, worker_impact, equipment_finder=None):
+        equipment_finder = equipment_finder if equipment_finder else EquipmentFinder()
         worker_impact["tool_based_quality"] = []
         for tool_type_name in tools:
-            group = models.EntityType.by_name(tool_type_name)
-            type_eff_pairs = group.get_descending_types()
+            group = equipment_finder.get_group(tool_type_name)
+            type_eff_pairs = equipment_finder.get_type_eff_pairs(group)
             allowed_types = [pair[0] for pair in type_eff_pairs]
 
-            tools = general.ItemQueryHelper.query_all_types_in(allowed_types, worker).all()
+            tools = equipment_finder.get_tools(worker, allowed_types)
             if not tools:
                 raise main.NoToolForActivityException(tool_name=group.name)
 
@@ -1026,14 +1591,15 @@ class ActivityProgress:
             worker_impact["tool_based_quality"] += [tool_best_relative_quality]
 
     @classmethod
-    def check_optional_tools(cls, worker, tools_progress_bonus, worker_impact):
+    def check_optional_tools(cls, worker, tools_progress_bonus, worker_impact, equipment_finder=None):
+        equipment_finder = equipment_finder if equipment_finder else EquipmentFinder()
         worker_impact["progress_ratio"] = 0.0
         for tool_type_name in tools_progress_bonus:
-            group = models.EntityType.by_name(tool_type_name)
-            type_eff_pairs = group.get_descending_types()
+            group = equipment_finder.get_group(tool_type_name)
+            type_eff_pairs = equipment_finder.get_type_eff_pairs(group)
             allowed_types = [pair[0] for pair in type_eff_pairs]
 
-            tools = general.ItemQueryHelper.query_all_types_in(allowed_types, worker).all()
+            tools = equipment_finder.get_tools(worker, allowed_types)
             if not tools:
                 continue
 
@@ -1052,13 +1618,14 @@ class ActivityProgress:
         return relative_quality(most_efficient_tool)
 
     @classmethod
-    def check_mandatory_machines(cls, machines, entity_having_activity, activity_params):
+    def check_mandatory_machines(cls, machines, entity_having_activity, activity_params, equipment_finder=None):
+        equipment_finder = equipment_finder if equipment_finder else EquipmentFinder()
         activity_params["machine_based_quality"] = []
         for machine_name in machines:
-            group = models.EntityType.by_name(machine_name)
-            type_eff_pairs = group.get_descending_types()
+            group = equipment_finder.get_group(machine_name)
+            type_eff_pairs = equipment_finder.get_type_eff_pairs(group)
             allowed_types = [pair[0] for pair in type_eff_pairs]
-            found_machines = cls.get_all_machines_around_entity(allowed_types, entity_having_activity)
+            found_machines = equipment_finder.get_machines_around(entity_having_activity, allowed_types)
             if not found_machines:
                 raise main.NoMachineForActivityException(machine_name=group.name)
 
@@ -1079,13 +1646,14 @@ class ActivityProgress:
                                         models.Item.is_in(parent_entity.parent_locations())).all()
 
     @classmethod
-    def check_optional_machines(cls, machine_progress_bonus, location, activity_params):
+    def check_optional_machines(cls, machine_progress_bonus, location, activity_params, equipment_finder=None):
+        equipment_finder = equipment_finder if equipment_finder else EquipmentFinder()
         for machine_type_name in machine_progress_bonus:
-            group = models.EntityType.by_name(machine_type_name)
-            type_eff_pairs = group.get_descending_types()
+            group = equipment_finder.get_group(machine_type_name)
+            type_eff_pairs = equipment_finder.get_type_eff_pairs(group)
             allowed_types = [pair[0] for pair in type_eff_pairs]
 
-            machines = general.ItemQueryHelper.query_all_types_near(allowed_types, location).all()
+            machines = equipment_finder.get_machines_near(location, allowed_types)
             if not machines:
                 continue
 
@@ -1195,39 +1763,72 @@ class EatingProcess(ProcessAction):
         return 1 + max(0, (sum(vals) / EatingProcess.FOOD_BASED_ATTR_MAX_POSSIBLE_INCREASE - 1) * 0.3)
 
     def perform_action(self):
-        characters = models.Character.query.all()
-
-        for character in characters:
-            character.states[main.States.HUNGER] += EatingProcess.HUNGER_INCREASE
-
-            eating_queue = character.eating_queue
-
-            hunger_attr_points = eating_queue.get(main.States.HUNGER)
-            if hunger_attr_points:
-                character.states[main.States.HUNGER] += max(hunger_attr_points, EatingProcess.HUNGER_MAX_DECREASE)
-                eating_queue[main.States.HUNGER] -= max(hunger_attr_points, EatingProcess.HUNGER_MAX_DECREASE)
-
-            attributes_to_increase = {}
-            for attribute in properties.EdibleProperty.FOOD_BASED_ATTR:
-                character.states[attribute] -= EatingProcess.FOOD_BASED_ATTR_DECAY
-
-                queue_attr_points = eating_queue.get(attribute, 0)
-                increase = min(queue_attr_points, EatingProcess.FOOD_BASED_ATTR_MAX_POSSIBLE_INCREASE)
-                attributes_to_increase[attribute] = increase
-                eating_queue[attribute] = eating_queue.get(attribute, 0) - increase
-
-            for attribute, increase in attributes_to_increase.items():
-                character.states[attribute] += increase * EatingProcess.bonus_mult(attributes_to_increase.values())
-            character.eating_queue = eating_queue
-
-        hungry_characters = models.Character.query \
-            .filter(models.Character.states[main.States.HUNGER].astext.cast(sql.Float) == 1.0).all()
-        for character in hungry_characters:
-            character.damage += EatingProcess.STARVATION_DAMAGE
-
-            character_modifiers = character.modifiers
-            starvation_visibility_time = general.GameDate.now() + EatingProcess.STARVATION_WOUND_TIMESPAN
-            character_modifiers[main.Modifiers.STARVATION] = starvation_visibility_time.game_timestamp
+        db.session.flush()  # states of all the characters are updated directly in the database
+
+        entities_table = models.Entity.__table__
+        characters_table = models.Character.__table__
+        states = entities_table.c.states
+        eating_queue = characters_table.c.eating_queue
+
+        def state_value(name):
+            return sql.func.coalesce(states[name].astext.cast(sql.Float), 0)
+
+        def queued_value(name):
+            return sql.func.coalesce(eating_queue[name].astext.cast(sql.Float), 0)
+
+        def clamp_0_1(value):
+            return sql.func.least(sql.func.greatest(value, 0), 1)
+
+        hunger_decrease = sql.func.greatest(queued_value(main.States.HUNGER), EatingProcess.HUNGER_MAX_DECREASE)
+        hunger = clamp_0_1(clamp_0_1(state_value(main.States.HUNGER) + EatingProcess.HUNGER_INCREASE)
+                           + hunger_decrease)
+
+        attribute_increases = collections.OrderedDict(
+            (attribute, sql.func.least(queued_value(attribute), EatingProcess.FOOD_BASED_ATTR_MAX_POSSIBLE_INCREASE))
+            for attribute in properties.EdibleProperty.FOOD_BASED_ATTR)
+        bonus_mult = 1 + sql.func.greatest(0, (sum(attribute_increases.values())
+                                               / EatingProcess.FOOD_BASED_ATTR_MAX_POSSIBLE_INCREASE - 1) * 0.3)
+
+        is_starving = hunger == 1.0
+        damage = sql.case([(is_starving, sql.func.to_jsonb(clamp_0_1(state_value(main.States.DAMAGE)
+                                                                     + EatingProcess.STARVATION_DAMAGE)))],
+                          else_=states[main.States.DAMAGE])
+
+        new_state_values = [main.States.HUNGER, hunger, main.States.DAMAGE, damage]
+        for attribute, increase in attribute_increases.items():
+            new_state_values += [attribute, state_value(attribute) - EatingProcess.FOOD_BASED_ATTR_DECAY
+                                 + increase * bonus_mult]
+        new_states = states.op("||")(sql.func.jsonb_build_object(*new_state_values))
+
+        starvation_visibility_time = general.GameDate.now() + EatingProcess.STARVATION_WOUND_TIMESPAN
+        new_states = sql.case([(is_starving, sql.func.jsonb_set(
+            new_states, "{{{},{}}}".format(main.States.MODIFIERS, main.Modifiers.STARVATION),
+            sql.func.to_jsonb(starvation_visibility_time.game_timestamp)))], else_=new_states)
+
+        # the old eating queue is used to calculate the states, so it must be updated afterwards
+        db.session.execute(entities_table.update()
+                           .where(entities_table.c.id == characters_table.c.id)
+                           .where(characters_table.c.type_name == main.Types.ALIVE_CHARACTER)
+                           .values(states=new_states))
+
+        new_queue_values = []
+        for attribute, increase in attribute_increases.items():
+            new_queue_values += [attribute, queued_value(attribute) - increase]
+        new_eating_queue = eating_queue.op("||")(sql.func.jsonb_build_object(*new_queue_values))
+        new_eating_queue = sql.case([(eating_queue.has_key(main.States.HUNGER), new_eating_queue.op("||")(
+            sql.func.jsonb_build_object(main.States.HUNGER, queued_value(main.States.HUNGER) - hunger_decrease)))],
+                                    else_=new_eating_queue)
+        db.session.execute(characters_table.update()
+                           .where(characters_table.c.type_name == main.Types.ALIVE_CHARACTER)
+                           .values(eating_queue=new_eating_queue))
+
+        expire_loaded_entities(models.Character, ["states", "eating_queue"])
+
+        characters_dead_of_starvation = models.Character.query \
+            .filter(models.Character.type_name == main.Types.ALIVE_CHARACTER) \
+            .filter(models.Character.states[main.States.DAMAGE].astext.cast(sql.Float) >= 1.0).all()
+        for character in characters_dead_of_starvation:
+            main.call_hook(main.Hooks.DAMAGE_EXCEEDED, entity=character)
 
 
 class DecayProcess(ProcessAction):
@@ -1245,20 +1846,59 @@ class DecayProcess(ProcessAction):
         self.decay_abandoned_activities()
 
     def degrade_items(self):
-        items_and_props = db.session.query(models.Item, models.EntityTypeProperty).join(models.ItemType).filter(
-            sql.and_(models.ItemType.name == models.EntityTypeProperty.type_name,  # ON clause
-                     models.Item.role == models.Item.ROLE_BEING_IN,
-                     models.EntityTypeProperty.name == P.DEGRADABLE)).all()  # handle all items
-        for item, degradable_prop in items_and_props:
-            item_lifetime = degradable_prop.data["lifetime"]
-            damage_fraction_to_add_since_last_tick = DecayProcess.SCHEDULER_RUNNING_INTERVAL / item_lifetime
-            item.damage += damage_fraction_to_add_since_last_tick
-
-            if item.damage == 1.0:
-                if item.type.stackable:
-                    self.decay_stackable_item(item)
-                else:
-                    self.crumble_item(item)
+        db.session.flush()  # degradation of items is started and stopped directly in the database
+        now = general.GameDate.now().game_timestamp
+        self.stop_degradation_of_items_not_being_in(now)
+        self.start_degradation_of_items(now)
+        expire_loaded_entities(models.Item, ["states", "damage_per_second", "damage_updated_at", "crumble_at"])
+
+        # damage is evaluated lazily, so only the items whose damage has reached the limit need to be changed
+        fully_damaged_items = models.Item.query.filter(models.Item.crumble_at <= now).all()
+        for item in fully_damaged_items:
+            if item.type.stackable:
+                item.damage = 1.0
+                self.decay_stackable_item(item)
+            else:
+                self.crumble_item(item)
+
+    def start_degradation_of_items(self, now):
+        items_table = models.Item.__table__
+        entities_table = models.Entity.__table__
+        type_properties_table = models.EntityTypeProperty.__table__
+
+        # the item is assumed to degrade since the previous run, so the first run increases its damage too
+        degradation_start = now - DecayProcess.SCHEDULER_RUNNING_INTERVAL
+        lifetime = type_properties_table.c.data["lifetime"].astext.cast(sql.Float)
+        stored_damage = sql.func.least(entities_table.c.states[main.States.DAMAGE].astext.cast(sql.Float), 1)
+        db.session.execute(items_table.update()
+                           .where(items_table.c.id == entities_table.c.id)
+                           .where(entities_table.c.role == models.Item.ROLE_BEING_IN)
+                           .where(items_table.c.damage_per_second.is_(None))
+                           .where(type_properties_table.c.type_name == items_table.c.type_name)
+                           .where(type_properties_table.c.name == P.DEGRADABLE)
+                           .values(damage_per_second=1.0 / lifetime,
+                                   damage_updated_at=degradation_start,
+                                   crumble_at=degradation_start + sql.func.ceil((1 - stored_damage) * lifetime)))
+
+    def stop_degradation_of_items_not_being_in(self, now):
+        items_table = models.Item.__table__
+        entities_table = models.Entity.__table__
+        states = entities_table.c.states
+
+        current_damage = sql.func.least(states[main.States.DAMAGE].astext.cast(sql.Float)
+                                        + (now - items_table.c.damage_updated_at) * items_table.c.damage_per_second, 1)
+        # damage must be stored before the degradation data is removed
+        db.session.execute(entities_table.update()
+                           .where(entities_table.c.id == items_table.c.id)
+                           .where(entities_table.c.role != models.Item.ROLE_BEING_IN)
+                           .where(items_table.c.damage_per_second.isnot(None))
+                           .values(states=sql.func.jsonb_set(states, "{{{}}}".format(main.States.DAMAGE),
+                                                             sql.func.to_jsonb(current_damage))))
+        db.session.execute(items_table.update()
+                           .where(items_table.c.id == entities_table.c.id)
+                           .where(entities_table.c.role != models.Item.ROLE_BEING_IN)
+                           .where(items_table.c.damage_per_second.isnot(None))
+                           .values(damage_per_second=None, damage_updated_at=None, crumble_at=None))
 
     def decay_stackable_item(self, item):
         runs_per_day = DecayProcess.SCHEDULER_RUNNING_INTERVAL / general.GameDate.SEC_IN_DAY
@@ -1270,33 +1910,47 @@ class DecayProcess(ProcessAction):
 
     def decay_progress_of_activities(self):
         # damage level for Activities is altered ONLY in WorkProcess
-        activities = models.Activity.query.filter(models.Activity.ticks_left < models.Activity.ticks_needed).all()
-        for activity in activities:  # decrease progress
-            activity.ticks_left += min(ActivityProgressProcess.DEFAULT_PROGRESS, activity.ticks_needed)
+        db.session.flush()  # progress of all the activities is decreased directly in the database
+        activities_table = models.Activity.__table__
+        progress_decrease = sql.func.least(ActivityProgressProcess.DEFAULT_PROGRESS, activities_table.c.ticks_needed)
+        decay_statement = activities_table.update() \
+            .where(activities_table.c.ticks_left < activities_table.c.ticks_needed) \
+            .values(ticks_left=activities_table.c.ticks_left + progress_decrease) \
+            .returning(activities_table.c.id, activities_table.c.steady_state_dependencies.isnot(None))
+        decayed_activities = db.session.execute(decay_statement).fetchall()
+        expire_loaded_entities(models.Activity, ["ticks_left"])
+
+        # change of progress is not noticed when flushing the session, so it's registered directly
+        ActivitySteadyState.mark_entities_changed([activity_id for activity_id, is_in_steady_state
+                                                   in decayed_activities if is_in_steady_state])
 
     def decay_abandoned_activities(self):
         # activities abandoned for a long time
-        activities = models.Activity.query.filter_by(damage=1.0) \
+        activities = models.Activity.query.filter(models.Activity.damage == 1.0) \
             .filter(models.Activity.ticks_left == models.Activity.ticks_needed).all()
-        for activity in activities:
-            items_and_props = db.session.query(models.Item, models.EntityTypeProperty).join(models.ItemType).filter(
-                sql.and_(models.ItemType.name == models.EntityTypeProperty.type_name,  # ON clause
-                         models.Item.is_used_for(activity),
-                         models.EntityTypeProperty.name == P.DEGRADABLE)).all()  # handle all normal stackables
-            for item, degradable_prop in items_and_props:
-                item_lifetime = degradable_prop.data["lifetime"]
-                damage_fraction_to_add_since_last_tick = DecayProcess.SCHEDULER_RUNNING_INTERVAL / item_lifetime
-                item.damage += damage_fraction_to_add_since_last_tick
-
-                if item.damage == 1.0:
-                    if item.type.stackable:
-                        previous_amount = item.amount
-                        self.decay_stackable_item(item)
-                        amount_to_be_removed = previous_amount - item.amount
-                        self.update_activity_requirements(activity, amount_to_be_removed, item)
-                    else:
-                        self.crumble_item(item)
-                        self.update_activity_requirements(activity, 1, item)
+        if not activities:
+            return
+        activities_by_id = {activity.id: activity for activity in activities}
+
+        items_and_props = db.session.query(models.Item, models.EntityTypeProperty).join(models.ItemType).filter(
+            sql.and_(models.ItemType.name == models.EntityTypeProperty.type_name,  # ON clause
+                     models.Item.is_used_for(activities),
+                     models.EntityTypeProperty.name == P.DEGRADABLE)).all()  # handle all normal stackables
+        for item, degradable_prop in items_and_props:
+            activity = activities_by_id[item.parent_entity_id]
+            item_lifetime = degradable_prop.data["lifetime"]
+            damage_fraction_to_add_since_last_tick = DecayProcess.SCHEDULER_RUNNING_INTERVAL / item_lifetime
+            item.damage += damage_fraction_to_add_since_last_tick
+
+            if item.damage == 1.0:
+                if item.type.stackable:
+                    previous_amount = item.amount
+                    self.decay_stackable_item(item)
+                    amount_to_be_removed = previous_amount - item.amount
+                    self.update_activity_requirements(activity, amount_to_be_removed, item)
+                else:
+                    self.crumble_item(item)
+                    self.update_activity_requirements(activity, 1, item)
 
     def update_activity_requirements(self, activity, amount_to_be_removed, item):
         input_req = activity.requirements.get("input", {})
@@ -1334,11 +1988,16 @@ class CombatProcess(ProcessAction):
     def perform_action(self):
 
         fighter_intents = self.combat_entity.fighters_intents()
+        # keeps the objects in the identity map until all the actions are deserialized
+        preloaded_objects = deferred.preload([intent.serialized_action for intent in fighter_intents])
+
+        fighter_combat_actions = [self.deserialized_action(intent) for intent in fighter_intents]
+        combat_round = combat.CombatRound(fighter_intents, fighter_combat_actions)
 
         all_potential_targets = set()  # participants who are or could have been a target of hit
         retreated_fighters_intents = set()
-        for fighter_intent in fighter_intents:
-            fighter_combat_action = self.deserialized_action(fighter_intent)
+        for fighter_intent, fighter_combat_action in zip(fighter_intents, fighter_combat_actions):
+            fighter_combat_action.combat_round = combat_round
             if self.combat_entity.is_able_to_fight(fighter_intent.executor):
                 target_action, potential_targets_actions = fighter_combat_action.perform()
             else:
@@ -1353,9 +2012,10 @@ class CombatProcess(ProcessAction):
 
             if fighter_combat_action.stance == combat.STANCE_RETREAT:
                 logger.debug("Try to retreat")
-                if self.try_to_retreat(fighter_intent):
+                if self.try_to_retreat(fighter_intent, combat_round):
                     logger.debug("Retreat successful")
                     retreated_fighters_intents.add(fighter_intent)
+                    combat_round.remove_fighter(fighter_intent.executor)
 
         logger.debug("All potential targets are: %s", all_potential_targets)
         active_fighter_intents = [intent for intent in fighter_intents
@@ -1365,11 +2025,14 @@ class CombatProcess(ProcessAction):
         fighter_intents_to_remove = [intent for intent in fighter_intents if intent not in active_fighter_intents]
 
         for intent_to_remove in fighter_intents_to_remove:  # participant not in range of any enemy
-            self.withdraw_from_combat(intent_to_remove)
+            self.withdraw_from_combat(intent_to_remove, combat_round)
+
+        combat_round.create_summary_event()
 
         fighters_able_to_fight = [intent for intent in active_fighter_intents if
                                   self.combat_entity.is_able_to_fight(intent.executor)]
-        number_of_combat_sides_participating = set([self.deserialized_action(i).side for i in fighters_able_to_fight])
+        number_of_combat_sides_participating = set([combat_round.get_combat_action(i.executor).side
+                                                    for i in fighters_able_to_fight])
         there_are_fighters_on_both_sides = len(number_of_combat_sides_participating) == 2
 
         if not there_are_fighters_on_both_sides:
@@ -1386,17 +2049,26 @@ class CombatProcess(ProcessAction):
                                   params={"entities": pyslatized_participants})
         self.task.stop_repeating()
 
-    def try_to_retreat(self, fighting_intent):
+    def try_to_retreat(self, fighting_intent, combat_round=None):
         if random.random() <= CombatProcess.RETREAT_CHANCE:
-            self.withdraw_from_combat(fighting_intent)
+            self.withdraw_from_combat(fighting_intent, combat_round, retreated=True)
             return True
         return False
 
-    def withdraw_from_combat(self, intent_to_remove):
+    def withdraw_from_combat(self, intent_to_remove, combat_round=None, retreated=False):
+        """
+        Removes the fighter from the combat. When a combat round is specified, the withdrawal is recorded
+        in the round's combat log instead of creating a separate event.
+        """
         logger.info("Fighter %s withdrew from combat", intent_to_remove.executor)
         db.session.delete(intent_to_remove)
-        general.EventCreator.base(main.Events.RETREAT_FROM_COMBAT, rng=general.VisibilityBasedRange(10), params={},
-                                  doer=intent_to_remove.executor)
+        if combat_round and retreated:
+            combat_round.record_retreat(intent_to_remove.executor)
+        elif combat_round:
+            combat_round.record_withdrawal(intent_to_remove.executor)
+        else:
+            general.EventCreator.base(main.Events.RETREAT_FROM_COMBAT, rng=general.VisibilityBasedRange(10),
+                                      params={}, doer=intent_to_remove.executor)
 
 
 #
@@ -1669,37 +2341,97 @@ class EatAction(ActionOnItem):
         main.call_hook(main.Hooks.EATEN, character=self.executor, item=self.item, amount=self.amount)
 
 
+class AnimalSurroundings:
+    """
+    Surroundings of all the animals having the same parent entity, so the animals in a herd share resource areas,
+    terrain, storages and food in the storages, which are retrieved from the database only once.
+    Food eaten by one of the animals is no longer available for the others, because they share the same objects.
+    """
+
+    def __init__(self, animal):
+        # the animal itself is not kept, because it can die before the others eat
+        self.center = AnimalSurroundings.get_group_key(animal)
+        self.parent_entity = animal.being_in
+        self._is_near_root_location = None
+        self._resource_areas = None
+        self._terrain_type_names = None
+        self._food_in_storages = None
+
+    @staticmethod
+    def get_group_key(animal):
+        # location-like animals can have own passages, so each of them has its own surroundings
+        if isinstance(animal, models.Location):
+            return animal
+        return animal.being_in
+
+    def is_near_root_location(self):
+        if self._is_near_root_location is None:
+            neighbouring_locations = general.NeighbouringLocationsRange(only_through_unlimited=True)
+            self._is_near_root_location = bool(neighbouring_locations.root_locations_near(self.center))
+        return self._is_near_root_location
+
+    def get_resource_areas(self):
+        if self._resource_areas is None:
+            self._resource_areas = models.ResourceArea.query \
+                .filter(models.ResourceArea.in_area(self.center.get_position())) \
+                .filter(models.ItemType.has_property(P.EDIBLE_BY_ANIMAL)).all()
+        return self._resource_areas
+
+    def get_terrain_type_names(self):
+        if self._terrain_type_names is None:
+            position = self.center.get_position()
+            self._terrain_type_names = {terrain.type_name for terrain in models.TerrainArea.query.filter(
+                models.TerrainArea.terrain.ST_Intersects(position.wkt)).all()}
+        return self._terrain_type_names
+
+    def get_food_in_storages(self):
+        """
+        :return: list of (storage, food) pairs, without the food which has already been eaten up
+        """
+        if self._food_in_storages is None:
+            storages = models.Item.query.filter(models.Item.is_in(self.parent_entity)) \
+                .filter(models.Item.has_property(P.STORAGE)).all()
+            foods_by_storage = collections.defaultdict(list)
+            if storages:
+                for food in models.Item.query.filter(models.Item.is_in(storages)) \
+                        .filter(models.Item.has_property(P.EDIBLE_BY_ANIMAL)).all():
+                    foods_by_storage[food.parent_entity].append(food)
+            self._food_in_storages = [(storage, food) for storage in storages for food in foods_by_storage[storage]]
+        return [(storage, food) for storage, food in self._food_in_storages
+                if food not in db.session.deleted and not sql.inspect(food).deleted]
+
+
 class AnimalEatingAction(Action):
     HUNGER_INCREASE = 0.1
     DAMAGE_WHEN_STARVING = 0.1
 
-    def __init__(self, executor):
+    def __init__(self, executor, shared_surroundings=None):
         super().__init__(executor)
+        self.shared_surroundings = shared_surroundings
+        self.surroundings = None
 
     def perform_action(self):
         animal_prop = self.executor.get_property(P.ANIMAL)
         if animal_prop is None:
             raise ValueError("{} is not an animal".format(self.executor))
 
+        self.surroundings = self.shared_surroundings if self.shared_surroundings \
+            else AnimalSurroundings(self.executor)
+
         self.executor.states[main.States.HUNGER] += AnimalEatingAction.HUNGER_INCREASE
 
-        neighbouring_locations = general.NeighbouringLocationsRange(only_through_unlimited=True)
-        any_root_location_near = neighbouring_locations.root_locations_near(self.executor)
-        if any_root_location_near:
+        if self.surroundings.is_near_root_location():
             self.eat_from_ground()
 
         if self.executor.states[main.States.HUNGER] > 0:  # need to eat more from storages
             self.try_to_eat_from_storages()
 
         if self.executor.states[main.States.HUNGER] >= 1.0:  # animal is starving
-            self.executor.states[main.States.DAMAGE] += AnimalEatingAction.DAMAGE_WHEN_STARVING
+            self.executor.damage += AnimalEatingAction.DAMAGE_WHEN_STARVING
 
     def eat_from_ground(self):
         logger.debug("Eat from the ground")
-        resource_areas = models.ResourceArea.query \
-            .filter(models.ResourceArea.in_area(self.executor.get_position())) \
-            .filter(models.ItemType.has_property(P.EDIBLE_BY_ANIMAL)).all()
-        for resource_area in resource_areas:  # eat from the ground
+        for resource_area in self.surroundings.get_resource_areas():  # eat from the ground
             logger.debug("Trying to eat from %s", resource_area)
             resource_type = resource_area.resource_type
             edible_by_animal_prop = resource_type.get_property(P.EDIBLE_BY_ANIMAL)
@@ -1719,18 +2451,10 @@ class AnimalEatingAction(Action):
 
     def try_to_eat_from_storages(self):
         logger.debug("Eat from the storages")
-        storages = models.Item.query.filter(models.Item.is_in(self.executor.being_in)) \
-            .filter(models.Item.has_property(P.STORAGE)).all()
-        for storage in storages:
-            foods_in_storage = models.Item.query \
-                .filter(models.Item.is_in(storage)) \
-                .filter(models.Item.has_property(P.EDIBLE_BY_ANIMAL)) \
-                .all()
-
-            for food in foods_in_storage:
-                if self.executor.states[main.States.HUNGER] > 0:
-                    logger.debug("Eating %s from %s", food, storage)
-                    self.try_to_eat_food_from_storage(food)
+        for storage, food in self.surroundings.get_food_in_storages():
+            if self.executor.states[main.States.HUNGER] > 0:
+                logger.debug("Eating %s from %s", food, storage)
+                self.try_to_eat_food_from_storage(food)
 
     def try_to_eat_food_from_storage(self, food):
         edible_by_animal_prop = food.get_property(P.EDIBLE_BY_ANIMAL)
@@ -1752,10 +2476,7 @@ class AnimalEatingAction(Action):
         if not terrain_types:
             return True
 
-        position = self.executor.get_position()
-        terrain = models.TerrainArea.query.filter(models.TerrainArea.terrain.ST_Intersects(position.wkt)) \
-            .filter(models.TerrainArea.type_name.in_(terrain_types)).first()
-        return terrain is not None
+        return not self.surroundings.get_terrain_type_names().isdisjoint(terrain_types)
 
 
 class AnimalStateProgressAction(Action):
@@ -1817,8 +2538,12 @@ class AnimalsProcess(ProcessAction):
                   + models.Location.query.filter(models.Location.has_property(P.DOMESTICATED)).all()
         # todo till #130 when it'll be possible to use Entity.has_property
 
+        surroundings_by_group = {}
         for animal in animals:
-            eat_food_action = AnimalEatingAction(animal)
+            group_key = AnimalSurroundings.get_group_key(animal)
+            if group_key not in surroundings_by_group:
+                surroundings_by_group[group_key] = AnimalSurroundings(animal)
+            eat_food_action = AnimalEatingAction(animal, surroundings_by_group[group_key])
             eat_food_action.perform()
 
             animal_state_progress_action = AnimalStateProgressAction(animal)
@@ -1998,6 +2723,7 @@ class JoinCombatAction(ActionOnEntity):
 
 
 class ChangeCombatStanceAction(ActionOnSelf):
+    @convert(executor=models.Character)
     def __init__(self, executor, new_stance):
         super().__init__(executor)
         self.new_stance = new_stance
@@ -1,3 +1,4 @@
+import collections
 import random
 
 from exeris.core import deferred, models, general, main, properties
@@ -11,11 +12,105 @@ STANCE_DEFENSIVE = "stance_defensive"
 STANCE_RETREAT = "stance_retreat"
 
 
-def get_combat_actions_of_visible_foes_and_allies(participant, combat_entity):
-    attackers, defenders = get_combat_actions_of_attackers_and_defenders(participant, combat_entity)
+class CombatRound:
+    """
+    Combat actions of all the fighters taking part in a single run of the combat process.
+    The actions are deserialized only once, and the visibility and melee reachability of every pair of fighters
+    are computed together at the start of the round, so they can be reused for targeting of each fighter.
+    Hits, retreats and withdrawals happening during the round are collected in a combat log,
+    which is shown as a summary event to everyone who can see any of the fighters.
+    Every observer gets only the entries whose doer they can see.
+    """
 
-    participant_combatable_property = properties.CombatableProperty(participant)
-    own_combat_action = participant_combatable_property.combat_action
+    def __init__(self, fighter_intents, combat_actions):
+        self.intent_by_executor = {intent.executor: intent for intent in fighter_intents}
+        self.combat_action_by_executor = {intent.executor: combat_action for intent, combat_action
+                                          in zip(fighter_intents, combat_actions)}
+
+        self.fighters = list(self.combat_action_by_executor.keys())
+        self.visibility_matrix = get_visibility_range().get_nearness_matrix(self.fighters)
+        self.melee_reachability_matrix = get_melee_range().get_nearness_matrix(self.fighters)
+
+        self.hits = []
+        self.retreats = []
+        self.withdrawals = []
+
+    def remove_fighter(self, fighter):
+        self.combat_action_by_executor.pop(fighter, None)
+
+    def refresh_combat_action(self, fighter):
+        """
+        Deserializes the combat action of the fighter again, so the changes made to its intent during the round
+        (e.g. a stance changed by an auxiliary action) are visible to the fighters acting later.
+        """
+        if fighter not in self.combat_action_by_executor:
+            return
+        combat_action = deferred.call(self.intent_by_executor[fighter].serialized_action)
+        combat_action.combat_round = self
+        self.combat_action_by_executor[fighter] = combat_action
+
+    def get_combat_action(self, fighter):
+        return self.combat_action_by_executor.get(fighter)
+
+    def get_combat_actions(self):
+        return list(self.combat_action_by_executor.values())
+
+    def is_visible(self, fighter, other_fighter):
+        return self.visibility_matrix.get((fighter, other_fighter), False)
+
+    def is_reachable_in_melee(self, fighter, other_fighter):
+        return self.melee_reachability_matrix.get((fighter, other_fighter), False)
+
+    def record_hit(self, fighter, target):
+        self.hits.append((fighter, {"doer": fighter.pyslatize(), "target": target.pyslatize()}))
+
+    def record_retreat(self, fighter):
+        self.retreats.append((fighter, fighter.pyslatize()))
+
+    def record_withdrawal(self, fighter):
+        self.withdrawals.append((fighter, fighter.pyslatize()))
+
+    def has_combat_log(self):
+        return bool(self.hits or self.retreats or self.withdrawals)
+
+    def create_summary_event(self):
+        if not self.has_combat_log():
+            return
+
+        doers = {doer for doer, entry in self.hits + self.retreats + self.withdrawals}
+        observers_by_doer = get_visibility_range().characters_near_each(doers)
+
+        # observers seeing the same doers get the same combat log, so they share a single event
+        observers_by_visible_doers = collections.defaultdict(list)
+        for observer in set().union(*observers_by_doer.values()):
+            visible_doers = frozenset(doer for doer in doers if observer in observers_by_doer[doer])
+            observers_by_visible_doers[visible_doers].append(observer)
+
+        for visible_doers, observers in observers_by_visible_doers.items():
+            def visible_entries(log):
+                return [entry for doer, entry in log if doer in visible_doers]
+
+            general.EventCreator.create_for_observers(main.PartialEvents.COMBAT_ROUND_SUMMARY,
+                                                      {"hits": visible_entries(self.hits),
+                                                       "retreats": visible_entries(self.retreats),
+                                                       "withdrawals": visible_entries(self.withdrawals)}, observers)
+
+
+def get_visibility_range():
+    return general.VisibilityBasedRange(10)
+
+
+def get_melee_range():
+    return general.TraversabilityBasedRange(50, allowed_terrain_types=[main.Types.LAND_TERRAIN])
+
+
+def get_combat_actions_of_visible_foes_and_allies(participant, combat_entity, combat_round=None):
+    attackers, defenders = get_combat_actions_of_attackers_and_defenders(participant, combat_entity, combat_round)
+
+    own_combat_action = combat_round.get_combat_action(participant) if combat_round else None
+    if not own_combat_action:
+        participant_combatable_property = properties.CombatableProperty(participant)
+        own_combat_action = participant_combatable_property.combat_action
     if own_combat_action.side == SIDE_ATTACKER:
         foes, allies = defenders, attackers
     else:
@@ -23,27 +118,32 @@ def get_combat_actions_of_visible_foes_and_allies(participant, combat_entity):
     return foes, allies
 
 
-def get_combat_actions_of_attackers_and_defenders(participant, combat_entity):
-    combatant_intents = models.Intent.query.filter_by(target=combat_entity).all()
-
-    combat_actions_of_both_sides = [deferred.call(intent.serialized_action) for intent in combatant_intents]
+def get_combat_actions_of_attackers_and_defenders(participant, combat_entity, combat_round=None):
+    if combat_round:
+        combat_actions_of_both_sides = combat_round.get_combat_actions()
+    else:
+        combatant_intents = models.Intent.query.filter_by(target=combat_entity).all()
+        combat_actions_of_both_sides = deferred.call_many([intent.serialized_action for intent in combatant_intents])
 
     attacker_combat_actions = [action for action in combat_actions_of_both_sides if
                                action.side == SIDE_ATTACKER]
     defender_combat_actions = [action for action in combat_actions_of_both_sides if
                                action.side == SIDE_DEFENDER]
 
-    combat_range = general.VisibilityBasedRange(10)
+    if combat_round:
+        is_visible = combat_round.is_visible
+    else:
+        is_visible = get_visibility_range().is_near
 
-    return (filter_visible_combatants(attacker_combat_actions, participant, combat_range),
-            filter_visible_combatants(defender_combat_actions, participant, combat_range))
+    return (filter_visible_combatants(attacker_combat_actions, participant, is_visible),
+            filter_visible_combatants(defender_combat_actions, participant, is_visible))
 
 
-def filter_visible_combatants(combat_actions, participant, combat_range):
-    return [combat for combat in combat_actions if combat_range.is_near(participant, combat.executor)]
+def filter_visible_combatants(combat_actions, participant, is_visible):
+    return [combat for combat in combat_actions if is_visible(participant, combat.executor)]
 
 
-def get_combat_actions_of_visible_foes(participant, combat_entity):
+def get_combat_actions_of_visible_foes(participant, combat_entity, combat_round=None):
     """
     Returns list of :class:`exeris.core.actions.FightInCombatAction` for fighters
     that can be a potential target of an attack by the `participant` (A). For each other participant (B) it means:
@@ -53,17 +153,19 @@ def get_combat_actions_of_visible_foes(participant, combat_entity):
     It can be interpreted as: "Each of listed participants can be attacked in some specific circumstances".
     :param participant: participant in proximity of whom combatants need to be
     :param combat_entity: entity of combat in which `participant` is
+    :param combat_round: optional :class:`CombatRound` with combat actions and ranges computed for the whole round
     :return: list of combat actions of all potential targets
     """
-    return get_combat_actions_of_visible_foes_and_allies(participant, combat_entity)[0]
+    return get_combat_actions_of_visible_foes_and_allies(participant, combat_entity, combat_round)[0]
 
 
-def get_hit_target(attacker_combat_action, foe_combat_actions):
+def get_hit_target(attacker_combat_action, foe_combat_actions, combat_round=None):
     """
     Returns a combat action for a fighter which is selected as target for the hit.
     It takes into the consideration
     :param attacker_combat_action: action of a fighter who needs a target to hit
     :param foe_combat_actions: list of combat actions of all potential targets being in visibility range
+    :param combat_round: optional :class:`CombatRound` with melee reachability computed for the whole round
     :return: hit target's combat action or None when nobody can be hit
     """
 
@@ -74,9 +176,12 @@ def get_hit_target(attacker_combat_action, foe_combat_actions):
         attacker = attacker_combat_action.executor
 
         # we can attack melee only traversably-accessible targets
-        range_to_fight_melee = general.TraversabilityBasedRange(50, allowed_terrain_types=[main.Types.LAND_TERRAIN])
+        if combat_round:
+            is_reachable_in_melee = combat_round.is_reachable_in_melee
+        else:
+            is_reachable_in_melee = get_melee_range().is_near
         foe_combat_actions = [foe_action for foe_action in foe_combat_actions if
-                              range_to_fight_melee.is_near(attacker, foe_action.executor)]
+                              is_reachable_in_melee(attacker, foe_action.executor)]
 
         # we are melee, so we can hit only melee foes, unless only ranged foes are there
         melee_fighters = [foe_action for foe_action in foe_combat_actions if not has_ranged_weapon(foe_action.executor)]
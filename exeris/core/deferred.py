@@ -1,21 +1,41 @@
+import collections
 import inspect
 
 import copy
 import project_root
+import sqlalchemy as sql
 import wrapt
 from exeris.core import main, models
 from exeris.core.main import db
 
 
+_imported_objects_by_name = {}
+_init_args_by_class = {}
+_qualified_names_by_class = {}
+_converted_argument_types_by_function = {}
+
+
 def object_import(name):
+    if name in _imported_objects_by_name:
+        return _imported_objects_by_name[name]
     parts = name.split('.')
     module = ".".join(parts[:-1])
     m = __import__(module)
     for comp in parts[1:]:
         m = getattr(m, comp)
+    _imported_objects_by_name[name] = m
     return m
 
 
+def get_init_args(cls):
+    """
+    :return: names of arguments of the constructor of the class (without 'self'), which are serialized
+    """
+    if cls not in _init_args_by_class:
+        _init_args_by_class[cls] = inspect.getfullargspec(cls.__init__).args[1:]
+    return _init_args_by_class[cls]
+
+
 def call(json_to_call, **injected_args):
     """
     Call the list which is the class-arguments pair.
@@ -35,6 +55,61 @@ def call(json_to_call, **injected_args):
     return func(**kwargs)
 
 
+def call_many(jsons_to_call, **injected_args):
+    """
+    Call all the lists which are class-arguments pairs. All entities referenced by the arguments are loaded
+    in advance with a single query for each model class.
+    :param jsons_to_call: list of lists being: [full path string to class, dict of arguments to call class' constructor]
+    :param injected_args: Additional args to add to every json args
+    :return: list of instances of classes specified in jsons
+    """
+    preloaded_objects = preload(jsons_to_call)  # keeps the objects in the identity map until all jsons are called
+    return [call(json_to_call, **injected_args) for json_to_call in jsons_to_call]
+
+
+def preload(jsons_to_call):
+    """
+    Loads all the objects referenced by arguments converted by the `convert` decorator
+    with a single query for each model class, so they are found in the session's identity map during deserialization.
+    :param jsons_to_call: list of lists being: [full path string to class, dict of arguments to call class' constructor]
+    :return: list of loaded objects. It needs to be kept as long as the jsons are being called,
+    because the identity map holds only weak references
+    """
+    ids_by_model = collections.defaultdict(set)
+    for json_to_call in jsons_to_call:
+        _collect_referenced_ids(json_to_call, ids_by_model)
+
+    loaded_objects = []
+    for model, ids in ids_by_model.items():
+        primary_key = sql.inspect(model).primary_key[0]
+        loaded_objects += model.query.filter(primary_key.in_(ids)).all()
+    return loaded_objects
+
+
+def _collect_referenced_ids(json_to_call, ids_by_model):
+    from exeris.core import actions
+    argument_types = get_converted_argument_types(object_import(json_to_call[0]))
+    for arg_name, arg_value in json_to_call[1].items():
+        arg_type = argument_types.get(arg_name)
+        if arg_type is None:
+            continue
+        if issubclass(arg_type, db.Model) and type(arg_value) in (int, str):
+            ids_by_model[arg_type].add(arg_value)
+        elif issubclass(arg_type, actions.AbstractAction) and isinstance(arg_value, list):
+            _collect_referenced_ids(arg_value, ids_by_model)
+
+
+def get_converted_argument_types(cls):
+    """
+    :return: dict of argument types specified by the `convert` decorator of the class' constructor
+    """
+    for klass in getattr(cls, "__mro__", []):
+        if "__init__" in klass.__dict__:
+            init = klass.__dict__["__init__"]
+            return _converted_argument_types_by_function.get(getattr(init, "__wrapped__", init), {})
+    return {}
+
+
 def get_qualified_class_name(cls):
     class_module = inspect.getfile(cls)
     path_in_project = project_root.relative_to_project_root(class_module)
@@ -44,25 +119,22 @@ def get_qualified_class_name(cls):
 
 
 def get_qualified_name(obj):
-    def remove_last_part(text):
-        return "/".join(text.split("/")[:-1])
+    if obj.__class__ in _qualified_names_by_class:
+        return _qualified_names_by_class[obj.__class__]
 
     class_module_path = inspect.getmodule(obj).__file__
     path_in_project = project_root.relative_to_project_root(class_module_path)
     module_path = path_in_project.replace("/", ".").strip(".").replace(".py", "")
     full_qualified_name = module_path + "." + obj.__class__.__qualname__
+    _qualified_names_by_class[obj.__class__] = full_qualified_name
     return full_qualified_name
 
 
 def serialize(obj):
     full_qualified_name = get_qualified_name(obj)
 
-    inspected_init_args = inspect.getfullargspec(obj.__class__.__init__).args
-
-    inspected_init_args.pop(0)  # remove 'self'
-
     args_to_serialize = {}
-    for arg_name in inspected_init_args:
+    for arg_name in get_init_args(obj.__class__):
         arg_value_to_serialize = getattr(obj, arg_name)
 
         from exeris.core import actions
@@ -79,6 +151,92 @@ def serialize(obj):
     return [full_qualified_name, args_to_serialize]
 
 
+def get_state(obj):
+    """
+    Returns a lightweight representation of the values of all serialized arguments of the object.
+    Entities and nested actions are compared by identity, so it's much cheaper than `serialize`.
+    Two states of the same object are equal if the object's serialized form hasn't changed.
+    """
+    from exeris.core import actions
+    state = []
+    for arg_name in get_init_args(obj.__class__):
+        value = getattr(obj, arg_name)
+        if isinstance(value, (models.Entity, models.EntityType)):
+            value = id(value)
+        elif isinstance(value, actions.AbstractAction):
+            value = (id(value), get_state(value))
+        else:
+            value = copy.deepcopy(value)
+        state.append(value)
+    return state
+
+
+def _are_all_entities_attached(obj):
+    from exeris.core import actions
+    for arg_name in get_init_args(obj.__class__):
+        value = getattr(obj, arg_name)
+        if isinstance(value, (models.Entity, models.EntityType)) and value not in db.session:
+            return False
+        if isinstance(value, actions.AbstractAction) and not _are_all_entities_attached(value):
+            return False
+    return True
+
+
+class DeserializedActionsCache:
+    """
+    Keeps actions deserialized from intents between the runs of a process.
+    An intent whose serialized action hasn't changed since the last run reuses the same action object.
+    It's also able to tell whether the action was changed and needs to be serialized again.
+    """
+
+    def __init__(self):
+        self._entries_by_intent_id = {}
+
+    def get_action(self, intent):
+        if self._is_cached(intent):
+            return self._entries_by_intent_id[intent.id][1]
+        action = call(intent.serialized_action)
+        self._entries_by_intent_id[intent.id] = (copy.deepcopy(intent.serialized_action), action, get_state(action))
+        return action
+
+    def preload(self, intents):
+        """
+        Loads all the entities needed to deserialize actions of intents which are not in the cache.
+        :return: list of loaded objects, which needs to be kept as long as the actions are being deserialized
+        """
+        return preload([intent.serialized_action for intent in intents if not self._is_cached(intent)])
+
+    def _is_cached(self, intent):
+        entry = self._entries_by_intent_id.get(intent.id)
+        return entry and entry[0] == intent.serialized_action and _are_all_entities_attached(entry[1])
+
+    def is_changed(self, intent, action):
+        entry = self._entries_by_intent_id.get(intent.id)
+        return not entry or entry[1] is not action or entry[2] != get_state(action)
+
+    def update(self, intent, action):
+        """
+        Serializes the action into the intent if the action has changed since it was deserialized
+        """
+        if self.is_changed(intent, action):
+            intent.serialized_action = serialize(action)
+            self._entries_by_intent_id[intent.id] = (copy.deepcopy(intent.serialized_action), action,
+                                                     get_state(action))
+
+    def discard(self, intent):
+        """
+        Should be called when the action could have been changed in a way not reflected in the database,
+        e.g. when its changes were rolled back
+        """
+        self._entries_by_intent_id.pop(intent.id, None)
+
+    def retain_only(self, intents):
+        intent_ids = {intent.id for intent in intents}
+        for intent_id in list(self._entries_by_intent_id):
+            if intent_id not in intent_ids:
+                del self._entries_by_intent_id[intent_id]
+
+
 def convert(**argument_types):
     @wrapt.decorator
     def wrapper(wrapped, instance, args, kwargs):
@@ -101,7 +259,11 @@ def convert(**argument_types):
 
         return wrapped(*args, **converted_args)
 
-    return wrapper
+    def register_and_wrap(wrapped):
+        _converted_argument_types_by_function[wrapped] = argument_types
+        return wrapper(wrapped)
+
+    return register_and_wrap
 
 
 def perform_or_turn_into_intent(executor, action, priority=1):
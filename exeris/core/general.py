@@ -15,6 +15,7 @@ from shapely.geometry import LineString, MultiLineString, Point, Polygon
 
 from exeris.core import models, main, util, map_data
 from exeris.core.main import db
+from flask_sqlalchemy import SignallingSession
 
 logger = logging.getLogger(__name__)
 
@@ -39,6 +40,9 @@ class GameDate:
     SEC_IN_DAY = SEC_IN_HOUR * HOUR_IN_DAY
     SEC_IN_MOON = SEC_IN_DAY * DAY_IN_MOON
 
+    # key in `session.info` under which the last checkpoint is stored
+    CHECKPOINT_INFO_KEY = "game_date_checkpoint"
+
     def __init__(self, game_timestamp):
         self.game_timestamp = game_timestamp
         self.second, game_timestamp = self.__get_modulo_and_divided(game_timestamp, GameDate.SEC_IN_MIN)
@@ -69,15 +73,25 @@ class GameDate:
 
     @staticmethod
     def now():
-        last_date_point = models.GameDateCheckpoint.query.one()
+        game_timestamp_base, real_timestamp_base = GameDate._get_checkpoint()
         now_timestamp = GameDate._get_timestamp()
 
-        real_timestamp_base = last_date_point.real_date
-        game_timestamp_base = last_date_point.game_date
-
         real_time_difference = int(now_timestamp) - real_timestamp_base
         return GameDate(game_timestamp_base + real_time_difference)  # 1 sec in game = 1 rl sec
 
+    @staticmethod
+    def _get_checkpoint():
+        """
+        Returns (game timestamp, real timestamp) of the last checkpoint. It's loaded only once per transaction,
+        because the current date is needed e.g. for the damage of every degradable item.
+        """
+        checkpoint = db.session.info.get(GameDate.CHECKPOINT_INFO_KEY)
+        if checkpoint is None:
+            last_date_point = models.GameDateCheckpoint.query.one()
+            checkpoint = (last_date_point.game_date, last_date_point.real_date)
+            db.session.info[GameDate.CHECKPOINT_INFO_KEY] = checkpoint
+        return checkpoint
+
     @staticmethod
     def _get_timestamp():
         return time.time()
@@ -99,6 +113,19 @@ class GameDate:
         return self + other
 
 
+@sql.event.listens_for(models.GameDateCheckpoint, "after_insert")
+@sql.event.listens_for(models.GameDateCheckpoint, "after_update")
+@sql.event.listens_for(models.GameDateCheckpoint, "after_delete")
+def forget_game_date_checkpoint_after_change(mapper, connection, checkpoint):
+    sql.orm.object_session(checkpoint).info.pop(GameDate.CHECKPOINT_INFO_KEY, None)
+
+
+@sql.event.listens_for(SignallingSession, "after_transaction_end")
+def forget_game_date_checkpoint_after_transaction_end(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(GameDate.CHECKPOINT_INFO_KEY, None)
+
+
 class RangeSpec:
     def characters_near(self, entity):
         locs = []
@@ -112,6 +139,24 @@ class RangeSpec:
             locs += self.locations_near(loc)
         return models.Item.query.filter(models.Item.is_in(locs)).all()
 
+    def characters_near_each(self, entities):
+        """
+        Returns a dict of sets of characters near each of the entities, using a single query for characters.
+        Locations near are found only once for each distinct location of the entities.
+        """
+        locations_near_by_location = {loc: set(self.locations_near(loc))
+                                      for loc in {loc for entity in entities for loc in self._locationize(entity)}}
+        all_locs = set().union(*locations_near_by_location.values())
+        characters = models.Character.query.filter(models.Character.is_in(list(all_locs)),
+                                                   models.Character.is_alive).all()
+
+        characters_near_by_entity = {}
+        for entity in entities:
+            locs = set().union(*[locations_near_by_location[loc] for loc in self._locationize(entity)])
+            characters_near_by_entity[entity] = {character for character in characters
+                                                 if character.parent_entity in locs}
+        return characters_near_by_entity
+
     def root_locations_near(self, entity):
         locs = []
         for loc in self._locationize(entity):
@@ -136,6 +181,39 @@ class RangeSpec:
             logger.debug("Exception when checking is_near(%s, %s): %s", entity_a, entity_b, e)
             return False
 
+    def get_nearness_matrix(self, entities):
+        """
+        Checks `is_near` for every ordered pair of the entities at once.
+        Locations near are found only once for each distinct location of the entities,
+        so many entities being in the same location share a single range computation.
+        :param entities: list of entities
+        :return: dict {(entity_a, entity_b): True if entity_a has access to entity_b}
+        """
+        locations_by_entity = {}
+        for entity in entities:
+            try:
+                locations_by_entity[entity] = self._locationize(entity)
+            except Exception as e:
+                logger.debug("Exception when locationizing %s: %s", entity, e)
+                locations_by_entity[entity] = []
+
+        locations_near_by_location = {}
+        nearness_matrix = {}
+        for entity_a in entities:
+            locations_near_a = []
+            try:
+                location_a = locations_by_entity[entity_a][0]
+                if location_a not in locations_near_by_location:
+                    locations_near_by_location[location_a] = self.locations_near(location_a)
+                locations_near_a = locations_near_by_location[location_a]
+            except Exception as e:
+                logger.debug("Exception when finding locations near %s: %s", entity_a, e)
+
+            for entity_b in entities:
+                nearness_matrix[(entity_a, entity_b)] = any(b in locations_near_a
+                                                            for b in locations_by_entity[entity_b])
+        return nearness_matrix
+
     def _locationize(self, entity):
         """
         Gets entity's location or returns itself if entity is a location
@@ -635,6 +713,21 @@ class EventCreator:
             for obs in event_obs:
                 main.call_hook(main.Hooks.NEW_EVENT, event_observer=obs)
 
+    @classmethod
+    def create_for_observers(cls, tag_observer, params, observers):
+        """
+        Creates a single event of type `tag_observer` seen by every character in `observers`.
+        It's useful when the set of observers is already known, e.g. it was computed for many doers at once.
+        """
+        event_for_observers = models.Event(tag_observer, params)
+        db.session.add(event_for_observers)
+
+        event_obs = [models.EventObserver(event_for_observers, char) for char in observers]
+        db.session.add_all(event_obs)
+
+        for obs in event_obs:
+            main.call_hook(main.Hooks.NEW_EVENT, event_observer=obs)
+
     @classmethod
     def can_receive_action(cls, entity):
         return entity and isinstance(entity, models.Character) and models.Character.is_alive
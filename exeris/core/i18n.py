@@ -3,10 +3,74 @@ import json
 import os
 
 import collections
+import logging
+import threading
+import time
+
 from pyslate.pyslate import Pyslate
 
 from exeris.core import main, models, general
 
+logger = logging.getLogger(__name__)
+
+
+class MissingTagsRecorder:
+    """
+    Collects missing translation tags in memory and periodically writes them to missing_tags.json
+    in a background thread, so a missing tag doesn't result in file I/O during every render.
+    """
+    FILE_PATH = os.path.join(os.path.dirname(__file__), "../missing_tags.json")
+    FLUSH_INTERVAL = 10  # in seconds
+
+    _pending_tags = {}
+    _lock = threading.Lock()
+    _flusher = None
+
+    @classmethod
+    def record(cls, key, params):
+        def turn_into_string(text):
+            if isinstance(params[text], dict):
+                return "{}[{}]".format(text, ",".join(params[text].keys()))
+            return text
+
+        with cls._lock:
+            cls._pending_tags[key] = {
+                "en": ",".join([turn_into_string(x) for x in params.keys()])}
+            cls._start_flusher()
+
+    @classmethod
+    def flush(cls):
+        with cls._lock:
+            tags_to_write, cls._pending_tags = cls._pending_tags, {}
+        if not tags_to_write:
+            return
+
+        try:
+            with open(cls.FILE_PATH, 'a+') as f:
+                f.seek(0)
+                try:
+                    old_data = json.loads(f.read())
+                except ValueError:
+                    old_data = {}
+                old_data.update(tags_to_write)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(old_data, indent=4))
+        except OSError:
+            logger.exception("Unable to write missing tags to %s", cls.FILE_PATH)
+
+    @classmethod
+    def _start_flusher(cls):
+        if cls._flusher is None:
+            cls._flusher = threading.Thread(target=cls._run_flusher, daemon=True)
+            cls._flusher.start()
+
+    @classmethod
+    def _run_flusher(cls):
+        while True:
+            time.sleep(cls.FLUSH_INTERVAL)
+            cls.flush()
+
 
 def create_pyslate(language, backend=None, character=None, **kwargs):
     # converters for custom info
@@ -40,24 +104,7 @@ def create_pyslate(language, backend=None, character=None, **kwargs):
         return g
 
     def on_missing_tag_key(key, params):
-        file_path = os.path.join(os.path.dirname(__file__), "../missing_tags.json")
-        with open(file_path, 'r+') as f:
-            try:
-                old_data = json.loads(f.read())
-            except ValueError:
-                old_data = {}
-            f.seek(0)
-
-            def turn_into_string(text):
-                if isinstance(params[text], dict):
-                    return "{}[{}]".format(text, ",".join(params[text].keys()))
-                return text
-
-            old_data[key] = {
-                "en": ",".join([turn_into_string(x) for x in params.keys()])}
-            f.write(json.dumps(old_data, indent=4))
-            f.truncate()
-
+        MissingTagsRecorder.record(key, params)
         return "[MISSING TAG {}]".format(key)
 
     def get_the_most_trusted(trusted_dict):
@@ -73,6 +120,7 @@ def create_pyslate(language, backend=None, character=None, **kwargs):
 
     if character:  # add character-specific data if character is specified
         kwargs["context"] = dict(kwargs.get("context", {}), observer=character, obs_gen=character.sex)
+        models.ObservedNamesCache.load_names_known_by([character])  # all names are likely to be rendered
 
     pyslate = Pyslate(language, backend=backend, on_missing_tag_key_callback=on_missing_tag_key, **kwargs)
 
@@ -215,9 +263,9 @@ def create_pyslate(language, backend=None, character=None, **kwargs):
         if "observer" in params and "location_id" in params:
             observer = params["observer"]
             location_id = params["location_id"]
-            observed_name = models.ObservedName.query.filter_by(observer=observer, target_id=location_id).first()
+            observed_name = models.ObservedNamesCache.get_name(observer.id, location_id)
             if observed_name:
-                return observed_name.name
+                return observed_name
 
         title_text = ""
         if "location_title" in params:
@@ -267,9 +315,9 @@ def create_pyslate(language, backend=None, character=None, **kwargs):
             observer = params["observer"]
             character_id = params["character_id"]
 
-            observed_name = models.ObservedName.query.filter_by(observer=observer, target_id=character_id).first()
+            observed_name = models.ObservedNamesCache.get_name(observer.id, character_id)
             if observed_name:
-                visible_name = helper.translation("tp_character_title", title=observed_name.name)
+                visible_name = helper.translation("tp_character_title", title=observed_name)
         elif "character_title" in params:
             visible_name = helper.translation("tp_character_title", title=params["character_title"])
 
@@ -374,4 +422,25 @@ def create_pyslate(language, backend=None, character=None, **kwargs):
 
     pyslate.register_function("list_of_entities", func_list_of_entities)
 
+    def func_combat_log(helper, tag_name, params):
+        observer_id = params["observer"].id if "observer" in params else None
+
+        def is_observer(pyslatized_entity):
+            return observer_id is not None \
+                   and pyslatized_entity.get(pyslatized_entity["entity_type"] + "_id") == observer_id
+
+        def get_perspective_suffix(groups):  # participants see their own part of the log in the first person
+            for role in ["doer", "target"]:
+                if role in groups and is_observer(groups[role]):
+                    return "_" + role
+            return ""
+
+        log_entries = [("tp_combat_log_hit", hit) for hit in params["hits"]]
+        log_entries += [("tp_combat_log_retreat", {"doer": fighter}) for fighter in params["retreats"]]
+        log_entries += [("tp_combat_log_withdrawal", {"doer": fighter}) for fighter in params["withdrawals"]]
+        return " ".join(helper.translation(log_tag + get_perspective_suffix(groups), groups=groups)
+                        for log_tag, groups in log_entries)
+
+    pyslate.register_function("combat_log", func_combat_log)
+
     return pyslate
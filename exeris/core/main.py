@@ -124,6 +124,7 @@ class PartialEvents:
     TAKE_ITEM_FROM_OTHER_LOCATION_OBSERVER = "event_take_item_from_other_location_observer"
     TAKE_ITEM_FROM_STORAGE_FROM_OTHER_LOCATION_OBSERVER = "event_take_item_from_storage_from_other_location_observer"
     BOARDING_SHIP_OBSERVER = "event_boarding_ship_observer"
+    COMBAT_ROUND_SUMMARY = "event_combat_round_summary"
 
 
 class Hooks:
@@ -136,6 +137,7 @@ class Hooks:
     NEW_CHARACTER_NOTIFICATION = "new_character_notification"
     NEW_PLAYER_NOTIFICATION = "new_player_notification"
     ENTITY_CONTENTS_COUNT_DECREASED = "entity_contents_count_decreased"
+    ENTITIES_MOVED = "entities_moved"  # entities moved in bulk, without changes visible in the session
     DAMAGE_EXCEEDED = "damage_exceeded"
 
 
@@ -188,30 +190,76 @@ def create_app(database=db, own_config_file_path=""):
     return app
 
 
-def _cipher():
+def _cipher(character_id=None):
+    if character_id is None and hasattr(g, "character"):
+        character_id = g.character.id
+
+    # key schedule is expensive, so ciphers are cached for the duration of the request
+    cipher_key = (app.config['SECRET_KEY'], character_id)
+    ciphers = g.setdefault("_ciphers", {})
+    if cipher_key not in ciphers:
+        ciphers[cipher_key] = _create_cipher(*cipher_key)
+    return ciphers[cipher_key]
+
+
+def _create_cipher(secret_key, character_id):
     h = hashlib.sha256()
-    h.update(app.config['SECRET_KEY'].encode())
+    h.update(secret_key.encode())
 
-    if hasattr(g, "character"):
-        h.update(g.character.id.to_bytes(8, 'big'))
+    if character_id is not None:
+        h.update(character_id.to_bytes(8, 'big'))
     else:
         h.update(b'NO CHAR ID')
     return AES.new(h.digest(), AES.MODE_ECB)
 
 
 _encode_token = b'f' * 8
+_block_size = 16
 
 
-def encode(uid):
-    pt = uid.to_bytes(8, 'big') + _encode_token
-    return str(int.from_bytes(_cipher().encrypt(pt), 'big'))
+def encode(uid, character_id=None):
+    """
+    :param uid: id to be encoded
+    :param character_id: id of the character for whom the id is encoded. Defaults to the character of the request
+    """
+    return encode_many([uid], character_id)[0]
+
+
+def encode_many(uids, character_id=None):
+    """
+    Encodes all ids with a single call to the cipher.
+    :param uids: list of ids to be encoded
+    :param character_id: id of the character for whom the ids are encoded. Defaults to the character of the request
+    :return: list of encoded ids in the same order
+    """
+    if not uids:
+        return []
+    pt = b''.join([uid.to_bytes(8, 'big') + _encode_token for uid in uids])
+    ct = _cipher(character_id).encrypt(pt)
+    return [str(int.from_bytes(ct[i:i + _block_size], 'big')) for i in range(0, len(ct), _block_size)]
 
 
 def decode(encoded_id):
-    pt = _cipher().decrypt(int(encoded_id).to_bytes(16, 'big'))
-    if pt[8:] != _encode_token:
-        raise ValueError('Could not decode ID')
-    return int.from_bytes(pt[:8], 'big')
+    return decode_many([encoded_id])[0]
+
+
+def decode_many(encoded_ids):
+    """
+    Decodes all ids with a single call to the cipher.
+    :param encoded_ids: list of encoded ids
+    :return: list of decoded ids in the same order
+    """
+    if not encoded_ids:
+        return []
+    ct = b''.join([int(encoded_id).to_bytes(_block_size, 'big') for encoded_id in encoded_ids])
+    pt = _cipher().decrypt(ct)
+
+    decoded_ids = []
+    for i in range(0, len(pt), _block_size):
+        if pt[i + 8:i + _block_size] != _encode_token:
+            raise ValueError('Could not decode ID')
+        decoded_ids.append(int.from_bytes(pt[i:i + 8], 'big'))
+    return decoded_ids
 
 
 _hooks = {}
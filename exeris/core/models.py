@@ -1,12 +1,17 @@
 import collections
+import contextlib
 import datetime
+import hashlib
+import json
 import logging
+import math
 
 import geoalchemy2 as gis
 import sqlalchemy as sql
 import sqlalchemy.dialects.postgresql as psql
 import sqlalchemy.orm
 from flask_security import UserMixin, RoleMixin
+from flask_sqlalchemy import SignallingSession
 from geoalchemy2.shape import to_shape, from_shape
 from shapely.geometry import Point
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
@@ -42,6 +47,34 @@ def ids(entities):
     return [entity.id for entity in entities]
 
 
+@contextlib.contextmanager
+def prefetched_properties(entities):
+    """
+    Loads all EntityTypeProperties and EntityProperties of the specified entities in two queries,
+    so get_property, has_property and get_entity_property of these entities don't query the database
+    inside of the with block. Properties added in other way than `Entity.alter_property` are not visible there.
+    :param entities: list of entities whose properties should be loaded
+    """
+    entities = [entity for entity in set(entities) if entity is not None]
+    if entities:
+        type_properties = collections.defaultdict(dict)
+        for type_property in EntityTypeProperty.query.filter(
+                EntityTypeProperty.type_name.in_({entity.type.name for entity in entities})).all():
+            type_properties[type_property.type_name][type_property.name] = type_property
+
+        entity_properties = collections.defaultdict(dict)
+        for entity_property in EntityProperty.query.filter(EntityProperty.entity_id.in_(ids(entities))).all():
+            entity_properties[entity_property.entity_id][entity_property.name] = entity_property
+
+        for entity in entities:
+            entity._prefetched_properties = (type_properties[entity.type.name], entity_properties[entity.id])
+    try:
+        yield
+    finally:
+        for entity in entities:
+            entity._prefetched_properties = None
+
+
 roles_users = db.Table('player_roles',
                        db.Column('player_id', db.String(PLAYER_ID_MAXLEN), db.ForeignKey('players.id')),
                        db.Column('role_id', db.Integer, db.ForeignKey('roles.id')),
@@ -373,6 +406,8 @@ class Entity(db.Model):
                 self.states[state] = state_prop["initial"]
 
     weight = sql.Column(sql.Integer)
+    # total weight of all the entities inside, kept up to date by the listeners of weight, parent_entity and role
+    _contents_weight = sql.Column("contents_weight", sql.Integer, default=0, nullable=False)
 
     parent_entity_id = sql.Column(sql.Integer, sql.ForeignKey("entities.id"), nullable=True)
     parent_entity = sql.orm.relationship(lambda: Entity, primaryjoin=parent_entity_id == id,
@@ -446,15 +481,21 @@ class Entity(db.Model):
         self.type = new_type
         self.add_type_specific_states()
 
+    # (type properties by name, entity properties by name) loaded in bulk by `prefetched_properties`
+    _prefetched_properties = None
+
     def get_property(self, name):
         props = {}
         ok = False
-        type_property = EntityTypeProperty.query.filter_by(type=self.type, name=name).first()
+        if self._prefetched_properties is not None:
+            type_property = self._prefetched_properties[0].get(name)
+        else:
+            type_property = EntityTypeProperty.query.filter_by(type=self.type, name=name).first()
         if type_property:
             props.update(type_property.data)
             ok = True
 
-        entity_property = EntityProperty.query.filter_by(entity=self, name=name).first()
+        entity_property = self.get_entity_property(name)
         if entity_property:
             props.update(entity_property.data)
             ok = True
@@ -464,6 +505,8 @@ class Entity(db.Model):
         return props
 
     def get_entity_property(self, name):
+        if self._prefetched_properties is not None:
+            return self._prefetched_properties[1].get(name)
         return EntityProperty.query.filter_by(entity=self, name=name).first()
 
     @hybrid_method
@@ -526,20 +569,69 @@ class Entity(db.Model):
     def modifiers(self):
         return self.states[main.States.MODIFIERS]
 
+    def contents_weight(self):
+        """
+        Returns total weight of all entities inside of this entity (or used for it in case of an Activity).
+        The value is stored in the entity and updated on every change of weight or parent of any entity inside.
+        """
+        if isinstance(self._contents_weight, sql.sql.expression.ClauseElement):  # increment which is not flushed yet
+            return self._unflushed_contents_weight
+        return self._contents_weight or 0
+
     def remove(self):
         parent_entity = self.being_in
 
         self.parent_entity = None
 
-        entities_inside = Entity.query.filter(Entity.is_in(self)).all()
-        for entity in entities_inside:
-            logger.debug("Removing %s which is inside of removed entity: %s", entity, self)
-            entity.being_in = None
+        removed_entity_ids = self.move_contents_to(None)
+        logger.debug("Removing %s which are inside of removed entity: %s", removed_entity_ids, self)
 
         db.session.delete(self)
 
         main.call_hook(main.Hooks.ENTITY_CONTENTS_COUNT_DECREASED, entity=parent_entity)
 
+    def move_contents_to(self, new_parent, entity_class=None):
+        """
+        Moves all entities being in this entity into `new_parent` using a single UPDATE.
+        Entities already loaded into the session are updated without being marked as modified.
+        :param new_parent: entity to become the new parent of the contents or None to leave them without a parent
+        :param entity_class: when specified, only instances of this class (or its subclasses) are moved
+        :return: list of ids of the moved entities
+        """
+        db.session.flush()
+        entities_table = Entity.__table__
+        moved_entities_condition = sql.and_(
+            entities_table.c.parent_entity_id == self.id,
+            entities_table.c.role == Entity.ROLE_BEING_IN,
+            entities_table.c.discriminator_type.notin_([ENTITY_LOCATION, ENTITY_ROOT_LOCATION]))
+        if entity_class:
+            moved_identities = [mapper.polymorphic_identity for mapper in sql.inspect(entity_class).self_and_descendants]
+            moved_entities_condition &= entities_table.c.discriminator_type.in_(moved_identities)
+
+        new_parent_id = new_parent.id if new_parent is not None else None
+        moved_entities = db.session.execute(
+            entities_table.update().where(moved_entities_condition)
+                .values(parent_entity_id=new_parent_id)
+                .returning(entities_table.c.id,
+                           sql.func.coalesce(entities_table.c.weight, 0) + entities_table.c.contents_weight)).fetchall()
+        if not moved_entities:
+            return []
+
+        moved_entity_ids = [entity_id for entity_id, total_weight in moved_entities]
+        moved_entity_ids_set = set(moved_entity_ids)
+        for obj in list(db.session.identity_map.values()):
+            if isinstance(obj, Entity) and obj.id in moved_entity_ids_set:
+                sql.orm.attributes.set_committed_value(obj, "parent_entity_id", new_parent_id)
+                sql.orm.attributes.set_committed_value(obj, "parent_entity", new_parent)
+
+        moved_weight = sum(total_weight for entity_id, total_weight in moved_entities)
+        _add_to_contents_weight(self, -moved_weight)
+        if new_parent is not None and not isinstance(new_parent, Activity):  # activities count only used entities
+            _add_to_contents_weight(new_parent, moved_weight)
+
+        main.call_hook(main.Hooks.ENTITIES_MOVED, entity_ids=moved_entity_ids, source=self, destination=new_parent)
+        return moved_entity_ids
+
     def alter_property(self, name, data=None):
         """
         Creates an EntityProperty for this Entity if it doesn't exist and fills it with provided data
@@ -550,6 +642,7 @@ class Entity(db.Model):
         """
         if not data:
             data = {}
+        self._prefetched_properties = None
         entity_property = EntityProperty.query.filter_by(entity=self, name=name).first()
         if entity_property:
             entity_property.data = data
@@ -568,15 +661,16 @@ class Entity(db.Model):
         excluding = ids(excluding if excluding else [])
         excluding.append(-1)  # to avoid empty IN() contradiction
         if isinstance(self, RootLocation):
-            if Passage.query.filter(Passage.incident(self)) \
-                    .filter(~Passage.left_location_id.in_(excluding)) \
-                    .filter(~Passage.right_location_id.in_(excluding)) \
-                    .count():
+            if db.session.query(Passage.query.filter(Passage.incident(self))
+                                        .filter(~Passage.left_location_id.in_(excluding))
+                                        .filter(~Passage.right_location_id.in_(excluding))
+                                        .exists()).scalar():
                 return False
-        return not Entity.query.filter(Entity.is_in(self)).filter(~Entity.id.in_(excluding)).count()
+        return not db.session.query(
+            Entity.query.filter(Entity.is_in(self)).filter(~Entity.id.in_(excluding)).exists()).scalar()
 
     def has_activity(self):
-        return Activity.query.filter(Activity.is_in(self)).count() > 0
+        return db.session.query(Activity.query.filter(Activity.is_in(self)).exists()).scalar()
 
     def get_position(self):
         return self.get_root().position
@@ -618,11 +712,151 @@ class Entity(db.Model):
 
 
 @sqlalchemy.event.listens_for(Entity, "load", propagate=True)
-def clamp_states_to_0_1(target, _):
+@sqlalchemy.event.listens_for(Entity, "refresh", propagate=True)
+def clamp_states_to_0_1(target, _, attrs=None):
+    if attrs is not None and "states" not in attrs:
+        return
     target.states = sqlalchemy_json_mutable.mutable_types.NestedMutableDict.coerce("states", target.states)
     target.states.listeners.append(clamp_to_0_1)
 
 
+def _get_parent_counting_weight(entity, parent_entity, role):
+    """
+    Returns the parent whose contents weight includes the entity or None if there's no such parent.
+    Locations are never a part of the contents and activities contain only the entities used for them.
+    """
+    if parent_entity is None or isinstance(entity, Location):
+        return None
+    if isinstance(parent_entity, Activity):
+        return parent_entity if role == Entity.ROLE_USED_FOR else None
+    return parent_entity if role == Entity.ROLE_BEING_IN else None
+
+
+def _add_to_contents_weight(entity, weight_difference):
+    """
+    Adds the difference to the contents weight of the entity and all its parents counting its weight.
+    Contents weight of a persistent entity is set to an SQL expression, so the difference is added
+    by the UPDATE statement and changes made by concurrent transactions are not overwritten.
+    """
+    if not weight_difference:
+        return
+    while entity is not None:
+        new_contents_weight = entity.contents_weight() + weight_difference
+        if sql.inspect(entity).persistent:
+            stored_contents_weight = entity._contents_weight
+            if not isinstance(stored_contents_weight, sql.sql.expression.ClauseElement):
+                stored_contents_weight = Entity.__table__.c.contents_weight
+            entity._contents_weight = stored_contents_weight + weight_difference
+            entity._unflushed_contents_weight = new_contents_weight  # expression is expired and reloaded after flush
+        else:
+            entity._contents_weight = new_contents_weight
+        entity = _get_parent_counting_weight(entity, entity.parent_entity, entity.role)
+
+
+def _add_to_contents_weight_of_parents(entity, parent_entity, role, weight_difference):
+    _add_to_contents_weight(_get_parent_counting_weight(entity, parent_entity, role), weight_difference)
+
+
+def _total_weight(entity):
+    return (entity.weight or 0) + entity.contents_weight()
+
+
+def _value_if_set(value):
+    if value is sql.orm.attributes.NO_VALUE or value is sql.orm.attributes.NEVER_SET:
+        return None
+    return value
+
+
+@sqlalchemy.event.listens_for(Entity.parent_entity, "set", propagate=True, active_history=True)
+def move_contents_weight_on_parent_change(target, value, oldvalue, initiator):
+    oldvalue = _value_if_set(oldvalue)
+    if value is oldvalue:
+        return
+    with db.session.no_autoflush:
+        total_weight = _total_weight(target)
+        _add_to_contents_weight_of_parents(target, oldvalue, target.role, -total_weight)
+        _add_to_contents_weight_of_parents(target, value, target.role, total_weight)
+
+
+@sqlalchemy.event.listens_for(Entity.role, "set", propagate=True, active_history=True)
+def move_contents_weight_on_role_change(target, value, oldvalue, initiator):
+    oldvalue = _value_if_set(oldvalue)
+    if value == oldvalue:
+        return
+    with db.session.no_autoflush:
+        total_weight = _total_weight(target)
+        _add_to_contents_weight_of_parents(target, target.parent_entity, oldvalue, -total_weight)
+        _add_to_contents_weight_of_parents(target, target.parent_entity, value, total_weight)
+
+
+@sqlalchemy.event.listens_for(Entity.weight, "set", propagate=True, active_history=True)
+def update_contents_weight_on_weight_change(target, value, oldvalue, initiator):
+    weight_difference = (value or 0) - (_value_if_set(oldvalue) or 0)
+    with db.session.no_autoflush:
+        _add_to_contents_weight_of_parents(target, target.parent_entity, target.role, weight_difference)
+
+
+@sqlalchemy.event.listens_for(SignallingSession, "before_flush")
+def remove_contents_weight_of_deleted_entities(session, flush_context, instances):
+    for obj in session.deleted:
+        if isinstance(obj, Entity):
+            _add_to_contents_weight_of_parents(obj, obj.parent_entity, obj.role, -_total_weight(obj))
+
+
+def _is_counted_in_contents_weight(child_table, parent_table):
+    return sql.or_(
+        sql.and_(child_table.c.role == Entity.ROLE_BEING_IN,
+                 child_table.c.discriminator_type.notin_([ENTITY_LOCATION, ENTITY_ROOT_LOCATION]),
+                 parent_table.c.discriminator_type != ENTITY_ACTIVITY),
+        sql.and_(child_table.c.role == Entity.ROLE_USED_FOR,
+                 parent_table.c.discriminator_type == ENTITY_ACTIVITY))
+
+
+def rebuild_contents_weights():
+    """
+    Verifies the stored contents weight of all entities against the value computed by a recursive query
+    and fixes the entities whose stored value is incorrect. The comparison and the fix are done by a single
+    UPDATE statement, so there's no window for a concurrent increment to be overwritten by a stale value.
+    It's a fallback for the incremental updates, which can be missed by bulk updates of the entities.
+    It scans the whole entities table, so it should be run offline (see util/rebuild_contents_weights.py).
+    :return: list of ids of entities whose contents weight had to be fixed
+    """
+    db.session.flush()
+    entities_table = Entity.__table__
+    child, parent = entities_table.alias("child"), entities_table.alias("parent")
+    descendants = sql.select([child.c.parent_entity_id.label("ancestor_id"),
+                              child.c.id.label("descendant_id"),
+                              child.c.weight.label("weight")]) \
+        .select_from(child.join(parent, child.c.parent_entity_id == parent.c.id)) \
+        .where(_is_counted_in_contents_weight(child, parent)) \
+        .cte("descendants", recursive=True)
+
+    nested_child, nested_parent = entities_table.alias("nested_child"), entities_table.alias("nested_parent")
+    descendants = descendants.union_all(
+        sql.select([descendants.c.ancestor_id, nested_child.c.id, nested_child.c.weight])
+            .select_from(nested_child.join(nested_parent, nested_child.c.parent_entity_id == nested_parent.c.id)
+                         .join(descendants, descendants.c.descendant_id == nested_parent.c.id))
+            .where(_is_counted_in_contents_weight(nested_child, nested_parent)))
+
+    computed_entity = entities_table.alias("computed_entity")
+    computed_weights = sql.select([computed_entity.c.id.label("entity_id"),
+                                   sql.func.coalesce(sql.func.sum(descendants.c.weight), 0).label("contents_weight")]) \
+        .select_from(computed_entity.outerjoin(descendants, descendants.c.ancestor_id == computed_entity.c.id)) \
+        .group_by(computed_entity.c.id).alias("computed_weights")
+
+    fixed_entity_ids = [row[0] for row in db.session.execute(
+        entities_table.update()
+            .where(entities_table.c.id == computed_weights.c.entity_id)
+            .where(entities_table.c.contents_weight != computed_weights.c.contents_weight)
+            .values(contents_weight=computed_weights.c.contents_weight)
+            .returning(entities_table.c.id)).fetchall()]
+
+    for obj in db.session.identity_map.values():
+        if isinstance(obj, Entity) and obj.id in fixed_entity_ids:
+            db.session.expire(obj, ["_contents_weight"])
+    return fixed_entity_ids
+
+
 class Intent(db.Model):
     """
     Represents entity's will or plan to perform certain action (which can be impossible at the moment)
@@ -733,9 +967,12 @@ class Character(Entity):
 
     @hybrid_property
     def name(self):
-        own_name = ObservedName.query.filter_by(target=self, observer=self).first()
+        if self.id is None:  # the cache is keyed by ids, so the name of a pending character needs to be queried
+            own_name = ObservedName.query.filter_by(target=self, observer=self).first()
+            return own_name.name if own_name else "UNNAMED"
+        own_name = ObservedNamesCache.get_name(self.id, self.id)
         if own_name:
-            return own_name.name
+            return own_name
         return "UNNAMED"
 
     @name.setter
@@ -767,10 +1004,6 @@ class Character(Entity):
     def validate_spawn_date(self, key, spawn_date):
         return spawn_date.game_timestamp
 
-    def contents_weight(self):
-        entities = Entity.query.filter(Entity.is_in(self)).all()
-        return sum([entity.weight + entity.contents_weight() for entity in entities])
-
     def pyslatize(self, **overwrites):
         pyslatized = dict(entity_type=ENTITY_CHARACTER, character_id=self.id, character_gen=self.sex,
                           character_name=self.type_name)
@@ -787,7 +1020,10 @@ class Character(Entity):
 
 
 @sqlalchemy.event.listens_for(Entity, "load", propagate=True)
-def add_death_listener(target, _):
+@sqlalchemy.event.listens_for(Entity, "refresh", propagate=True)
+def add_death_listener(target, _, attrs=None):
+    if attrs is not None and "states" not in attrs:
+        return
     target.states = sqlalchemy_json_mutable.mutable_types.NestedMutableDict.coerce("states", target.states)
     target.states.listeners.append(create_death_listener(target))
 
@@ -831,6 +1067,41 @@ class Item(Entity):
 
     quality = sql.Column(sql.Float, default=1.0)
 
+    # damage of degradable items is evaluated lazily: the damage stored in states is increased by
+    # `damage_per_second` for every second since `damage_updated_at`. All are None when it doesn't degrade
+    damage_per_second = sql.Column(sql.Float, nullable=True)
+    damage_updated_at = sql.Column(sql.BigInteger, nullable=True)
+    crumble_at = sql.Column(sql.BigInteger, nullable=True, index=True)  # game timestamp when damage reaches 1
+
+    @hybrid_property
+    def damage(self):
+        stored_damage = self.states[main.States.DAMAGE]
+        if self.damage_per_second is None:
+            return stored_damage
+        from exeris.core import general
+        seconds_since_update = general.GameDate.now().game_timestamp - self.damage_updated_at
+        return util.clamp_0_1(stored_damage + seconds_since_update * self.damage_per_second)
+
+    @damage.setter
+    def damage(self, new_value):
+        if self.damage_per_second is not None:
+            from exeris.core import general
+            self.damage_updated_at = general.GameDate.now().game_timestamp
+            self.crumble_at = self.damage_updated_at + Item.seconds_until_crumbling(new_value,
+                                                                                     self.damage_per_second)
+        self.states[main.States.DAMAGE] = new_value
+
+    @staticmethod
+    def seconds_until_crumbling(damage, damage_per_second):
+        return math.ceil((1 - util.clamp_0_1(damage)) / damage_per_second)
+
+    @damage.expression
+    def damage(cls):
+        from exeris.core import general
+        stored_damage = cls.states[main.States.DAMAGE].astext.cast(sql.Float)
+        damage_since_update = cls.damage_per_second * (general.GameDate.now().game_timestamp - cls.damage_updated_at)
+        return sql.func.greatest(0, sql.func.least(stored_damage + sql.func.coalesce(damage_since_update, 0), 1))
+
     @hybrid_property
     def amount(self):
         if not self.type.stackable:
@@ -848,17 +1119,10 @@ class Item(Entity):
 
     def remove(self, move_contents=True):
         if move_contents:
-            items_inside = Item.query.filter(Item.is_in(self)).all()
-
-            for item in items_inside:
-                item.being_in = self.being_in  # move outside
+            self.move_contents_to(self.being_in, Item)  # move outside
 
         super(Item, self).remove()
 
-    def contents_weight(self):
-        entities = Entity.query.filter(Entity.is_in(self)).all()
-        return sum([entity.weight + entity.contents_weight() for entity in entities])
-
     def pyslatize(self, **overwrites):
         pyslatized = dict(entity_type=ENTITY_ITEM, item_id=self.id, item_name=self.type_name,
                           item_damage=self.damage)
@@ -945,9 +1209,13 @@ class Activity(Entity):
     ticks_needed = sql.Column(sql.Float)
     ticks_left = sql.Column(sql.Float)
 
-    def contents_weight(self):
-        entities = Entity.query.filter(Entity.is_used_for(self)).all()
-        return sum([entity.weight + entity.contents_weight() for entity in entities])
+    # progress per tick of the activity worked on in a steady state (see actions.ActivitySteadyState)
+    steady_state = sql.Column(sqlalchemy_json_mutable.JsonDict, nullable=True)
+    # ids of entities whose change brings the activity back from the steady state; NULL when not in a steady state
+    steady_state_dependencies = sql.Column(psql.ARRAY(sql.Integer), nullable=True)
+
+    __table_args__ = (sql.Index("activity_steady_state_dependencies_index", "steady_state_dependencies",
+                                postgresql_using="gin"),)
 
     def pyslatize(self, **overwrites):
         pyslatized = dict(entity_type=ENTITY_ACTIVITY, activity_id=self.id,
@@ -1256,10 +1524,6 @@ class Location(Entity):
         # or decide that all dependent locations will be destroyed
         # self.being_in = None
 
-    def contents_weight(self):
-        entities = Entity.query.filter(Entity.is_in(self)).all()
-        return sum([entity.weight + entity.contents_weight() for entity in entities])
-
     def pyslatize(self, **overwrites):
         pyslatized = dict(entity_type=ENTITY_LOCATION, location_id=self.id,
                           location_name=self.type_name)
@@ -1286,6 +1550,8 @@ class Location(Entity):
 class Sequences(db.Model):
     __tablename__ = "sequences"
     entity_union_sequence = sql.Sequence("entity_union_sequence")
+    # incremented after every commit changing requirements of recipes or type groups, used by RecipeAvailabilityIndex
+    recipes_version_sequence = sql.Sequence("recipes_version_sequence", metadata=db.metadata)
     serial_id = sql.Column(sql.Integer, entity_union_sequence, primary_key=True)
 
 
@@ -1316,6 +1582,11 @@ class RootLocation(Location):
 
     @position.setter
     def position(self, position):  # we assume position is a Point
+        self._position = from_shape(RootLocation.wrap_position(position))
+
+    @staticmethod
+    def wrap_position(position):
+        """Returns a position which is wrapped around the edges of the map"""
         x, y = position.x, position.y
         if not (0 <= x < MAP_WIDTH):
             x %= MAP_WIDTH
@@ -1325,7 +1596,7 @@ class RootLocation(Location):
         if y > MAP_HEIGHT:
             y = MAP_HEIGHT - (y - MAP_HEIGHT)
             x = (x + MAP_WIDTH / 2) % MAP_WIDTH
-        self._position = from_shape(Point(x, y))
+        return Point(x, y)
 
     @position.expression
     def position(cls):
@@ -1607,6 +1878,78 @@ class ObservedName(db.Model):
         return "{{ObservedName target={}, by={}, name={}}}".format(self.target, self.observer, self.name)
 
 
+class ObservedNamesCache:
+    """
+    Names of entities given by the characters observing them, cached until the end of the transaction.
+    All the names known by many observers can be loaded with a single query before these names are rendered.
+    The cache is kept in `session.info`, so it's never shared between sessions,
+    and it's cleared whenever any observed name is changed or deleted or a savepoint is rolled back.
+    """
+    SESSION_INFO_KEY = "observed_names_cache"
+
+    def __init__(self):
+        self.names = {}  # (observer_id, target_id) -> name
+        self.observer_ids_fully_loaded = set()
+
+    @classmethod
+    def _get_cache(cls, session=None):
+        session = session if session is not None else db.session
+        return session.info.setdefault(cls.SESSION_INFO_KEY, ObservedNamesCache())
+
+    @classmethod
+    def get_name(cls, observer_id, target_id):
+        """
+        :return: name of the target given by the observer or None if the observer hasn't named the target
+        """
+        cache = cls._get_cache()
+        key = (observer_id, target_id)
+        if key not in cache.names and observer_id not in cache.observer_ids_fully_loaded:
+            observed_name = ObservedName.query.filter_by(observer_id=observer_id, target_id=target_id).first()
+            cache.names[key] = observed_name.name if observed_name else None
+        return cache.names.get(key)
+
+    @classmethod
+    def load_names_known_by(cls, observers):
+        cache = cls._get_cache()
+        observer_ids = {observer.id for observer in observers if observer.id is not None}
+        observer_ids -= cache.observer_ids_fully_loaded
+        if not observer_ids:
+            return
+        known_names = db.session.query(ObservedName.observer_id, ObservedName.target_id, ObservedName.name) \
+            .filter(ObservedName.observer_id.in_(observer_ids)).all()
+        for observer_id, target_id, name in known_names:
+            cache.names[(observer_id, target_id)] = name
+        cache.observer_ids_fully_loaded.update(observer_ids)
+
+    @classmethod
+    def clear(cls, session=None):
+        session = session if session is not None else db.session
+        session.info.pop(cls.SESSION_INFO_KEY, None)
+
+
+@sqlalchemy.event.listens_for(ObservedName.name, "set")
+def clear_observed_names_cache_on_rename(target, value, oldvalue, initiator):
+    ObservedNamesCache.clear(sql.orm.object_session(target))
+
+
+@sqlalchemy.event.listens_for(SignallingSession, "before_flush")
+def clear_observed_names_cache_on_delete(session, flush_context, instances):
+    if any(isinstance(obj, ObservedName) for obj in session.deleted):
+        ObservedNamesCache.clear(session)
+
+
+@sqlalchemy.event.listens_for(SignallingSession, "after_soft_rollback")
+def clear_observed_names_cache_after_rollback(session, previous_transaction):
+    # names changed in the savepoint which was rolled back could have been cached
+    ObservedNamesCache.clear(session)
+
+
+@sqlalchemy.event.listens_for(SignallingSession, "after_transaction_end")
+def clear_observed_names_cache_after_transaction(session, transaction):
+    if transaction.parent is None:
+        ObservedNamesCache.clear(session)
+
+
 class Achievement(db.Model):
     __tablename__ = "achievements"
 
@@ -1641,7 +1984,8 @@ class Notification(db.Model):
 
     id = sql.Column(sql.Integer, primary_key=True)
 
-    def __init__(self, title_tag, title_params, text_tag, text_params, count=1, character=None, player=None):
+    def __init__(self, title_tag, title_params, text_tag, text_params, count=1, character=None, player=None,
+                 deduplicated=False):
         self.title_tag = title_tag
         self.title_params = title_params
         self.text_tag = text_tag
@@ -1649,6 +1993,8 @@ class Notification(db.Model):
         self.count = count
         self.character = character
         self.player = player
+        if deduplicated:
+            self.content_hash = Notification.get_content_hash(title_tag, title_params, text_tag, text_params)
 
         from exeris.core import general
         self.game_date = general.GameDate.now().game_timestamp
@@ -1672,6 +2018,14 @@ class Notification(db.Model):
 
     game_date = sql.Column(sql.BigInteger)
 
+    # set only for notifications which are deduplicated, there can be just one with the same contents for a recipient
+    content_hash = sql.Column(sql.String(40), nullable=True)
+
+    @staticmethod
+    def get_content_hash(title_tag, title_params, text_tag, text_params):
+        contents = json.dumps([title_tag, title_params, text_tag, text_params], sort_keys=True)
+        return hashlib.sha1(contents.encode("utf-8")).hexdigest()
+
     def update_date(self):
         from exeris.core import general
         self.game_date = general.GameDate.now().game_timestamp
@@ -1705,6 +2059,11 @@ class Notification(db.Model):
         return cls.query.get(entity_id)
 
 
+# NULLs are distinct in unique indexes, so recipient columns need to be coalesced
+sql.Index("notification_recipient_content_hash_index", sql.func.coalesce(Notification.character_id, 0),
+          sql.func.coalesce(Notification.player_id, ""), Notification.content_hash, unique=True)
+
+
 class ScheduledTask(db.Model):
     __tablename__ = "scheduled_tasks"
 
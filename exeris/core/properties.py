@@ -356,8 +356,11 @@ class OptionalBeingMovedProperty(OptionalPropertyBase):
     def set_target(self, location):
         self._update_value("target", location.id)
 
+    def get_target_id(self):
+        return self.entity_property.data.get("target", None)
+
     def get_target(self):
-        target_id = self.entity_property.data.get("target", None)
+        target_id = self.get_target_id()
         if not target_id:
             return None
         return models.Location.by_id(target_id)
@@ -1,9 +1,12 @@
+import collections
 import copy
 
-from exeris.core import models, deferred, general, main
+import sqlalchemy as sql
+from exeris.core import models, deferred, general, main, util
 from exeris.core import properties
 from exeris.core.main import db, Types
 from exeris.core.properties_base import P
+from flask_sqlalchemy import SignallingSession
 
 
 class ActivityFactory:
@@ -191,6 +194,10 @@ class ActivityFactory:
 
     @classmethod
     def get_selectable_entities(cls, recipe, character):
+        """
+        Returns all items, locations and passages around the character which can be selected as a container
+        of the activity created from the recipe. Everything is retrieved in a single query.
+        """
         activity_container_spec = recipe.activity_container
         if activity_container_spec[0] != "selected_entity":
             return []
@@ -200,51 +207,75 @@ class ActivityFactory:
             descending_types = models.EntityType.by_name(type_name).get_descending_types()
             allowed_types += [subtype.name for subtype, eff in descending_types]
 
-        # items
-        item_query_parts = cls.property_related_query_parts(activity_container_spec, models.Item)
-        if allowed_types:
-            item_query_parts += [models.Item.type_name.in_(allowed_types)]
-        items = models.Item.query.filter(models.Item.is_in(character.parent_locations()),
-                                         *item_query_parts).all()
-
-        # locations
-        location_ids = models.ids(character.parent_locations())
-        for loc in character.parent_locations():
-            location_ids += [directed_passage.other_side.id for directed_passage in loc.passages_to_neighbours
-                             if directed_passage.passage.is_accessible(False)]
-
-        loc_query_parts = cls.property_related_query_parts(activity_container_spec, models.Location)
-        if allowed_types:
-            loc_query_parts += [models.Location.type_name.in_(allowed_types)]
-
-        locations = models.Location.query.filter(models.Location.id.in_(location_ids),
-                                                 *loc_query_parts).all()
-
-        # passages
+        parent_locations = character.parent_locations()
+        location_ids = models.ids(parent_locations)
         passage_ids = []
-        for loc in character.parent_locations():
-            passage_ids += [directed_passage.passage.id for directed_passage in loc.passages_to_neighbours
-                            if directed_passage.passage.is_accessible(False)]
+        for loc in parent_locations:
+            for directed_passage in loc.passages_to_neighbours:
+                if directed_passage.passage.is_accessible(False):
+                    location_ids.append(directed_passage.other_side.id)
+                    passage_ids.append(directed_passage.passage.id)
+
+        def selectable_ids_query(entity_class, *conditions):
+            query = db.session.query(entity_class.id).filter(*conditions)
+            if allowed_types:
+                query = query.filter(entity_class.type_name.in_(allowed_types))
+            return cls.filter_by_container_properties(query, activity_container_spec, entity_class)
+
+        selectable_ids_queries = [
+            selectable_ids_query(models.Item, models.Item.is_in(parent_locations)),
+            selectable_ids_query(models.Location, models.Location.id.in_(location_ids)),
+        ]
+        if passage_ids:
+            selectable_ids_queries.append(selectable_ids_query(models.Passage, models.Passage.id.in_(passage_ids)))
 
-        passage_query_parts = cls.property_related_query_parts(activity_container_spec, models.Passage)
-        if allowed_types:
-            passage_query_parts += [models.Passage.type_name.in_(allowed_types)]
+        selectable_ids = selectable_ids_queries[0].union(*selectable_ids_queries[1:]).subquery()
 
-        passages = []
-        if passage_ids:
-            passages = models.Passage.query.filter(models.Passage.id.in_(passage_ids),
-                                                   *passage_query_parts).all()
+        entity_classes = [models.Item, models.Location, models.Passage]
+        polymorphic_entity = sql.orm.with_polymorphic(models.Entity, entity_classes + [models.RootLocation])
+        selectable_entities = db.session.query(polymorphic_entity) \
+            .filter(polymorphic_entity.id.in_(sql.select([selectable_ids.c.id]))).all()
 
-        return items + locations + passages
+        # items first, then locations and passages
+        return sorted(selectable_entities, key=lambda entity: [isinstance(entity, entity_class)
+                                                               for entity_class in entity_classes], reverse=True)
 
     @classmethod
-    def property_related_query_parts(cls, activity_container_spec, entity_class):
-        property_query_parts = []
-        for property_name, property_dict in activity_container_spec[1].get("properties", {}).items():
-            property_query_parts += [entity_class.has_property(property_name, **property_dict)]
-        for property_name, property_dict in activity_container_spec[1].get("no_properties", {}).items():
-            property_query_parts += [~entity_class.has_property(property_name, **property_dict)]
-        return property_query_parts
+    def filter_by_container_properties(cls, query, activity_container_spec, entity_class):
+        """
+        Filters the query to the entities having all "properties" and none of "no_properties"
+        specified in the activity container spec. Every property is checked using outer joins
+        with EntityProperty and EntityTypeProperty tables instead of a correlated subquery.
+        """
+        required_properties = activity_container_spec[1].get("properties", {})
+        forbidden_properties = activity_container_spec[1].get("no_properties", {})
+
+        for property_name, property_dict, is_required in \
+                [(name, prop_dict, True) for name, prop_dict in required_properties.items()] + \
+                [(name, prop_dict, False) for name, prop_dict in forbidden_properties.items()]:
+            entity_property = sql.orm.aliased(models.EntityProperty)
+            type_property = sql.orm.aliased(models.EntityTypeProperty)
+            query = query \
+                .outerjoin(entity_property, sql.and_(entity_property.entity_id == entity_class.id,
+                                                     entity_property.name == property_name)) \
+                .outerjoin(type_property, sql.and_(type_property.type_name == entity_class.type_name,
+                                                   type_property.name == property_name))
+
+            has_property = sql.or_(entity_property.name.isnot(None), type_property.name.isnot(None))
+            for key, value in property_dict.items():
+                entity_cast_value = util.Sql.cast_json_value_to_psql_type(entity_property.data[key], value)
+                type_cast_value = util.Sql.cast_json_value_to_psql_type(type_property.data[key], value)
+                has_property = sql.and_(has_property, sql.or_(
+                    entity_cast_value == value,
+                    sql.and_(
+                        type_cast_value == value,
+                        sql.sql.functions.coalesce(entity_cast_value == value, True)
+                    )
+                ))
+
+            has_property = sql.sql.functions.coalesce(has_property, False)
+            query = query.filter(has_property if is_required else ~has_property)
+        return query
 
     @classmethod
     def get_list_of_errors(cls, recipe, character):
@@ -295,76 +326,243 @@ class RecipeListProducer:
         self.character = character
 
     def get_recipe_list(self):
-        # prefetch data
-        location = self.character.get_location()
+        recipes_index = RecipeAvailabilityIndex.get()
+        context = RecipeCharacterContext(self.character, recipes_index)
 
-        skills = {}
-        for (skill_name,) in db.session.query(models.SkillType.name).all():
-            skills_property = properties.SkillsProperty(self.character)
-            skills[skill_name] = skills_property.get_skill_factor(skill_name)
+        available_recipe_ids = recipes_index.get_available_recipe_ids(context)
+        if not available_recipe_ids:
+            return []
 
-        character_position = location.get_position()
+        recipes_by_id = {recipe.id: recipe for recipe in
+                         models.EntityRecipe.query.filter(models.EntityRecipe.id.in_(available_recipe_ids)).all()}
+        return [recipes_by_id[recipe_id] for recipe_id in recipes_index.recipe_ids if recipe_id in recipes_by_id]
+
+
+class AnyOfRequirementIndex:
+    """
+    Inverted index for requirements met when at least one of the required values is present,
+    e.g. one of location types or one of terrain types.
+    """
+
+    def __init__(self):
+        self.requiring = set()
+        self.by_value = collections.defaultdict(set)
+
+    def add(self, recipe_id, required_values):
+        self.requiring.add(recipe_id)
+        for value in required_values:
+            self.by_value[value].add(recipe_id)
+
+    def get_unavailable(self, present_values):
+        meeting_requirement = set()
+        for value in present_values:
+            meeting_requirement.update(self.by_value.get(value, set()))
+        return self.requiring - meeting_requirement
+
+
+class AllOfRequirementIndex:
+    """
+    Inverted index for requirements met when all of the required values are present,
+    e.g. all mandatory tools or machines.
+    """
+
+    def __init__(self):
+        self.by_value = collections.defaultdict(set)
+
+    def add(self, recipe_id, required_values):
+        for value in required_values:
+            self.by_value[value].add(recipe_id)
+
+    def get_unavailable(self, is_value_present):
+        unavailable = set()
+        for value, recipe_ids in self.by_value.items():
+            if not is_value_present(value):
+                unavailable.update(recipe_ids)
+        return unavailable
+
+
+class RecipeAvailabilityIndex:
+    """
+    Requirements of all the recipes compiled into inverted indices (from the required location type,
+    terrain type, resource, tool and machine to the recipe ids), so checking availability of all recipes
+    for a character is a couple of set operations. The index is shared between requests
+    and rebuilt only when requirements of the recipes or type groups change (in any process).
+    """
+    _instance = None
+
+    # key in `session.info` marking that the transaction changes anything the index is compiled from
+    CHANGED_INFO_KEY = "recipes_changed"
+
+    def __init__(self, version):
+        self.version = version
+        self.recipe_ids = []
+        self.location_types = AnyOfRequirementIndex()
+        self.terrain_types = AnyOfRequirementIndex()
+        self.required_resources = AnyOfRequirementIndex()
+        self.mandatory_machines = AllOfRequirementIndex()
+        self.mandatory_tools = AllOfRequirementIndex()
+        self.requiring_permanence = set()
+        self.skills = []  # (recipe_id, skill_name, min_skill_value)
+        self.concrete_types_of_groups = {}  # type name -> set of names of concrete types
+
+        for recipe_id, req in db.session.query(models.EntityRecipe.id, models.EntityRecipe.requirements) \
+                .order_by(models.EntityRecipe.id).all():
+            self._compile_recipe(recipe_id, req)
+
+    def _compile_recipe(self, recipe_id, req):
+        self.recipe_ids.append(recipe_id)
+
+        def as_list(value):
+            return [value] if isinstance(value, str) else value
+
+        if "location_types" in req:
+            self.location_types.add(recipe_id, as_list(req["location_types"]))
+        if "terrain_types" in req:
+            self.terrain_types.add(recipe_id, as_list(req["terrain_types"]))
+        if "required_resources" in req:
+            self.required_resources.add(recipe_id, as_list(req["required_resources"]))
+        if "permanence" in req:
+            self.requiring_permanence.add(recipe_id)
+        if "skills" in req:
+            for skill_name, min_skill_value in req["skills"].items():
+                self.skills.append((recipe_id, skill_name, min_skill_value))
+        if "mandatory_machines" in req:
+            self.mandatory_machines.add(recipe_id, req["mandatory_machines"])
+            self._compile_groups(req["mandatory_machines"])
+        if "mandatory_tools" in req:
+            self.mandatory_tools.add(recipe_id, req["mandatory_tools"])
+            self._compile_groups(req["mandatory_tools"])
+
+    def _compile_groups(self, group_names):
+        for group_name in group_names:
+            if group_name not in self.concrete_types_of_groups:
+                group = models.EntityType.by_name(group_name)
+                concrete_types = models.get_concrete_types_for_groups([group]) if group else set()
+                self.concrete_types_of_groups[group_name] = {entity_type.name for entity_type in concrete_types}
+
+    def get_available_recipe_ids(self, context):
+        unavailable = set()
+        if self.location_types.requiring:
+            unavailable |= self.location_types.get_unavailable([context.location_type])
+        if self.terrain_types.requiring:
+            unavailable |= self.terrain_types.get_unavailable(context.terrain_types)
+        if self.required_resources.requiring:
+            unavailable |= self.required_resources.get_unavailable(context.available_resources)
+
+        if self.mandatory_machines.by_value:
+            unavailable |= self.mandatory_machines.get_unavailable(
+                lambda group_name: self.concrete_types_of_groups[group_name] & context.machine_types)
+        if self.mandatory_tools.by_value:
+            unavailable |= self.mandatory_tools.get_unavailable(
+                lambda group_name: self.concrete_types_of_groups[group_name] & context.tool_types)
+
+        if self.requiring_permanence - unavailable and not context.can_be_permanent:
+            unavailable |= self.requiring_permanence
+
+        for recipe_id, skill_name, min_skill_value in self.skills:
+            if recipe_id not in unavailable and context.get_skill(skill_name) < min_skill_value:
+                unavailable.add(recipe_id)
+
+        return [recipe_id for recipe_id in self.recipe_ids if recipe_id not in unavailable]
 
-        location_type = location.type_name
-        terrain_types = db.session.query(models.TerrainArea.type_name) \
-            .filter(models.TerrainArea.terrain.ST_Intersects(character_position.wkt)).all()
-        terrain_types = [terain_type[0] for terain_type in terrain_types]
+    @staticmethod
+    def get_version():
+        """
+        Version of everything the index is compiled from. It's a sequence incremented after the commit
+        of every transaction which changes requirements of recipes or type groups, so changes made by
+        other processes are noticed too. `is_called` is needed to tell apart the start value and its first increment.
+        """
+        return tuple(db.session.execute(sql.text("SELECT last_value, is_called FROM recipes_version_sequence")).first())
 
-        available_resources = db.session.query(models.ResourceArea.resource_type_name) \
-            .filter(models.ResourceArea.center.ST_DWithin(character_position.wkt, models.ResourceArea.radius)).all()
-        available_resources = [resource[0] for resource in available_resources]
+    @classmethod
+    def get(cls):
+        version = cls.get_version()
+        if cls._instance is None or cls._instance.version != version:
+            cls._instance = RecipeAvailabilityIndex(version)
+        return cls._instance
 
-        can_be_permanent = location.get_root().can_be_permanent()
+    @classmethod
+    def invalidate(cls):
+        cls._instance = None
 
-        all_recipes = models.EntityRecipe.query.all()
 
-        def is_recipe_available(recipe):
-            req = recipe.requirements
+def _mark_recipes_changed(mapper, connection, target):
+    # index of this process is rebuilt immediately, because the change is visible in its session
+    RecipeAvailabilityIndex.invalidate()
+    session = sql.orm.object_session(target)
+    if session is not None:
+        session.info[RecipeAvailabilityIndex.CHANGED_INFO_KEY] = True
 
-            if "location_types" in req:
-                if location_type not in req["location_types"]:
-                    return False
 
-            if "terrain_types" in req:
-                if not set(req["terrain_types"]).intersection(set(terrain_types)):
-                    return False
+for recipe_affecting_model in [models.EntityRecipe, models.TypeGroupElement]:
+    for mapper_event in ["after_insert", "after_update", "after_delete"]:
+        sql.event.listen(recipe_affecting_model, mapper_event, _mark_recipes_changed)
 
-            if "permanence" in req:
-                if not can_be_permanent:
-                    return False
 
-            if "skills" in req:
-                for skill_name, min_skill_value in req["skills"]:
-                    if skills[skill_name] < min_skill_value:
-                        return False
+@sql.event.listens_for(SignallingSession, "after_commit")
+def increment_recipes_version_after_commit(session):
+    if session.transaction is not None and session.transaction.nested:
+        return  # other processes can't see the changes before the outermost transaction is committed
+    if session.info.pop(RecipeAvailabilityIndex.CHANGED_INFO_KEY, False):
+        db.engine.execute(models.Sequences.recipes_version_sequence)
 
-            if "required_resources" in req:
-                if not set(req["required_resources"]).intersection(set(available_resources)):
-                    return False
 
-            if "mandatory_machines" in req:
-                for machine_name in req["mandatory_machines"]:
-                    group = models.EntityType.by_name(machine_name)
-                    allowed_types = models.get_concrete_types_for_groups([group])
+@sql.event.listens_for(SignallingSession, "after_soft_rollback")
+def forget_recipes_changes_after_rollback(session, previous_transaction):
+    if previous_transaction.parent is None and session.info.pop(RecipeAvailabilityIndex.CHANGED_INFO_KEY, False):
+        RecipeAvailabilityIndex.invalidate()  # it could have been built from the changes which were rolled back
 
-                    from exeris.core import actions
-                    machines = actions.ActivityProgress.get_all_machines_around_entity(allowed_types,
-                                                                                       self.character)
-                    if not machines:
-                        return False
 
-            if "mandatory_tools" in req:
-                for tool_type_name in req["mandatory_tools"]:
-                    group = models.EntityType.by_name(tool_type_name)
-                    allowed_types = models.get_concrete_types_for_groups([group])
+class RecipeCharacterContext:
+    """
+    Everything about the character that is needed to check availability of the recipes.
+    Every part is retrieved from the database only if any recipe requires it.
+    """
 
-                    tools = general.ItemQueryHelper.query_all_types_in(allowed_types, self.character).first()
-                    if not tools:
-                        return False
+    def __init__(self, character, recipes_index):
+        self.character = character
+        location = character.get_location()
+        self.location_type = location.type_name
 
-            return True
+        character_position = location.get_position()
 
-        return [recipe for recipe in all_recipes if is_recipe_available(recipe)]
+        self.terrain_types = []
+        if recipes_index.terrain_types.requiring:
+            terrain_types = db.session.query(models.TerrainArea.type_name) \
+                .filter(models.TerrainArea.terrain.ST_Intersects(character_position.wkt)).all()
+            self.terrain_types = [terrain_type[0] for terrain_type in terrain_types]
+
+        self.available_resources = []
+        if recipes_index.required_resources.requiring:
+            available_resources = db.session.query(models.ResourceArea.resource_type_name) \
+                .filter(models.ResourceArea.center.ST_DWithin(character_position.wkt,
+                                                              models.ResourceArea.radius)).all()
+            self.available_resources = [resource[0] for resource in available_resources]
+
+        self.can_be_permanent = False
+        if recipes_index.requiring_permanence:
+            self.can_be_permanent = location.get_root().can_be_permanent()
+
+        # character itself is considered a machine, like in ActivityProgress.get_all_machines_around_entity
+        self.machine_types = {character.type_name}
+        if recipes_index.mandatory_machines.by_value:
+            item_types_around = db.session.query(models.Item.type_name) \
+                .filter(models.Item.is_in(character.parent_locations())).distinct().all()
+            self.machine_types.update(item_type[0] for item_type in item_types_around)
+
+        self.tool_types = set()
+        if recipes_index.mandatory_tools.by_value:
+            item_types_in_inventory = db.session.query(models.Item.type_name) \
+                .filter(models.Item.is_in(character)).distinct().all()
+            self.tool_types = {item_type[0] for item_type in item_types_in_inventory}
+
+        self._skills = {}
+
+    def get_skill(self, skill_name):
+        if skill_name not in self._skills:
+            skills_property = properties.SkillsProperty(self.character)
+            self._skills[skill_name] = skills_property.get_skill_factor(skill_name)
+        return self._skills[skill_name]
 
 
 class InputField:
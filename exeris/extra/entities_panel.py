@@ -0,0 +1,124 @@
+# Versioning service for the contents of entities shown in the entities panel. Should be referenced directly.
+# Contents version of an entity is bumped when anything gets in or out of it or when any of its direct children
+# (their states, properties or observed names) is changed, which includes creation of an activity.
+# An entity without a parent (e.g. RootLocation) bumps its own contents version when it's changed.
+# After the outermost transaction is commited successfully all sids having the contents of the entity expanded
+# are notified, so they can pull only the rows that have changed.
+# Changes are collected in `session.info`. In case of rollback of a savepoint the changes collected before it
+# are restored and in case of rollback of the whole transaction all the collected changes are discarded
+
+import itertools
+import weakref
+
+import sqlalchemy
+from exeris.app import socketio, socketio_users, redis_db
+from exeris.core import main, models
+from exeris.core.main import db
+from flask_sqlalchemy import SignallingSession
+
+VERSION_KEY_PREFIX = "entity_contents_version:"
+VERSION_TTL = 24 * 60 * 60  # in seconds
+
+CHANGED_PARENT_IDS_KEY = "entities_panel_changed_parent_ids"
+SNAPSHOTS_KEY = "entities_panel_snapshots"
+
+
+def get_contents_version(entity_id):
+    version = redis_db.get(VERSION_KEY_PREFIX + str(entity_id))
+    return int(version) if version else 0
+
+
+def get_info_versions(entities):
+    """
+    Info about an entity shown in the panel depends on the entity itself (its version is the contents version of
+    its parent or its own contents version if it has no parent) and on its contents (e.g. if it can be expanded).
+    :return: list of versions of the info about the entities, retrieved with a single MGET
+    """
+    if not entities:
+        return []
+    parent_ids = [entity.parent_entity_id for entity in entities]
+    keys = [VERSION_KEY_PREFIX + str(entity_id) for entity_id in parent_ids + models.ids(entities)]
+    versions = [int(version) if version else 0 for version in redis_db.mget(keys)]
+    parent_versions, own_versions = versions[:len(entities)], versions[len(entities):]
+    return ["{}:{}:{}".format(parent_id, parent_version, own_version)
+            for parent_id, parent_version, own_version in zip(parent_ids, parent_versions, own_versions)]
+
+
+def _get_parent_ids_of_changed(obj):
+    if isinstance(obj, models.Entity):
+        parent_history = sqlalchemy.inspect(obj).attrs.parent_entity.history
+        old_and_new_parents = itertools.chain(*parent_history)
+        return [_get_id_of_parent_or_itself(obj)] + [parent.id for parent in old_and_new_parents if parent is not None]
+    if isinstance(obj, models.EntityProperty) and obj.entity is not None:
+        return [_get_id_of_parent_or_itself(obj.entity)]
+    if isinstance(obj, models.ObservedName) and obj.target is not None:
+        return [_get_id_of_parent_or_itself(obj.target)]
+    return []
+
+
+def _get_id_of_parent_or_itself(entity):
+    return entity.parent_entity_id if entity.parent_entity_id is not None else entity.id
+
+
+def _get_changed_parent_ids(session):
+    return session.info.setdefault(CHANGED_PARENT_IDS_KEY, set())
+
+
+def mark_contents_changed(parent_ids):
+    _get_changed_parent_ids(db.session).update(parent_ids)
+
+
+@sqlalchemy.event.listens_for(SignallingSession, 'before_flush')
+def collect_before_flush(session, flush_context, instances):
+    changed_objects = itertools.chain(session.new, session.deleted,
+                                      [obj for obj in session.dirty if session.is_modified(obj)])
+    changed_parent_ids = _get_changed_parent_ids(session)
+    for obj in changed_objects:
+        changed_parent_ids.update(parent_id for parent_id in _get_parent_ids_of_changed(obj)
+                                  if parent_id is not None)
+
+
+@sqlalchemy.event.listens_for(SignallingSession, 'after_transaction_create')
+def take_snapshot_on_savepoint(session, transaction):
+    if transaction.nested:
+        snapshots = session.info.setdefault(SNAPSHOTS_KEY, weakref.WeakKeyDictionary())
+        snapshots[transaction] = set(_get_changed_parent_ids(session))
+
+
+@sqlalchemy.event.listens_for(SignallingSession, 'after_commit')
+def notify_after_commit(session):
+    if session.transaction is not None and session.transaction.nested:
+        return  # changes are not visible to the other sessions until the outermost transaction is committed
+    changed_parent_ids = _get_changed_parent_ids(session)
+    if not changed_parent_ids:
+        return
+    parent_ids = list(changed_parent_ids)
+    changed_parent_ids.clear()
+
+    pipe = redis_db.pipeline()
+    for parent_id in parent_ids:
+        pipe.incr(VERSION_KEY_PREFIX + str(parent_id))
+        pipe.expire(VERSION_KEY_PREFIX + str(parent_id), VERSION_TTL)
+    versions = pipe.execute()[::2]
+
+    sids_by_parent_id = socketio_users.get_all_by_open_entity_ids(parent_ids)
+    all_sids = set(itertools.chain(*sids_by_parent_id.values()))
+    if not all_sids:
+        return
+
+    character_id_by_sid = socketio_users.get_character_ids_by_sids(all_sids)
+    for parent_id, version in zip(parent_ids, versions):
+        for sid in sids_by_parent_id[parent_id]:
+            if character_id_by_sid[sid] is None:
+                continue
+            socketio.emit("entities.contents_changed", (main.encode(parent_id, character_id_by_sid[sid]), version),
+                          room=sid)
+
+
+@sqlalchemy.event.listens_for(SignallingSession, 'after_soft_rollback')
+def restore_after_rollback(session, previous_transaction):
+    snapshots = session.info.get(SNAPSHOTS_KEY, {})
+    if previous_transaction.nested and previous_transaction in snapshots:
+        session.info[CHANGED_PARENT_IDS_KEY] = snapshots.pop(previous_transaction)
+    elif previous_transaction.parent is None:
+        _get_changed_parent_ids(session).clear()
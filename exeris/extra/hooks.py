@@ -1,11 +1,6 @@
-import exeris
-from exeris.app import app
-from exeris.core import main, actions, models, util
+from exeris.core import main, actions, models
 from exeris.core.properties_base import P
-from exeris.extra import notifications_service
-from exeris.core.i18n import create_pyslate
-from pyslate.backends import postgres_backend
-import psycopg2
+from exeris.extra import notifications_service, entities_panel  # entities_panel listens to the session changes
 
 
 @main.hook(main.Hooks.DAMAGE_EXCEEDED)
@@ -27,37 +22,23 @@ def on_root_location_contents_reduced(entity):
         entity.remove()
 
 
-@main.hook(main.Hooks.NEW_EVENT)
-def on_new_event(event_observer):
-    observer = event_observer.observer
-    event = event_observer.event
+@main.hook(main.Hooks.ENTITIES_MOVED)
+def on_entities_moved(entity_ids, source, destination):
+    parent_ids = [parent.id for parent in (source, destination) if parent is not None]
+    actions.ActivitySteadyState.mark_entities_changed(entity_ids + parent_ids)
+    entities_panel.mark_contents_changed(parent_ids)
 
-    conn = psycopg2.connect(app.config["SQLALCHEMY_DATABASE_URI"])
-    pyslate = create_pyslate(observer.language, backend=postgres_backend.PostgresBackend(conn, "translations"),
-                             character=observer)
 
-    for sid in exeris.app.socketio_users.get_all_by_character_id(observer.id):
-        notifications_service.add_event_to_send(sid, event.id,
-                                                pyslate.t("game_date", game_date=event.date) + ": " +
-                                                pyslate.t(event.type_name, html=True, **event.params))
+@main.hook(main.Hooks.NEW_EVENT)
+def on_new_event(event_observer):
+    notifications_service.add_event_to_send(event_observer.observer, event_observer.event)
 
 
 @main.hook(main.Hooks.NEW_CHARACTER_NOTIFICATION)
 def on_new_notification(character, notification):
-    conn = psycopg2.connect(app.config["SQLALCHEMY_DATABASE_URI"])
-    pyslate = create_pyslate(character.language, backend=postgres_backend.PostgresBackend(conn, "translations"),
-                             character=character)
-
-    for sid in exeris.app.socketio_users.get_all_by_character_id(character.id):
-        notification_info = util.serialize_notifications([notification], pyslate)[0]
-        notifications_service.add_notification_to_send(sid, notification_info)
+    notifications_service.add_notification_to_send(character, notification)
 
 
 @main.hook(main.Hooks.NEW_PLAYER_NOTIFICATION)
 def on_new_player_notification(player, notification):
-    conn = psycopg2.connect(app.config["SQLALCHEMY_DATABASE_URI"])
-    pyslate = create_pyslate(player.language, backend=postgres_backend.PostgresBackend(conn, "translations"))
-
-    for sid in exeris.app.socketio_users.get_all_by_player_id(player.id):
-        notification_info = util.serialize_notifications([notification], pyslate)[0]
-        notifications_service.add_notification_to_send(sid, notification_info)
+    notifications_service.add_notification_to_send(player, notification)
@@ -1,37 +1,118 @@
 # Notification and in-game event queue service. Should be referenced directly.
 # It queues all pending notifications and events to send them to the client through socketio
 # if and only if the transaction is commited successfully.
+# Just before the commit the sids of all recipients are retrieved at once and the texts are translated
+# only for the recipients who are connected. Then all the payloads for a single sid are sent as one message.
 # In case of rollback all the queued data is discarded
 
+import collections
+
+import psycopg2
 import sqlalchemy
-from exeris.app import socketio
+from exeris.app import app, socketio, socketio_users
+from exeris.core import models, util
+from exeris.core.i18n import create_pyslate
 from flask_sqlalchemy import SignallingSession
+from pyslate.backends import postgres_backend
+
+_pending_events = []  # (observer, event) pairs
+_pending_notifications = []  # (recipient, notification) pairs, recipient is a Character or a Player
+
+_notifications_to_send = collections.defaultdict(list)  # sid -> list of serialized notifications
+_events_to_send = collections.defaultdict(list)  # sid -> list of (event_id, event_text)
+
+
+def add_event_to_send(observer, event):
+    _pending_events.append((observer, event))
+
+
+def add_notification_to_send(recipient, notification):
+    _pending_notifications.append((recipient, notification))
+
+
+def _clear_all():
+    _pending_events.clear()
+    _pending_notifications.clear()
+    _notifications_to_send.clear()
+    _events_to_send.clear()
 
-_notifications_to_send = []
-_events_to_send = []
 
+@sqlalchemy.event.listens_for(SignallingSession, 'before_commit')
+def prepare_before_commit(session):
+    if not _pending_events and not _pending_notifications:
+        return
 
-def add_event_to_send(sid, event_id, event_text):
-    _events_to_send.append((sid, event_id, event_text))
+    session.flush()  # ids of new events and notifications are needed
 
+    character_ids = {observer.id for observer, event in _pending_events}
+    character_ids.update(recipient.id for recipient, notification in _pending_notifications
+                         if isinstance(recipient, models.Character))
+    player_ids = {recipient.id for recipient, notification in _pending_notifications
+                  if isinstance(recipient, models.Player)}
 
-def add_notification_to_send(sid, notification):
-    _notifications_to_send.append((sid, notification))
+    sids_by_character_id = socketio_users.get_all_by_character_ids(character_ids)
+    sids_by_player_id = socketio_users.get_all_by_player_ids(player_ids)
+
+    def sids_of(recipient):
+        if isinstance(recipient, models.Character):
+            return sids_by_character_id.get(recipient.id, [])
+        return sids_by_player_id.get(recipient.id, [])
+
+    # names known by all the connected observers are loaded at once for the translation of events
+    models.ObservedNamesCache.load_names_known_by(
+        {observer for observer, event in _pending_events if sids_of(observer)})
+
+    conn = None
+    pyslates = {}
+
+    def pyslate_for(recipient):
+        nonlocal conn
+        if recipient not in pyslates:
+            if conn is None:
+                conn = psycopg2.connect(app.config["SQLALCHEMY_DATABASE_URI"])
+            character = recipient if isinstance(recipient, models.Character) else None
+            pyslates[recipient] = create_pyslate(recipient.language,
+                                                 backend=postgres_backend.PostgresBackend(conn, "translations"),
+                                                 character=character)
+        return pyslates[recipient]
+
+    try:
+        for observer, event in _pending_events:
+            sids = sids_of(observer)
+            if not sids:
+                continue
+            pyslate = pyslate_for(observer)
+            event_text = pyslate.t("game_date", game_date=event.date) + ": " + \
+                         pyslate.t(event.type_name, html=True, **event.params)
+            for sid in sids:
+                _events_to_send[sid].append((event.id, event_text))
+
+        for recipient, notification in _pending_notifications:
+            sids = sids_of(recipient)
+            if not sids:
+                continue
+            notification_info = util.serialize_notifications([notification], pyslate_for(recipient))[0]
+            for sid in sids:
+                _notifications_to_send[sid].append(notification_info)
+    finally:
+        if conn is not None:
+            conn.close()
+
+    _pending_events.clear()
+    _pending_notifications.clear()
 
 
 @sqlalchemy.event.listens_for(SignallingSession, 'after_commit')
 def send_after_commit(session):
-    for new_event in _events_to_send:
-        socketio.emit("character.new_event", new_event[1:], room=new_event[0])
+    for sid, new_events in _events_to_send.items():
+        socketio.emit("character.new_events", (new_events,), room=sid)
 
-    for new_notification in _notifications_to_send:
-        socketio.emit("player.new_notification", (new_notification[1],), room=new_notification[0])
+    for sid, new_notifications in _notifications_to_send.items():
+        socketio.emit("player.new_notifications", (new_notifications,), room=sid)
 
-    _notifications_to_send.clear()
-    _events_to_send.clear()
+    _clear_all()
 
 
 @sqlalchemy.event.listens_for(SignallingSession, 'after_rollback')
 def send_after_rollback(session):
-    _notifications_to_send.clear()
-    _events_to_send.clear()
+    _clear_all()
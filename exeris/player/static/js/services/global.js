@@ -4,7 +4,7 @@ FRAGMENTS.player = (function($, socket) {
         socket.emit("player.pull_notifications_initial");
     });
 
-    socket.on("player.new_notification", function(notification) {
+    var show_notification = function(notification) {
 
         // hide previous version of this notification
         $("[href='show_notification/" + notification.notification_id + "']").closest("div.alert").remove();
@@ -12,6 +12,14 @@ FRAGMENTS.player = (function($, socket) {
         var title = notification.title + (notification.count > 1 ? " (" + notification.count + "x)" : "");
         var notification_id = notification.notification_id;
         $.publish("global/show_notification", title, notification_id, notification.easy_close);
+    };
+
+    socket.on("player.new_notification", show_notification);
+
+    socket.on("player.new_notifications", function(notifications) {
+        for (var i = 0; i < notifications.length; i++) {
+            show_notification(notifications[i]);
+        }
     });
 
 })(jQuery, socket);
@@ -82,6 +82,30 @@ data = {
     "event_retreat_from_combat_doer": {
         "en": "You retreat from combat."
     },
+    "event_combat_round_summary": {
+        "en": "You see the combat go on. ${combat_log}"
+    },
+    "tp_combat_log_hit": {
+        "en": "${doer:entity_info} hits ${target:entity_info}.",
+    },
+    "tp_combat_log_hit_doer": {
+        "en": "You hit ${target:entity_info}.",
+    },
+    "tp_combat_log_hit_target": {
+        "en": "You are hit by ${doer:entity_info}.",
+    },
+    "tp_combat_log_retreat": {
+        "en": "${doer:entity_info} retreats from combat.",
+    },
+    "tp_combat_log_retreat_doer": {
+        "en": "You retreat from combat.",
+    },
+    "tp_combat_log_withdrawal": {
+        "en": "${doer:entity_info} is no longer in combat.",
+    },
+    "tp_combat_log_withdrawal_doer": {
+        "en": "You are no longer in combat.",
+    },
     "event_take_item_doer": {
         "en": "You take ${item:item_info}."
     },
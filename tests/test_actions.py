@@ -88,6 +88,63 @@ class ActionsSerializationTest(TestCase):
             ]}, serialized[1])
 
 
+    def test_deserialized_actions_cache(self):
+        rl = RootLocation(Point(1, 1), 35)
+        character = util.create_character("abc", rl, util.create_player("AHA"))
+        hammer_type = ItemType("hammer", 30)
+        hammer = Item(hammer_type, character)
+        db.session.add_all([hammer_type, hammer, rl])
+        db.session.flush()
+
+        intent = Intent(character, main.Intents.WORK, 1, hammer,
+                        deferred.serialize(RemoveItemAction(hammer, False)))
+        db.session.add(intent)
+        db.session.flush()
+
+        cache = deferred.DeserializedActionsCache()
+        action = cache.get_action(intent)
+        self.assertEqual(hammer, action.item)
+        self.assertIs(action, cache.get_action(intent))  # unchanged intent reuses the same action
+        self.assertFalse(cache.is_changed(intent, action))
+
+        action.gracefully = True
+        self.assertTrue(cache.is_changed(intent, action))
+        cache.update(intent, action)
+        self.assertEqual({"item": hammer.id, "gracefully": True}, intent.serialized_action[1])
+        self.assertIs(action, cache.get_action(intent))
+
+        intent.serialized_action = deferred.serialize(RemoveItemAction(hammer, False))
+        self.assertIsNot(action, cache.get_action(intent))  # intent changed by somebody else
+
+        cache.retain_only([])
+        self.assertIsNot(action, cache.get_action(intent))
+
+
+    def test_call_many_loads_referenced_entities_at_once(self):
+        hammer_type = ItemType("hammer", 30)
+        hammers = [Item(hammer_type, None) for _ in range(3)]
+        db.session.add_all([hammer_type] + hammers)
+        db.session.flush()
+
+        serialized_actions = [deferred.serialize(RemoveItemAction(hammer, False)) for hammer in hammers]
+        hammer_ids = [hammer.id for hammer in hammers]
+        db.session.expire_all()
+
+        executed_queries = []
+
+        def count_query(*args):
+            executed_queries.append(args)
+
+        sql.event.listen(db.engine, "before_cursor_execute", count_query)
+        try:
+            deserialized_actions = deferred.call_many(serialized_actions)
+        finally:
+            sql.event.remove(db.engine, "before_cursor_execute", count_query)
+
+        self.assertEqual(1, len(executed_queries))
+        self.assertEqual(hammer_ids, [action.item.id for action in deserialized_actions])
+
+
 class FinishActivityActionsTest(TestCase):
     create_app = util.set_up_app_with_database
     tearDown = util.tear_down_rollback
@@ -984,6 +1041,39 @@ class CharacterActionsTest(TestCase):
         # 19 would be better, but 18 is because of precision of floating point arithmetics
         self.assertIn(grass_in_basket.amount, [18, 19])
 
+    def test_animals_eat_food_from_shared_surroundings(self):
+        self._set_up_entities_for_animal_eating()
+        grass_type = ItemType.by_name("grass")
+        herbivore_group = TypeGroup.by_name("herbivore")
+        rl = RootLocation.query.one()
+
+        sheep_type = ItemType("sheep", 100)
+        sheep_type.properties.append(EntityTypeProperty(P.ANIMAL))
+        herbivore_group.add_to_group(sheep_type)
+        first_sheep = Item(sheep_type, rl)
+        second_sheep = Item(sheep_type, rl)
+
+        basket_type = ItemType("basket", 100)
+        basket_type.properties.append(EntityTypeProperty(P.STORAGE))
+        basket = Item(basket_type, rl)
+        grass_in_basket = Item(grass_type, basket, amount=3)
+        db.session.add_all([sheep_type, first_sheep, second_sheep, basket_type, basket, grass_in_basket])
+
+        first_sheep.states[States.HUNGER] = 0.1
+        second_sheep.states[States.HUNGER] = 0.1
+
+        surroundings = actions.AnimalSurroundings(first_sheep)
+        self.assertIs(actions.AnimalSurroundings.get_group_key(second_sheep),
+                      actions.AnimalSurroundings.get_group_key(first_sheep))
+        AnimalEatingAction(first_sheep, surroundings).perform()
+        AnimalEatingAction(second_sheep, surroundings).perform()
+
+        # the first sheep has eaten 2 pieces, so only one was left for the other one
+        self.assertAlmostEqual(0, first_sheep.states[States.HUNGER])
+        self.assertAlmostEqual(0.1, second_sheep.states[States.HUNGER])
+        self.assertTrue(sql.inspect(grass_in_basket).deleted or grass_in_basket in db.session.deleted)
+        self.assertEqual([], surroundings.get_food_in_storages())
+
     def _set_up_entities_for_animal_eating(self):
         rl = RootLocation(Point(1, 1), 100)
         cow_type = LocationType("cow", 100)
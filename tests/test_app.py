@@ -41,4 +41,21 @@ class EncoderTest(TestCase):
             enc = main.encode(val)
             self.assertRaises(ValueError, main.decode, str(int(enc) + 1))
 
+    def test_codec_for_explicit_character(self):
+        g.character = self.character2
+        encoded = [main.encode(i, self.character1.id) for i in self.values]
+        g.character = self.character1
+        for val, enc in zip(self.values, encoded):
+            self.assertEqual(main.encode(val), enc)
+            self.assertEqual(main.decode(enc), val)
+
+    def test_codec_many(self):
+        g.character = self.character1
+        encoded = main.encode_many(self.values)
+        self.assertEqual([main.encode(val) for val in self.values], encoded)
+        self.assertEqual(list(self.values), main.decode_many(encoded))
+        self.assertEqual([], main.encode_many([]))
+
+        self.assertRaises(ValueError, main.decode_many, encoded[:2] + [str(int(encoded[2]) + 1)])
+
     tearDown = util.tear_down_rollback
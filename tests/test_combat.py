@@ -136,6 +136,21 @@ class CombatTest(TestCase):
             foe_to_hit_action = combat.get_hit_target(roman1_combat_action, [gaul_on_a_ship_combat_action])
             self.assertEqual(gaul_on_a_ship_combat_action, foe_to_hit_action)
 
+        # the same foes are found when ranges are computed once for the whole combat round
+        all_combat_intents = [roman1_combat, roman2_combat, roman3_combat,
+                              gaul1_combat, gaul2_combat, gaul3_combat, gaul_on_a_ship_combat]
+        combat_round = combat.CombatRound(all_combat_intents, deferred.call_many(
+            [intent.serialized_action for intent in all_combat_intents]))
+
+        combat_potential_foes_actions = combat.get_combat_actions_of_visible_foes(roman1, combat_entity, combat_round)
+        combat_potential_foes = [action.executor for action in combat_potential_foes_actions]
+        self.assertCountEqual([gaul1, gaul2, gaul_on_a_ship], combat_potential_foes)
+
+        self.assertTrue(combat_round.is_visible(roman1, roman2))
+        self.assertFalse(combat_round.is_visible(roman1, gaul3))
+        self.assertTrue(combat_round.is_reachable_in_melee(roman1, gaul1))
+        self.assertFalse(combat_round.is_reachable_in_melee(roman1, gaul_on_a_ship))
+
     def test_combat_process(self):
         util.initialize_date()
         rl = RootLocation(Point(1, 1), 100)
@@ -184,6 +199,13 @@ class CombatTest(TestCase):
 
             # one of two romans should be hit
             self.assertAlmostEqual(0.1, roman1.damage + roman2.damage)
+
+            # all hits of the round are shown in a single event
+            summary_event = models.Event.query.filter_by(type_name=main.PartialEvents.COMBAT_ROUND_SUMMARY).one()
+            self.assertEqual(3, len(summary_event.params["hits"]))
+            self.assertCountEqual([roman1, roman2, gaul1], summary_event.observers)
+            self.assertEqual(0, models.Event.query.filter(
+                models.Event.type_name.startswith(main.Events.HIT_TARGET_IN_COMBAT)).count())
         CombatProcess.RETREAT_CHANCE = 1.0  # retreat is always successful
         with patch("exeris.core.actions.FightInCombatAction.calculate_hit_damage", new=lambda x, y: 0.01):
             with roman1_combat as roman1_combat_action:
@@ -211,6 +233,93 @@ class CombatTest(TestCase):
             self.assertEqual([], Intent.query.all())
             self.assertEqual(0, Combat.query.count())
 
+    def test_combat_round_summary_contains_only_entries_of_visible_doers(self):
+        util.initialize_date()
+        rl_roman = RootLocation(Point(10, 10), 11)
+        rl_gaul = RootLocation(Point(16, 10), 11)
+        rl_far_away = RootLocation(Point(25, 10), 11)
+        db.session.add_all([rl_roman, rl_gaul, rl_far_away])
+
+        grass_type = TerrainType("grassland")
+        TypeGroup.by_name(main.Types.LAND_TERRAIN).add_to_group(grass_type)
+        grass_poly = Polygon([(0, 5), (0, 15), (30, 15), (30, 5)])
+        grass_terrain = TerrainArea(grass_poly, grass_type)
+        grass_vis_area = PropertyArea(models.AREA_KIND_VISIBILITY, 1, 1, grass_poly, grass_terrain)
+        db.session.add_all([grass_type, grass_terrain, grass_vis_area])
+
+        roman1 = util.create_character("roman1", rl_roman, util.create_player("abc1"))
+        gaul1 = util.create_character("gaul1", rl_gaul, util.create_player("abc21"))
+        observer_far_away = util.create_character("observer", rl_far_away, util.create_player("abc31"))
+
+        combat_entity = Combat()
+        db.session.add(combat_entity)
+        db.session.flush()
+
+        roman1_combat = Intent(roman1, main.Intents.COMBAT, 1, combat_entity,
+                               deferred.serialize(FightInCombatAction(roman1, combat_entity, combat.SIDE_ATTACKER,
+                                                                      combat.STANCE_OFFENSIVE)))
+        gaul1_combat = Intent(gaul1, main.Intents.COMBAT, 1, combat_entity,
+                              deferred.serialize(FightInCombatAction(gaul1, combat_entity, combat.SIDE_DEFENDER,
+                                                                     combat.STANCE_OFFENSIVE)))
+        db.session.add_all([roman1_combat, gaul1_combat])
+        db.session.flush()
+
+        fighter_intents = [roman1_combat, gaul1_combat]
+        combat_round = combat.CombatRound(fighter_intents,
+                                          [deferred.call(intent.serialized_action) for intent in fighter_intents])
+        combat_round.record_hit(roman1, gaul1)
+        combat_round.record_withdrawal(gaul1)
+        combat_round.create_summary_event()
+
+        summary_events = models.Event.query.filter_by(type_name=main.PartialEvents.COMBAT_ROUND_SUMMARY).all()
+        self.assertEqual(2, len(summary_events))
+        full_summary_event = [event for event in summary_events if event.params["hits"]][0]
+        self.assertCountEqual([roman1, gaul1], full_summary_event.observers)
+        self.assertEqual([gaul1.pyslatize()], full_summary_event.params["withdrawals"])
+
+        # the far away observer can see only gaul1, so doesn't know about the hit
+        partial_summary_event = [event for event in summary_events if not event.params["hits"]][0]
+        self.assertEqual([observer_far_away], partial_summary_event.observers)
+        self.assertEqual([gaul1.pyslatize()], partial_summary_event.params["withdrawals"])
+
+    def test_stance_changed_by_auxiliary_action_is_used_in_the_same_round(self):
+        util.initialize_date()
+        rl = RootLocation(Point(1, 1), 100)
+
+        roman1 = util.create_character("roman1", rl, util.create_player("abc1"))
+        gaul1 = util.create_character("gaul1", rl, util.create_player("abc21"))
+
+        combat_entity = Combat()
+        db.session.add(combat_entity)
+        db.session.flush()
+
+        roman1_combat = Intent(roman1, main.Intents.COMBAT, 1, combat_entity,
+                               deferred.serialize(FightInCombatAction(roman1, combat_entity, combat.SIDE_ATTACKER,
+                                                                      combat.STANCE_OFFENSIVE)))
+        gaul1_combat = Intent(gaul1, main.Intents.COMBAT, 1, combat_entity,
+                              deferred.serialize(FightInCombatAction(gaul1, combat_entity, combat.SIDE_DEFENDER,
+                                                                     combat.STANCE_OFFENSIVE)))
+        gaul1_auxiliary_action = Intent(gaul1, main.Intents.COMBAT_AUXILIARY_ACTION, 1, None,
+                                        deferred.serialize(ChangeCombatStanceAction(gaul1, combat.STANCE_DEFENSIVE)))
+        db.session.add_all([roman1_combat, gaul1_combat, gaul1_auxiliary_action])
+        db.session.flush()
+
+        fighter_intents = [gaul1_combat, roman1_combat]
+        fighter_combat_actions = [deferred.call(intent.serialized_action) for intent in fighter_intents]
+        combat_round = combat.CombatRound(fighter_intents, fighter_combat_actions)
+        gaul1_combat_action, roman1_combat_action = fighter_combat_actions
+        for combat_action in fighter_combat_actions:
+            combat_action.combat_round = combat_round
+
+        gaul1_combat_action.perform_first_auxiliary_action()
+
+        self.assertEqual(0, Intent.query.filter_by(type=main.Intents.COMBAT_AUXILIARY_ACTION).count())
+        # roman1 fighting later in the round sees the new stance of gaul1
+        gaul1_combat_action = combat_round.get_combat_action(gaul1)
+        self.assertEqual(combat.STANCE_DEFENSIVE, gaul1_combat_action.stance)
+        self.assertEqual(combat_round, gaul1_combat_action.combat_round)
+        self.assertAlmostEqual(0.1 * 1.5 / 2, roman1_combat_action.calculate_hit_damage(gaul1_combat_action))
+
     def test_combat_process_for_animals(self):
         util.initialize_date()
         rl = RootLocation(Point(1, 1), 100)
@@ -1,6 +1,7 @@
 import string
 from unittest.mock import patch
 
+import sqlalchemy
 from flask_testing import TestCase
 from shapely.geometry import Point, Polygon
 
@@ -27,6 +28,20 @@ class GameDateTest(TestCase):
             now = GameDate.now()
             self.assertAlmostEqual(200, now.game_timestamp)
 
+        # checkpoint is loaded only once per transaction
+        executed_queries = []
+
+        def count_query(*args):
+            executed_queries.append(args)
+
+        sqlalchemy.event.listen(db.engine, "before_cursor_execute", count_query)
+        try:
+            with patch("exeris.core.general.GameDate._get_timestamp", new=lambda: 1150):
+                self.assertAlmostEqual(250, GameDate.now().game_timestamp)
+        finally:
+            sqlalchemy.event.remove(db.engine, "before_cursor_execute", count_query)
+        self.assertEqual(0, len(executed_queries))
+
     def test_timestamp_to_date_conversion(self):
         date = GameDate(3600 * 48 * 14 * 5 + 3600 * 48 * 3 + 3600 * 30 + 60 * 17 + 33)
         # 5-3-11:17:33
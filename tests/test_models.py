@@ -3,13 +3,13 @@ from flask_testing import TestCase
 from geoalchemy2.shape import from_shape
 from shapely.geometry import Point
 
-from exeris.core import actions, properties_base, main
+from exeris.core import actions, properties_base, main, models
 from exeris.core.general import GameDate
 from exeris.core.main import db, Types
 from exeris.core.map_data import MAP_HEIGHT, MAP_WIDTH
 from exeris.core.models import RootLocation, Location, Item, EntityProperty, EntityTypeProperty, \
     ItemType, Passage, TypeGroup, TypeGroupElement, EntityRecipe, BuildMenuCategory, LocationType, Character, \
-    Entity, Activity, SkillType, PassageType
+    Entity, Activity, SkillType, PassageType, Sequences, prefetched_properties
 from exeris.core.properties_base import P
 from exeris.core.recipes import ActivityFactory, RecipeListProducer
 from tests import util
@@ -186,6 +186,40 @@ class EntityTest(TestCase):
 
         self.assertDictEqual({"very": True, "feel": "blue", "cookies": 0}, item.get_property("Sad"))
 
+    def test_prefetched_properties(self):
+        item_type = ItemType("potato", 1, stackable=True)
+
+        item = Item(item_type, None, weight=100)
+        item_without_properties = Item(item_type, None, weight=100)
+        item.type.properties.append(EntityTypeProperty("Sad", {"very": False, "cookies": 0}))
+        item.properties.append(EntityProperty("Sad", {"very": True, "feel": "blue"}))
+
+        db.session.add_all([item_type, item, item_without_properties])
+        db.session.flush()
+
+        with prefetched_properties([item, item_without_properties]):
+            executed_queries = []
+
+            def count_query(*args):
+                executed_queries.append(args)
+
+            sqlalchemy.event.listen(db.engine, "before_cursor_execute", count_query)
+            try:
+                self.assertDictEqual({"very": True, "feel": "blue", "cookies": 0}, item.get_property("Sad"))
+                self.assertTrue(item.has_property("Sad", very=True))
+                self.assertDictEqual({"very": False, "cookies": 0}, item_without_properties.get_property("Sad"))
+                self.assertIsNone(item_without_properties.get_entity_property("Sad"))
+                self.assertFalse(item.has_property("Happy"))
+            finally:
+                sqlalchemy.event.remove(db.engine, "before_cursor_execute", count_query)
+            self.assertEqual([], executed_queries)
+
+            item.alter_property("Happy", {"feel": "yellow"})
+            self.assertDictEqual({"feel": "yellow"}, item.get_property("Happy"))
+
+        self.assertIsNone(item._prefetched_properties)
+        self.assertIsNone(item_without_properties._prefetched_properties)
+
     def test_has_property_used_in_query(self):
         rl = RootLocation(Point(1, 2), 31)
         item_type = ItemType("hammer", 1)
@@ -283,6 +317,42 @@ class EntityTest(TestCase):
         char.name = "James"
         self.assertEqual("James", char.name)
 
+    def test_observed_names_cache(self):
+        rl = RootLocation(Point(1, 1), 123)
+        observer = util.create_character("observer", rl, util.create_player("abc1"))
+        other_char = util.create_character("other", rl, util.create_player("abc2"))
+        unnamed_char = util.create_character("unnamed", rl, util.create_player("abc3"))
+        db.session.add(models.ObservedName(observer, other_char, "Bob"))
+        db.session.flush()
+
+        models.ObservedNamesCache.load_names_known_by([observer])
+
+        executed_queries = []
+
+        def count_query(*args):
+            executed_queries.append(args)
+
+        sqlalchemy.event.listen(db.engine, "before_cursor_execute", count_query)
+        try:
+            self.assertEqual("Bob", models.ObservedNamesCache.get_name(observer.id, other_char.id))
+            self.assertIsNone(models.ObservedNamesCache.get_name(observer.id, unnamed_char.id))
+            self.assertEqual("observer", observer.name)
+        finally:
+            sqlalchemy.event.remove(db.engine, "before_cursor_execute", count_query)
+        self.assertEqual([], executed_queries)
+
+        # renaming invalidates the cache
+        models.ObservedName.query.filter_by(observer=observer, target=other_char).one().name = "Robert"
+        self.assertEqual("Robert", models.ObservedNamesCache.get_name(observer.id, other_char.id))
+
+        # name cached after a rename is forgotten when the rename is rolled back
+        db.session.flush()
+        db.session.begin_nested()
+        models.ObservedName.query.filter_by(observer=observer, target=other_char).one().name = "Rob"
+        self.assertEqual("Rob", models.ObservedNamesCache.get_name(observer.id, other_char.id))
+        db.session.rollback()
+        self.assertEqual("Robert", models.ObservedNamesCache.get_name(observer.id, other_char.id))
+
     def test_removal_of_entity_with_activity(self):
         util.initialize_date()
 
@@ -304,6 +374,29 @@ class EntityTest(TestCase):
 
         activity.remove()
 
+    def test_removal_of_item_moves_its_contents_outside(self):
+        rl = RootLocation(Point(1, 1), 123)
+        box_type = ItemType("box", 300)
+        stone_type = ItemType("stone", 10, stackable=True)
+        box = Item(box_type, rl)
+        stones = Item(stone_type, box, amount=5)
+        pebbles = Item(stone_type, box, amount=2)
+
+        db.session.add_all([rl, box_type, stone_type, box, stones, pebbles])
+        db.session.flush()
+
+        self.assertFalse(box.is_empty())
+        self.assertEqual(70, box.contents_weight())
+
+        box.remove()
+
+        # entities already loaded into the session see the new parent
+        self.assertEqual(rl, stones.being_in)
+        self.assertEqual(rl, pebbles.being_in)
+        self.assertEqual(70, rl.contents_weight())
+        self.assertCountEqual([stones, pebbles], Item.query.filter(Item.is_in(rl)).all())
+        self.assertEqual([], models.rebuild_contents_weights())
+
     def test_persistence_of_normalized_states(self):
         """
         Test two normalized states: tiredness and damage (because it can be accessed through a hybrid property)
@@ -350,6 +443,45 @@ class EntityTest(TestCase):
         # a basket with (a hammer with an activity with 7 used stones) and 17 stones
         self.assertEqual(70 + 365 + 10 * 17, basket.contents_weight())
 
+        # contents weight is updated when anything inside is moved, changed or removed
+        stone.being_in = initiator
+        self.assertEqual(70 + 365, basket.contents_weight())
+        self.assertEqual(10 * 17, initiator.contents_weight())
+        self.assertEqual(1000 + 500 + 70 + 365 + 10 * 17, rl.contents_weight())
+
+        used_stone.amount = 3
+        self.assertEqual(30, hammer.contents_weight())
+        self.assertEqual(30 + 365, basket.contents_weight())
+
+        used_stone.remove()
+        self.assertEqual(0, hammer.contents_weight())
+        self.assertEqual(365, basket.contents_weight())
+        self.assertEqual(1000 + 500 + 365 + 10 * 17, rl.contents_weight())
+
+        # like Entity.is_in, locations inside are not a part of the contents (neither is anything inside of them)
+        building_type = LocationType("building", 2000)
+        building = Location(rl, building_type)
+        stone_in_building = Item(stone_type, building, amount=5)
+        db.session.add_all([building_type, building, stone_in_building])
+        self.assertEqual(1000 + 500 + 365 + 10 * 17, rl.contents_weight())
+        self.assertEqual(50, building.contents_weight())
+
+        # stored values are the same as computed by the recursive query
+        self.assertEqual([], models.rebuild_contents_weights())
+
+        db.session.execute(Entity.__table__.update().where(Entity.__table__.c.id == basket.id)
+                           .values(contents_weight=0))
+        self.assertEqual([basket.id], models.rebuild_contents_weights())
+        self.assertEqual(365, basket.contents_weight())
+
+        # the difference is added by the UPDATE statement, so a change made by another transaction is not overwritten
+        db.session.execute(Entity.__table__.update().where(Entity.__table__.c.id == basket.id)
+                           .values(contents_weight=Entity.__table__.c.contents_weight + 1000))
+        stone.being_in = basket
+        self.assertEqual(365 + 10 * 17, basket.contents_weight())
+        db.session.flush()
+        self.assertEqual(1000 + 365 + 10 * 17, basket.contents_weight())
+
 
 class RootLocationTest(TestCase):
     create_app = util.set_up_app_with_database
@@ -734,6 +866,38 @@ class GroupTest(TestCase):
         selectable_entities = factory.get_selectable_entities(recipe, initiator)
         self.assertCountEqual([anvil1, anvil2], selectable_entities)
 
+    def test_get_selectable_entities_filtered_by_properties(self):
+        rl = RootLocation(Point(1, 1), 32)
+        building_type = LocationType("building", 100)
+        building = Location(rl, building_type)
+        chest_type = ItemType("chest", 100, portable=False)
+        chest_type.properties.append(EntityTypeProperty("Storage", {"can_store": True}))
+        tools_category = BuildMenuCategory("tools")
+        db.session.add_all([rl, building_type, building, chest_type, tools_category])
+
+        initiator = util.create_character("John", rl, util.create_player("AAA"))
+        open_chest = Item(chest_type, rl)
+        locked_chest = Item(chest_type, rl)
+        locked_chest.properties.append(EntityProperty("Locked", {"value": True}))
+        chest_with_broken_lock = Item(chest_type, rl)
+        chest_with_broken_lock.properties.append(EntityProperty("Locked", {"value": False}))
+        chest_unable_to_store = Item(chest_type, rl)
+        chest_unable_to_store.properties.append(EntityProperty("Storage", {"can_store": False}))
+        db.session.add_all([open_chest, locked_chest, chest_with_broken_lock, chest_unable_to_store])
+
+        recipe = EntityRecipe("project_manufacturing", {}, {}, 11, tools_category,
+                              activity_container=["selected_entity", {"properties": {"Storage": {"can_store": True}},
+                                                                      "no_properties": {"Locked": {"value": True}}}])
+        db.session.add(recipe)
+
+        selectable_entities = ActivityFactory.get_selectable_entities(recipe, initiator)
+        self.assertCountEqual([open_chest, chest_with_broken_lock], selectable_entities)
+
+        recipe.activity_container = ["selected_entity", {"types": ["chest"]}]
+        selectable_entities = ActivityFactory.get_selectable_entities(recipe, initiator)
+        self.assertCountEqual([open_chest, locked_chest, chest_with_broken_lock, chest_unable_to_store],
+                              selectable_entities)
+
     def test_get_recipes_list(self):
         rl = RootLocation(Point(1, 1), 32)
         initiator = util.create_character("John", rl, util.create_player("AAA"))
@@ -761,6 +925,50 @@ class GroupTest(TestCase):
 
         self.assertEqual([available_recipe], recipe_list_producer.get_recipe_list())
 
+    def test_get_recipes_list_with_tools_and_location_types(self):
+        rl = RootLocation(Point(1, 1), 32)
+        initiator = util.create_character("John", rl, util.create_player("AAA"))
+
+        hammer_type = ItemType("hammer", 100)
+        axe_type = ItemType("axe", 100)
+        tools_group = TypeGroup("group_tools", stackable=False)
+        tools_group.add_to_group(hammer_type)
+        building_type = LocationType("building", 1000)
+
+        tools_category = BuildMenuCategory("tools")
+        db.session.add_all([rl, hammer_type, axe_type, tools_group, building_type, tools_category])
+        db.session.flush()
+
+        recipe_requiring_tool = EntityRecipe("project_manufacturing", {}, {"mandatory_tools": ["group_tools"]}, 11,
+                                             tools_category)
+        recipe_requiring_building = EntityRecipe("project_manufacturing", {}, {"location_types": ["building"]}, 11,
+                                                 tools_category)
+        recipe_requiring_outside = EntityRecipe("project_manufacturing", {},
+                                                {"location_types": [rl.type_name]}, 11, tools_category)
+        db.session.add_all([recipe_requiring_tool, recipe_requiring_building, recipe_requiring_outside])
+
+        recipe_list_producer = RecipeListProducer(initiator)
+        self.assertEqual([recipe_requiring_outside], recipe_list_producer.get_recipe_list())
+
+        axe = Item(axe_type, initiator)
+        db.session.add(axe)
+        self.assertEqual([recipe_requiring_outside], recipe_list_producer.get_recipe_list())
+
+        hammer = Item(hammer_type, initiator)
+        db.session.add(hammer)
+        self.assertEqual([recipe_requiring_tool, recipe_requiring_outside], recipe_list_producer.get_recipe_list())
+
+        # requirements changed without the session noticing it, like in another process
+        recipes_table = EntityRecipe.__table__
+        db.session.execute(recipes_table.update().where(recipes_table.c.id == recipe_requiring_building.id)
+                           .values(requirements={"location_types": [rl.type_name]}))
+        self.assertEqual([recipe_requiring_tool, recipe_requiring_outside], recipe_list_producer.get_recipe_list())
+
+        # version is incremented by the other process after it commits the change
+        db.engine.execute(Sequences.recipes_version_sequence)
+        self.assertEqual([recipe_requiring_tool, recipe_requiring_building, recipe_requiring_outside],
+                         recipe_list_producer.get_recipe_list())
+
     def test_perform_error_check_for_activity_from_recipe_creation(self):
         hammer_type = ItemType("hammer", 100)
 
@@ -8,7 +8,8 @@ from exeris.core import properties
 from exeris.core.actions import ActivityProgressProcess, EatingProcess, DecayProcess, \
     WorkProcess, EatAction, WorkOnActivityAction, TravelInDirectionAction, \
     CreateItemAction, ActivityProgress, StartControllingMovementAction, TravelToEntityAction, ControlMovementAction, \
-    AnimalsProcess
+    AnimalsProcess, PrefetchedEquipmentFinder, ActivityCompletionProcess, ActivitySteadyState, \
+    get_root_location_at_position
 from exeris.core.general import GameDate
 from exeris.core.main import db, Types
 from exeris.core.models import Activity, ItemType, RootLocation, Item, ScheduledTask, TypeGroup, EntityProperty, \
@@ -297,6 +298,69 @@ class SchedulerTravelTest(TestCase):
 
         work_process.process_travel_movement()
 
+    def test_move_root_locations_of_lone_entities_at_once(self):
+        rl1 = RootLocation(Point(2, 2), 10)
+        rl2 = RootLocation(Point(6, 6), 10)
+        cog_type = LocationType("cog", 1000)
+        cog_type.properties.append(EntityTypeProperty(P.MOBILE, {"inertiality": 0, "speed": 40}))
+        cog1 = Location(rl1, cog_type)
+        cog2 = Location(rl2, cog_type)
+
+        poly_grass = Polygon([(0, 0), (10, 0), (10, 10), (0, 10)])
+        land_terrain = TypeGroup.by_name(Types.LAND_TERRAIN)
+        grass_terrain = TerrainType("grassland")
+        land_terrain.add_to_group(grass_terrain)
+        grass = models.TerrainArea(poly_grass, grass_terrain)
+        land_traversability = models.PropertyArea(models.AREA_KIND_TRAVERSABILITY, 1, 1, poly_grass, grass)
+
+        db.session.add_all([rl1, rl2, cog_type, cog1, cog2, grass_terrain, land_terrain, grass, land_traversability])
+
+        properties.OptionalBeingMovedProperty(cog1).set_movement(2, 0)
+        properties.OptionalBeingMovedProperty(cog2).set_movement(2, math.radians(90))
+        db.session.flush()
+
+        executed_statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            executed_statements.append(statement)
+
+        sql.event.listen(db.engine, "before_cursor_execute", record_statement)
+        try:
+            WorkProcess(None).process_travel_movement()
+        finally:
+            sql.event.remove(db.engine, "before_cursor_execute", record_statement)
+
+        root_location_updates = [statement for statement in executed_statements
+                                 if statement.startswith("UPDATE root_locations")]
+        self.assertEqual(1, len(root_location_updates))
+
+        # lone entities are moved together with their root locations
+        self.assertEqual(rl1, cog1.being_in)
+        self.assertEqual(rl2, cog2.being_in)
+        self.assertAlmostEqual(4, rl1.position.x)
+        self.assertAlmostEqual(2, rl1.position.y)
+        self.assertAlmostEqual(6, rl2.position.x)
+        self.assertAlmostEqual(8, rl2.position.y)
+
+        # only the inertia is left
+        self.assertEqual([2, 0], properties.OptionalBeingMovedProperty(cog1).entity_property.data["inertia"])
+
+    def test_get_root_location_at_position_with_pending_moves(self):
+        rl1 = RootLocation(Point(2, 2), 10)
+        rl2 = RootLocation(Point(6, 6), 10)
+        db.session.add_all([rl1, rl2])
+        db.session.flush()
+
+        self.assertEqual(rl1, get_root_location_at_position(Point(2, 2)))
+
+        # rl1 is going to be moved away and rl2 is going to be moved to its position
+        new_positions_by_root_location = {rl1: (Point(4, 4), 0)}
+        self.assertIsNone(get_root_location_at_position(Point(2, 2), new_positions_by_root_location))
+        self.assertEqual(rl1, get_root_location_at_position(Point(4, 4), new_positions_by_root_location))
+
+        new_positions_by_root_location[rl2] = (Point(2, 2), 0)
+        self.assertEqual(rl2, get_root_location_at_position(Point(2, 2), new_positions_by_root_location))
+
 
 class SchedulerActivityTest(TestCase):
     create_app = util.set_up_app_with_database
@@ -331,6 +395,14 @@ class SchedulerActivityTest(TestCase):
         failure_notification = Notification.query.one()
         self.assertEqual(main.Errors.NO_TOOL_FOR_ACTIVITY, failure_notification.title_tag)
         self.assertEqual(worker, failure_notification.character)
+        self.assertEqual(1, failure_notification.count)
+
+        # the same failure in the next tick increases the counter of the existing notification
+        process = WorkProcess(None)
+        process.perform()
+
+        failure_notification = Notification.query.one()
+        self.assertEqual(2, failure_notification.count)
 
     def test_scheduler(self):
         """
@@ -356,6 +428,75 @@ class SchedulerActivityTest(TestCase):
         self.assertEqual(self.worker, result_item.being_in)
         self.assertEqual("result", result_item.type.name)
 
+    def test_work_process_isolates_failing_job_of_chunk(self):
+        rl = RootLocation(Point(1, 1), 123)
+        hammer_type = ItemType("hammer", 100)
+        db.session.add_all([rl, hammer_type])
+
+        def create_hammer(weight):
+            db.session.add(Item(hammer_type, rl, weight=weight))
+            if weight == 3:
+                raise main.TooFewParticipantsException(min_number=weight)
+
+        failed_jobs = []
+        process = WorkProcess(None)
+        with patch.object(WorkProcess, "CHUNK_SIZE", 4):
+            process.perform_in_chunks(list(range(10)), create_hammer,
+                                      lambda job, exception: failed_jobs.append((job, exception.error_kwargs)))
+
+        self.assertEqual([(3, {"min_number": 3})], failed_jobs)
+        hammers = Item.query.filter_by(type=hammer_type).all()
+        self.assertCountEqual([0, 1, 2, 4, 5, 6, 7, 8, 9], [hammer.weight for hammer in hammers])
+
+    def test_activity_in_steady_state(self):
+        util.initialize_date()
+        self._before_activity_process()
+
+        activity = Activity.query.one()
+        activity.ticks_needed = activity.ticks_left = 12  # 3 ticks of a single worker
+
+        work_task = ScheduledTask(["exeris.core.actions.WorkProcess", {}], GameDate.now().game_timestamp)
+        WorkProcess(work_task).perform()
+
+        self.assertEqual(7, activity.ticks_left)
+        self.assertIsNotNone(activity.steady_state_dependencies)
+        completion_task = ScheduledTask.query.get(activity.steady_state["completion_task_id"])
+        self.assertEqual(work_task.execution_game_timestamp + 2 * WorkProcess.SCHEDULER_RUNNING_INTERVAL,
+                         completion_task.execution_game_timestamp)
+
+        # activity in a steady state is not progressed by WorkProcess
+        WorkProcess(work_task).perform()
+        self.assertEqual(7, activity.ticks_left)
+
+        # dropping the tool brings the activity back to the regular progress
+        hammer = Item.query.filter(Item.is_in(self.worker)).one()
+        db.session.begin_nested()
+        hammer.being_in = self.worker.being_in
+        db.session.commit()
+        # committing a savepoint is not enough, it's done when the outermost transaction is committed
+        self.assertIsNotNone(activity.steady_state_dependencies)
+        # rollback of a later savepoint doesn't discard changes made before it
+        db.session.begin_nested()
+        db.session.rollback()
+        ActivitySteadyState.leave_for_changed_dependencies()
+
+        self.assertIsNone(activity.steady_state_dependencies)
+        self.assertIsNone(ScheduledTask.query.get(completion_task.id))
+
+        WorkProcess(work_task).perform()  # no tool, no progress
+        self.assertEqual(7, activity.ticks_left)
+        self.assertIsNone(activity.steady_state_dependencies)
+
+        hammer.being_in = self.worker
+        WorkProcess(work_task).perform()
+        self.assertEqual(2, activity.ticks_left)
+
+        completion_task = ScheduledTask.query.get(activity.steady_state["completion_task_id"])
+        ActivityCompletionProcess(activity, completion_task).perform()
+
+        result_item = Item.query.filter_by(type=ItemType.by_name("result")).one()
+        self.assertEqual(self.worker, result_item.being_in)
+
     def _before_activity_process(self):
         """
         Prepares environment for unit tests. Requires a tool called "hammer". Takes 1 tick.
@@ -665,6 +806,59 @@ class SchedulerActivityTest(TestCase):
         ActivityProgress.check_optional_machines({"anvil": 0.5}, rl, activity_params)
         self.assertEqual(activity_params["progress_ratio"], 1.0)
 
+    def test_prefetched_equipment_finder(self):
+        rl = RootLocation(Point(1, 1), 123)
+        plr = util.create_player("ABC")
+        worker1 = util.create_character("1", rl, plr)
+        worker2 = util.create_character("2", rl, plr)
+
+        worked_on_type = ItemType("worked_on", 100)
+        worked_on1 = Item(worked_on_type, rl)
+        worked_on2 = Item(worked_on_type, rl)
+        bone_hammer = ItemType("bone_hammer", 200)
+        bronze_anvil_type = ItemType("bronze_anvil", 300, portable=False)
+
+        hammers_group = TypeGroup("group_hammers", stackable=False)
+        hammers_group.add_to_group(bone_hammer, efficiency=2.0)
+
+        activity1 = Activity(worked_on1, "name", {}, {"mandatory_tools": ["group_hammers"],
+                                                      "mandatory_machines": ["bronze_anvil"]}, 1, worker1)
+        activity2 = Activity(worked_on2, "name", {}, {"optional_tools": {"group_hammers": 0.5},
+                                                      "optional_machines": {"bronze_anvil": 0.5}}, 1, worker2)
+
+        hammer1 = Item(bone_hammer, worker1, quality=1.5)
+        hammer2 = Item(bone_hammer, worker2)
+        anvil_on_ground = Item(bronze_anvil_type, rl)
+        anvil_in_worked_on = Item(bronze_anvil_type, worked_on2)
+
+        db.session.add_all([rl, worked_on_type, worked_on1, worked_on2, bone_hammer, bronze_anvil_type,
+                            hammers_group, activity1, activity2, hammer1, hammer2, anvil_on_ground,
+                            anvil_in_worked_on])
+        db.session.flush()
+
+        finder = PrefetchedEquipmentFinder({activity1: [worker1], activity2: [worker2]})
+
+        worker_impact = {}
+        ActivityProgress.check_mandatory_tools(worker1, ["group_hammers"], worker_impact, finder)
+        self.assertCountEqual([3.0], worker_impact["tool_based_quality"])
+
+        activity_params = {}
+        ActivityProgress.check_mandatory_machines(["bronze_anvil"], worked_on1, activity_params, finder)
+        self.assertCountEqual([1.0], activity_params["machine_based_quality"])
+
+        worker_impact = {}
+        ActivityProgress.check_optional_tools(worker2, {"group_hammers": 0.5}, worker_impact, finder)
+        self.assertAlmostEqual(1.0, worker_impact["progress_ratio"])
+
+        activity_params = {}
+        ActivityProgress.check_optional_machines({"bronze_anvil": 0.5}, worked_on2, activity_params, finder)
+        self.assertAlmostEqual(0.5, activity_params["progress_ratio"])
+
+        # tool moved away during the tick is no longer available
+        hammer1.being_in = rl
+        self.assertRaises(main.NoToolForActivityException,
+                          lambda: ActivityProgress.check_mandatory_tools(worker1, ["group_hammers"], {}, finder))
+
     def test_check_activitys_skills(self):
         rl = RootLocation(Point(1, 1), 123)
         worked_on_type = ItemType("worked_on", 100)
@@ -783,6 +977,22 @@ class SchedulerEatingTest(TestCase):
         self.assertAlmostEqual(value_after_two_ticks, char.states["fitness"])
         self.assertAlmostEqual(value_after_two_ticks, char.states["perception"])
 
+    def test_eating_process_only_for_alive_characters(self):
+        rl = RootLocation(Point(1, 1), 111)
+        db.session.add(rl)
+        alive_char = util.create_character("alive", rl, util.create_player("DEF"))
+        dead_char = util.create_character("dead", rl, util.create_player("GHI"))
+        dead_char.type = models.EntityType.by_name(main.Types.DEAD_CHARACTER)
+        dead_char.eating_queue = dict(strength=0.3)
+
+        process = EatingProcess(None)
+        process.perform()
+
+        self.assertEqual(EatingProcess.HUNGER_INCREASE, alive_char.states["hunger"])
+        self.assertEqual(0, dead_char.states["hunger"])
+        self.assertEqual(Character.FOOD_BASED_ATTR_INITIAL_VALUE, dead_char.states["strength"])
+        self.assertEqual({"strength": 0.3}, dead_char.eating_queue)
+
     def test_eating_applying_single_attr_food(self):
         rl = RootLocation(Point(1, 1), 111)
         db.session.add(rl)
@@ -956,30 +1166,43 @@ class SchedulerDecayTest(TestCase):
 
         db.session.add_all([rl, carrot_type, fresh_pile_of_carrots, axe_type, axe, hammer_type, hammer])
 
-        process = DecayProcess(None)
-        process.perform()
+        with patch("exeris.core.general.GameDate._get_timestamp", new=lambda: 1100):  # stop the time!
+            process = DecayProcess(None)
+            process.perform()
 
-        self.assertAlmostEqual(1 / 30, fresh_pile_of_carrots.damage)
-        self.assertEqual(1000, fresh_pile_of_carrots.amount)
+            self.assertAlmostEqual(1 / 30, fresh_pile_of_carrots.damage)
+            self.assertEqual(1000, fresh_pile_of_carrots.amount)
 
-        self.assertAlmostEqual(1 / 100, axe.damage)
+            self.assertAlmostEqual(1 / 100, axe.damage)
 
-        self.assertEqual(0.0, hammer.damage)  # make sure items without DEGRADABLE property are not affected
+            self.assertEqual(0.0, hammer.damage)  # make sure items without DEGRADABLE property are not affected
 
-        old_pile_of_carrots = Item(carrot_type, rl, amount=1000)
-        old_pile_of_carrots.damage = 0.99  #
+            # the time when the item reaches the maximum damage
+            previous_run_timestamp = GameDate.now().game_timestamp - DecayProcess.SCHEDULER_RUNNING_INTERVAL
+            self.assertEqual(previous_run_timestamp + 30 * 24 * 3600, fresh_pile_of_carrots.crumble_at)
+            self.assertIsNone(hammer.crumble_at)
 
-        axe.damage = 0.999  # it'll crumble
+        # damage is increasing between the runs of the process
+        with patch("exeris.core.general.GameDate._get_timestamp", new=lambda: 1100 + GameDate.SEC_IN_DAY / 2):
+            self.assertAlmostEqual(1.5 / 30, fresh_pile_of_carrots.damage)
+            self.assertAlmostEqual(1.5 / 100, axe.damage)
 
-        db.session.add(old_pile_of_carrots)
+            old_pile_of_carrots = Item(carrot_type, rl, amount=1000)
+            old_pile_of_carrots.damage = 0.99  #
 
-        process = DecayProcess(None)
-        process.perform()
+            axe.damage = 0.999  # it'll crumble
+
+            db.session.add(old_pile_of_carrots)
+
+        with patch("exeris.core.general.GameDate._get_timestamp", new=lambda: 1100 + GameDate.SEC_IN_DAY):
+            process = DecayProcess(None)
+            process.perform()
 
-        self.assertEqual(1, old_pile_of_carrots.damage)
-        self.assertEqual(990, old_pile_of_carrots.amount)
-        self.assertEqual(None, axe.being_in)
-        self.assertTrue(sql.inspect(axe).deleted)
+            self.assertAlmostEqual(2 / 30, fresh_pile_of_carrots.damage)
+            self.assertEqual(1, old_pile_of_carrots.damage)
+            self.assertEqual(990, old_pile_of_carrots.amount)
+            self.assertEqual(None, axe.being_in)
+            self.assertTrue(sql.inspect(axe).deleted)
 
     def test_activity_decay(self):
         util.initialize_date()
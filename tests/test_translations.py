@@ -1,3 +1,8 @@
+import json
+import os
+import tempfile
+import unittest.mock
+
 from exeris.core.actions import ControlMovementAction, TravelInDirectionAction
 from flask import g
 from flask_testing import TestCase
@@ -6,7 +11,7 @@ from shapely.geometry import Point
 
 from exeris.core import main
 from exeris.core.general import GameDate
-from exeris.core.i18n import create_pyslate
+from exeris.core.i18n import create_pyslate, MissingTagsRecorder
 from exeris.core.main import db, Types
 from exeris.core.models import Item, ItemType, RootLocation, EntityProperty, Character, ObservedName, Location, \
     LocationType, TerrainArea, TerrainType, Passage, Activity, PassageType, EntityType, EntityTypeProperty
@@ -216,6 +221,21 @@ data = {
     "tp_game_date": {
         "en": "%{day}-%{moon}m. %{hour}:%{minute}",
     },
+    "tp_combat_log_hit": {
+        "en": "${doer:entity_info} hits ${target:entity_info}.",
+    },
+    "tp_combat_log_hit_doer": {
+        "en": "You hit ${target:entity_info}.",
+    },
+    "tp_combat_log_hit_target": {
+        "en": "You are hit by ${doer:entity_info}.",
+    },
+    "tp_combat_log_retreat": {
+        "en": "${doer:entity_info} retreats from combat.",
+    },
+    "tp_combat_log_retreat_doer": {
+        "en": "You retreat from combat.",
+    },
 
 }
 
@@ -448,6 +468,30 @@ class CharacterAndLocationTranslationTest(TestCase):
         self.assertEqual("martwa Judith", pyslate_pl.t("character_info", **woman.pyslatize()))
         self.assertEqual("martwy John", pyslate_pl.t("character_info", **man.pyslatize()))
 
+    def test_combat_log_in_perspective_of_observer(self):
+        util.initialize_date()
+
+        rl = RootLocation(Point(1, 1), 111)
+        plr = util.create_player("adwdas")
+        man = util.create_character("A MAN", rl, plr, sex=Character.SEX_MALE)
+        woman = util.create_character("A WOMAN", rl, plr, sex=Character.SEX_FEMALE)
+        obs = util.create_character("obs", rl, plr)
+        db.session.add(rl)
+        db.session.flush()
+
+        combat_log = {"hits": [{"doer": man.pyslatize(), "target": woman.pyslatize()}],
+                      "retreats": [woman.pyslatize()], "withdrawals": []}
+        backend = json_backend.JsonBackend(json_data=data)
+
+        pyslate_en = create_pyslate("en", backend=backend, character=obs)
+        self.assertEqual("man hits woman. woman retreats from combat.", pyslate_en.t("combat_log", **combat_log))
+
+        pyslate_en = create_pyslate("en", backend=backend, character=man)
+        self.assertEqual("You hit woman. woman retreats from combat.", pyslate_en.t("combat_log", **combat_log))
+
+        pyslate_en = create_pyslate("en", backend=backend, character=woman)
+        self.assertEqual("You are hit by man. You retreat from combat.", pyslate_en.t("combat_log", **combat_log))
+
     def test_location_name(self):
         rl = RootLocation(Point(1, 1), 213)
         plr = util.create_player("dawdasdawdasw")
@@ -530,6 +574,26 @@ class CharacterAndLocationTranslationTest(TestCase):
 
         self.assertEqual("wololo", pyslate_en.t("TAG_THAT_DOESNT_EXIST"))
 
+    def test_missing_tags_recorder_buffers_tags_until_flush(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "missing_tags.json")
+            with open(file_path, "w") as f:
+                f.write(json.dumps({"old_tag": {"en": "abc"}}))
+
+            with unittest.mock.patch.object(MissingTagsRecorder, "FILE_PATH", file_path):
+                backend = json_backend.JsonBackend(json_data=data)
+                pyslate_en = create_pyslate("en", backend=backend)
+
+                self.assertEqual("[MISSING TAG new_tag]", pyslate_en.t("new_tag", number=3, target={"a": 1}))
+                with open(file_path) as f:  # nothing is written until flush
+                    self.assertEqual({"old_tag": {"en": "abc"}}, json.loads(f.read()))
+
+                MissingTagsRecorder.flush()
+
+            with open(file_path) as f:
+                self.assertEqual({"old_tag": {"en": "abc"}, "new_tag": {"en": "number,target[a]"}},
+                                 json.loads(f.read()))
+
     def test_passage_with_other_side(self):
         rl = RootLocation(Point(1, 1), 213)
         initiator = util.create_character("initiator", rl, util.create_player("abc"))
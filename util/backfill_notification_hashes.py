@@ -0,0 +1,38 @@
+from exeris.app import app, db
+from exeris.core import models
+
+"""
+Sets the content hash of deduplicated failure notifications created before the content hash was introduced.
+They are the ones with the same title and text. Notifications turning out to have the same contents
+for the same recipient are merged into the most recent one, so the unique index is not violated.
+"""
+
+if __name__ == "__main__":
+    with app.app_context():
+        notifications = models.Notification.query.filter(models.Notification.content_hash.is_(None)) \
+            .filter(models.Notification.title_tag == models.Notification.text_tag) \
+            .order_by(models.Notification.game_date.desc()).all()
+
+        # notifications created after the content hash was introduced are the most recent ones
+        notification_by_recipient_and_hash = {
+            (notification.character_id, notification.player_id, notification.content_hash): notification
+            for notification in models.Notification.query.filter(models.Notification.content_hash.isnot(None)).all()}
+        hashed_count = 0
+        merged_count = 0
+        for notification in notifications:
+            if notification.title_params != notification.text_params:
+                continue
+            content_hash = models.Notification.get_content_hash(notification.title_tag, notification.title_params,
+                                                                notification.text_tag, notification.text_params)
+            key = (notification.character_id, notification.player_id, content_hash)
+            if key in notification_by_recipient_and_hash:
+                notification_by_recipient_and_hash[key].count += notification.count
+                db.session.delete(notification)
+                merged_count += 1
+            else:
+                notification.content_hash = content_hash
+                hashed_count += 1
+                notification_by_recipient_and_hash[key] = notification
+
+        print("SET CONTENT HASH OF {} NOTIFICATIONS, MERGED {} DUPLICATES".format(hashed_count, merged_count))
+        db.session.commit()
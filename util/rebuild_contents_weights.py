@@ -0,0 +1,8 @@
+from exeris.app import app, db
+from exeris.core import models
+
+if __name__ == "__main__":
+    with app.app_context():
+        fixed_entity_ids = models.rebuild_contents_weights()
+        print("FIXED CONTENTS WEIGHT OF {} ENTITIES".format(len(fixed_entity_ids)))
+        db.session.commit()